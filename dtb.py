@@ -12,11 +12,14 @@ Usage:
   dtb.py add <resource-uri>...
   dtb.py addfolder <folder-uri>
   dtb.py info
+  dtb.py compact
   dtb.py size
-  dtb.py lmdb export <lmdb_destination> <splits>... [--size=<WxH>] [--equalize-histogram] [--shuffle]
-  dtb.py lmdb import <lmdb_source> [--clean]
-  dtb.py lmdb size <lmdb_source>
-  dtb.py lmdb check-shuffle-status <lmdb_source>
+  dtb.py lmdb export <lmdb_destination> <splits>... [--size=<WxH>] [--equalize-histogram] [--shuffle] [--workers=<N>] [--seed=<seed>] [--compact] [--encoded=<format>] [--resume | --incremental] [--stratify] [--max-consecutive=<N>] [--shards=<N>] [--no-statistics] [--fast-write]
+  dtb.py lmdb import <lmdb_source> [--clean] [--workers=<N>]
+  dtb.py lmdb transform <lmdb_source> <lmdb_destination> [<splits>...] [--shuffle] [--size=<WxH>] [--equalize-histogram] [--workers=<N>] [--seed=<seed>] [--compact] [--stratify] [--max-consecutive=<N>] [--shards=<N>] [--no-statistics] [--fast-write]
+  dtb.py lmdb concat <lmdb_destination> <lmdb_sources>... [--shuffle] [--seed=<seed>] [--compact] [--fast-write]
+  dtb.py lmdb size <lmdb_source> [--rescan]
+  dtb.py lmdb check-shuffle-status <lmdb_source> [--workers=<N>] [--rescan] [--sample=<fraction|count>] [--seed=<seed>]
   dtb.py zip export <zip_destination>
   dtb.py zip import <zip_source> [--override-config]
   dtb.py merge <dataset_uri>... [--deduplicate-by-hash] [--blacklist=<uri>]
@@ -36,9 +39,30 @@ Options:
   --equalize-histogram      Equalizes the histogram of the pixels' intensities,
   --clean       Specifies if the previous content should be cleaned. Otherwise it will be merged.
   --override-config     Overrides the configuration file for this dataset if it exists in the zip file.
+  --workers=<N>     Number of processes used to decode and normalize images when exporting, or to read the LMDB when
+                    importing or checking it [default: 1].
+  --seed=<seed>     Seed for the shuffle and the splits of the export. The same seed produces the same LMDB. When
+                    sampling a LMDB, seed for the position of the samples.
+  --compact     Compacts the exported LMDB to its real size at the end of the export.
+  --encoded=<format>    Stores the images compressed inside the LMDB instead of raw pixels. Format is jpg or png,
+                        optionally with the quality. Example: jpg:90
+  --resume      Resumes a previous export into the same LMDB, exporting only the images that are not in its manifest.
+  --incremental     Same as --resume. Exports only the images added to the dataset since the previous export.
+  --stratify    Splits each class separately, so that every split keeps the proportions of the classes.
+  --max-consecutive=<N>     Shuffles the export interleaving the classes, so that no more than N consecutive images
+                            share the same class.
+  --shards=<N>  Writes each split into N LMDBs at the same time, each one from its own process [default: 1].
+  --no-statistics   Skips the computation of the mean image and the channels statistics of each exported split.
+  --fast-write  Writes the LMDBs without synchronous writes, syncing them to disk only when they are closed. Faster, but
+                a crash of the system while writing may corrupt them.
+  --rescan      Reads the whole LMDB instead of the summary written by the export.
+  --sample=<fraction|count>     Estimates the shuffle status from random batches of consecutive images instead of
+                                reading all of them. It is the fraction of the images to read (0.01) or their number
+                                (100000).
 """
 
 import json
+import math
 import os
 from docopt import docopt
 import inspect
@@ -46,18 +70,11 @@ import inspect
 from main.dataset.data_holder.mem_database import MemDatabase
 from main.dataset.dataset import dataset_proto, LMDB_BATCH_SIZE, Dataset
 from main.normalizer.normalizer import normalizer_proto
-
-# Import datasets to register them
-from main.dataset.generic_image_age_dataset import GenericImageAgeDataset           # DO NOT DELETE THIS LINE
-from main.dataset.generic_image_dataset import GenericImageDataset                  # DO NOT DELETE THIS LINE
-
-# Import normalizers to register them
-from main.normalizer.image.histogram_normalizer import HistogramNormalizer          # DO NOT DELETE THIS LINE
-from main.normalizer.image.size_normalizer import SizeNormalizer                    # DO NOT DELETE THIS LINE
-
 from main.resource.resource import Resource
-from main.tools.lmdb_util import LMDBUtil
-from main.tools.splitter import Splitter
+from main.tools.split_engine import SplitEngine
+
+# Dataset types, normalizers and the LMDB tools are imported only by the commands that use them, so that the
+# commands that don't need them (like info or lmdb size) start fast.
 
 __author__ = 'Iván de Paz Centeno'
 HIDDEN_CONFIG_FILE='.options.json'
@@ -111,6 +128,10 @@ class DTB(object):
             self.do_lmdb_check_shuffle()
         elif arguments['lmdb'] and arguments['size']:
             self.do_lmdb_get_size()
+        elif arguments['lmdb'] and arguments['transform']:
+            self.do_lmdb_transform()
+        elif arguments['lmdb'] and arguments['concat']:
+            self.do_lmdb_concat()
         #
         #
 
@@ -119,6 +140,9 @@ class DTB(object):
         else:
             self._load_options()
 
+        if not arguments['info']:
+            self._load_dataset()
+
         if arguments['add']:
             self.do_add()
 
@@ -134,6 +158,9 @@ class DTB(object):
         elif arguments['size']:
             self.do_get_size()
 
+        elif arguments['compact']:
+            self.do_compact()
+
         elif arguments['lmdb'] and arguments['export']:
             self.do_lmdb_export()
 
@@ -172,7 +199,7 @@ class DTB(object):
 
     def _load_options(self):
         """
-        Loads the options file and, if it exists, initializes the dataset with that options.
+        Loads the options file of the dataset, if it exists.
         :return:
         """
 
@@ -186,11 +213,16 @@ class DTB(object):
             print("Invalid dataset type.")
             exit(-1)
 
+    def _load_dataset(self):
+        """
+        Initializes the dataset of the current folder with the loaded options. Only the module of its type is imported.
+        """
         parameters = {
             "root_folder": os.getcwd(),
         }
 
-        arguments_to_fulfill = [argument for argument in inspect.getargspec(dataset_proto[self.options['type']]).args
+        dataset_arguments = inspect.getfullargspec(dataset_proto[self.options['type']]).args
+        arguments_to_fulfill = [argument for argument in dataset_arguments
                                 if argument not in parameters and argument in self.options]
 
         for argument in arguments_to_fulfill:
@@ -217,6 +249,18 @@ class DTB(object):
         print(len(self.dataset.get_keys()))
         exit(0)
 
+    def do_compact(self):
+        """
+        Compacts the journal of the metadata into the metadata file of the dataset.
+        :return:
+        """
+        if self.dataset.compact_metadata():
+            print("Metadata journal compacted into {}".format(self.dataset.get_metadata_filename()))
+        else:
+            print("There is no metadata journal to compact.")
+
+        exit(0)
+
     def do_add(self):
         """
         Appends to the current dataset the specified files.
@@ -260,7 +304,8 @@ class DTB(object):
 
         dataset = Dataset(uri, "", "none")
 
-        dataset._load_routes()
+        # The folder is listed without writing the routes index into it.
+        dataset._load_routes(persist_index=False)
 
         for route in dataset.get_routes():
             try:
@@ -336,26 +381,32 @@ class DTB(object):
         Exports the current dataset into a LMDB format under the specified folder with the specified splits.
         :return:
         """
-        dest_dir = self.arguments['<lmdb_destination>']
+        from main.tools.image_encoding import ImageEncoding
 
-        splits_preprocessed = [split.split(":") for split in self.arguments['<splits>']]
+        dest_dir = self.arguments['<lmdb_destination>']
 
-        percentages = [float(split_elements[1]) for split_elements in splits_preprocessed]
+        splits = [split.split(":") for split in self.arguments['<splits>']]
 
-        if sum(percentages) > 1:
+        if sum([float(percentage) for name, percentage in splits]) > 1:
             print("Splits for LMDB export are not correctly defined: they must sum 1 or less.")
             exit(-1)
 
-        # The percentage with highest value must be changed to 1. Required by dataset's lmdb export method
-        index_max = max(range(len(percentages)), key=percentages.__getitem__)
-        splits_preprocessed[index_max][1] = 1
+        seed = self.arguments['--seed']
+        encoding = self.arguments['--encoded']
 
-        splits = [Splitter(split_elements[1], split_elements[0]) for split_elements in splits_preprocessed]
+        if seed is not None:
+            seed = int(seed)
 
-        # The percentage with highest value must be the last in the splits list.
-        if index_max+1 < len(splits):
-            # Let's swap index_max by the last element.
-            splits[-1], splits[index_max] = splits[index_max], splits[-1]
+        if encoding is not None:
+            encoding = ImageEncoding.fromstring(encoding)
+
+        max_consecutive = self.arguments['--max-consecutive']
+
+        if max_consecutive is not None:
+            max_consecutive = int(max_consecutive)
+
+        # Splits are assigned by a hash of the keys, so the same seed always gives the same splits.
+        split_engine = SplitEngine(splits, seed=seed or 0, stratify=self.arguments['--stratify'])
 
         # If are there normalizers defined for this export we need to create them.
         normalizers_to_fulfill = [normalizer for normalizer in normalizer_proto if self.arguments["--"+normalizer]]
@@ -367,43 +418,147 @@ class DTB(object):
         self.dataset.update_normalizers(normalizers)
         self.dataset.load_dataset()
 
-        self.dataset.export_to_lmdb(lmdb_foldername=dest_dir, splitters=splits,
-                                    apply_normalizers=(len(normalizers) > 0))
+        self.dataset.export_to_lmdb(lmdb_foldername=dest_dir, split_engine=split_engine,
+                                    apply_normalizers=(len(normalizers) > 0),
+                                    workers=int(self.arguments['--workers']), seed=seed,
+                                    compact=self.arguments['--compact'], encoding=encoding,
+                                    resume=self.arguments['--resume'] or self.arguments['--incremental'],
+                                    max_consecutive=max_consecutive, shards=int(self.arguments['--shards']),
+                                    compute_statistics=not self.arguments['--no-statistics'],
+                                    fast_write=self.arguments['--fast-write'])
+
+        exit(0)
+
+    def do_lmdb_transform(self):
+        """
+        Writes a LMDB into new LMDBs, shuffled, split or normalized. The dataset is not used.
+        :return:
+        """
+        from main.tools.lmdb_shards import find_lmdb_foldernames
+        from main.tools.lmdb_transformer import LMDBTransformer
+
+        lmdb_source = self.arguments["<lmdb_source>"]
+
+        if not find_lmdb_foldernames(lmdb_source):
+            print("Specified LMDB source wasn't found.")
+            exit(-1)
+
+        splits = [split.split(":") for split in self.arguments['<splits>']]
+
+        if sum([float(percentage) for name, percentage in splits]) > 1:
+            print("Splits for LMDB transform are not correctly defined: they must sum 1 or less.")
+            exit(-1)
+
+        seed = self.arguments['--seed']
+
+        if seed is not None:
+            seed = int(seed)
+
+        max_consecutive = self.arguments['--max-consecutive']
+
+        if max_consecutive is not None:
+            max_consecutive = int(max_consecutive)
+
+        split_engine = None
+
+        if splits:
+            split_engine = SplitEngine(splits, seed=seed or 0, stratify=self.arguments['--stratify'])
+
+        normalizers = [normalizer_proto[normalizer].fromstring(self.arguments["--"+normalizer])
+                       for normalizer in normalizer_proto if self.arguments["--"+normalizer]]
+
+        transformer = LMDBTransformer(normalizers, workers=int(self.arguments['--workers']))
+
+        try:
+            transformer.transform(lmdb_source, self.arguments['<lmdb_destination>'], split_engine=split_engine,
+                                  shuffle=self.arguments['--shuffle'], seed=seed, compact=self.arguments['--compact'],
+                                  max_consecutive=max_consecutive, shards=int(self.arguments['--shards']),
+                                  compute_statistics=not self.arguments['--no-statistics'],
+                                  fast_write=self.arguments['--fast-write'])
+
+        except Exception as ex:
+            print("LMDB couldn't be transformed. Reason: {}".format(ex))
+            exit(-1)
+
+        exit(0)
+
+    def do_lmdb_concat(self):
+        """
+        Concatenates several LMDBs into a new one. The dataset is not used.
+        :return:
+        """
+        from main.tools.lmdb_concatenator import LMDBConcatenator
+
+        seed = self.arguments['--seed']
+
+        if seed is not None:
+            seed = int(seed)
+
+        try:
+            LMDBConcatenator().concat(self.arguments['<lmdb_destination>'], self.arguments['<lmdb_sources>'],
+                                      shuffle=self.arguments['--shuffle'], seed=seed,
+                                      compact=self.arguments['--compact'], fast_write=self.arguments['--fast-write'])
+
+        except Exception as ex:
+            print("LMDBs couldn't be concatenated. Reason: {}".format(ex))
+            exit(-1)
 
         exit(0)
 
     def do_lmdb_get_size(self):
         """
-        Prints the number of elements in a LMDB file.
+        Prints the number of elements in a LMDB file or in a set of shards.
         """
+        from main.tools.lmdb_shards import find_lmdb_foldernames
+        from main.tools.lmdb_util import LMDBUtil
+
         lmdb_source = self.arguments["<lmdb_source>"]
 
-        if not os.path.exists(lmdb_source):
+        if not find_lmdb_foldernames(lmdb_source):
             print("Specified LMDB source wasn't found.")
             exit(-1)
 
-        lmdb_util = LMDBUtil(lmdb_source)
+        lmdb_util = LMDBUtil(lmdb_source, rescan=self.arguments['--rescan'])
 
         print(lmdb_util.get_size())
         exit(0)
 
     def do_lmdb_check_shuffle(self):
         """
-        Checks if a given LMDB is shuffled or not.
+        Checks if a given LMDB (or each shard of a set of shards) is shuffled or not.
         :return:
         """
+        from main.tools.lmdb_shards import find_lmdb_foldernames
+        from main.tools.lmdb_util import LMDBUtil
+
         lmdb_source = self.arguments["<lmdb_source>"]
 
-        if not os.path.exists(lmdb_source):
+        if not find_lmdb_foldernames(lmdb_source):
             print("Specified LMDB source wasn't found.")
             exit(-1)
 
-        lmdb_util = LMDBUtil(lmdb_source)
+        lmdb_util = LMDBUtil(lmdb_source, workers=int(self.arguments['--workers']),
+                             rescan=self.arguments['--rescan'])
+
+        if self.arguments['--sample'] is not None:
+            try:
+                max_consecutive_counts = self._sample_shuffle(lmdb_util, float(self.arguments['--sample']))
+
+            except Exception as ex:
+                print("LMDB couldn't be sampled. Reason: {}".format(ex))
+                exit(-1)
 
-        classes = lmdb_util.get_classes()
-        max_consecutive_counts = lmdb_util.get_max_consecutive_counts()
+            self._print_shuffle_verdict(max_consecutive_counts)
+            exit(0)
+
+        # The summaries of the export (or a single pass over the labels) retrieve the classes and their consecutive
+        # counts.
+        scan_result = lmdb_util.scan()
+
+        classes = scan_result["classes"]
+        max_consecutive_counts = scan_result["max_consecutive"]
         total_classes = len(classes)
-        total_elements = sum([value for key, value in classes.items()])
+        total_elements = scan_result["entries"]
 
         print("Available_classes:")
         print(json.dumps(classes, indent="    "))
@@ -411,6 +566,83 @@ class DTB(object):
         print("\n Max consecutive count:")
         print(json.dumps(max_consecutive_counts, indent="    "))
 
+        label_dictionary = lmdb_util.get_label_dictionary()
+
+        if label_dictionary:
+            print("\n Labels:")
+            print(json.dumps(label_dictionary, indent="    "))
+
+        self._print_shuffle_verdict(max_consecutive_counts)
+        exit(0)
+
+    def _sample_shuffle(self, lmdb_util, sample):
+        """
+        Estimates the shuffle status of a LMDB from random windows of LMDB_BATCH_SIZE consecutive elements, and prints
+        the estimation.
+        :param lmdb_util: LMDBUtil of the LMDB.
+        :param sample: fraction (lower than 1) or number of elements to read.
+        :return: the maximum number of consecutive elements of each class observed.
+        """
+        from main.tools.shuffle_estimate import estimate_shuffle
+
+        if sample <= 0:
+            raise Exception("Sample must be a positive fraction or number of elements")
+
+        total_elements = lmdb_util.get_size()
+        sample_elements = sample * total_elements if sample < 1 else sample
+
+        seed = self.arguments['--seed']
+        windows = lmdb_util.sample_windows(sample_elements, LMDB_BATCH_SIZE,
+                                           seed=None if seed is None else int(seed))
+
+        thresholds = [int(math.ceil(LMDB_BATCH_SIZE * 0.2)), int(math.ceil(LMDB_BATCH_SIZE * 0.5))]
+        estimate = estimate_shuffle(windows, thresholds, total_entries=total_elements)
+
+        print("Sampled {} batches of {} elements: {} of {} elements ({}%).".format(
+            estimate["windows"], LMDB_BATCH_SIZE, estimate["entries"], total_elements,
+            round(estimate["entries"] / max(1, total_elements) * 100, 2)))
+        print("\n Sampled classes:")
+        print(json.dumps(estimate["classes"], indent="    "))
+        print("\n Max consecutive count observed (the real one may be greater):")
+        print(json.dumps(estimate["max_consecutive"], indent="    "))
+
+        print("\n Mean consecutive count (95% confidence interval):")
+        for class_name, (mean, low, high) in estimate["run_length"].items():
+            if mean is None:
+                print("[Class {}] No complete runs sampled.".format(class_name))
+            else:
+                print("[Class {}] {:.2f} ({:.2f} - {:.2f})".format(class_name, mean, low, high))
+
+        print("\n Batches with long runs (95% confidence interval):")
+        for class_name, long_runs in estimate["long_runs"].items():
+            print("[Class {}] {}".format(class_name, ", ".join(
+                ["{} or more consecutive: {:.2f}% ({:.2f}% - {:.2f}%)".format(threshold, proportion * 100, low * 100,
+                                                                             high * 100)
+                 for threshold, (proportion, low, high) in sorted(long_runs.items())])))
+
+        batch_entropy, low, high = estimate["entropy"]["batch"]
+
+        if batch_entropy is not None:
+            print("\n Entropy of the classes inside a batch: {:.3f} bits ({:.3f} - {:.3f}). Entropy of the classes "
+                  "of all the sampled elements: {:.3f} bits.".format(batch_entropy, low, high,
+                                                                    estimate["entropy"]["global"]))
+
+        print("\n Max consecutive count extrapolated to all the elements, if they were randomly shuffled (95% "
+              "confidence interval):")
+        for class_name, (estimated, low, high) in estimate["estimated_max_consecutive"].items():
+            print("[Class {}] {} ({} - {})".format(class_name, estimated, low, "?" if high is None else high))
+
+        # The verdict is only given from what was read: the extrapolation assumes that the LMDB is shuffled.
+        print("\n Verdict from the max consecutive count observed:")
+
+        return estimate["max_consecutive"]
+
+    @staticmethod
+    def _print_shuffle_verdict(max_consecutive_counts):
+        """
+        Prints if each class is shuffled enough to train, by its maximum number of consecutive elements.
+        :param max_consecutive_counts: dict with the maximum number of consecutive elements of each class.
+        """
         # Shuffle logic check: should be lesser than LMDB_BATCH_SIZE
         for class_name, count in max_consecutive_counts.items():
             if count < LMDB_BATCH_SIZE * 0.2:
@@ -419,9 +651,7 @@ class DTB(object):
                 print("[Class {}] It is partially shuffled, it could work but consider shuffling again.".format(class_name))
             else:
                 print("[Class {}] Shuffle is not correct as it is greater than half of the "
-                      "batch size ({}).".format(LMDB_BATCH_SIZE, class_name))
-
-        exit(0)
+                      "batch size ({}).".format(class_name, LMDB_BATCH_SIZE))
 
     def do_list_dataset_types(self):
         """
@@ -439,9 +669,11 @@ class DTB(object):
         """
         self.dataset.load_dataset()
 
+        from main.tools.lmdb_shards import find_lmdb_foldernames
+
         source = self.arguments['<lmdb_source>']
 
-        if not os.path.exists(source):
+        if not find_lmdb_foldernames(source):
             print("Error: the specified LMDB source folder does not exist.")
             exit(-1)
 
@@ -450,7 +682,7 @@ class DTB(object):
         if do_clean:
             self.dataset.clean(remove_files=True)
 
-        self.dataset.import_from_lmdb(source)
+        self.dataset.import_from_lmdb(source, workers=int(self.arguments['--workers']))
         self.dataset.save_dataset()
 
         exit(0)
@@ -6,10 +6,15 @@ __author__ = 'Iván de Paz Centeno'
 import fnmatch
 import os
 import errno
+from main.tools.lazy_registry import LazyRegistry
+from main.tools.route_finder import RouteFinder
+from main.tools.route_index import RouteIndex
 
 
-LMDB_BATCH_SIZE = 256    # Batch size for writing into LMDB. This is the amount of image
-                         # before the batch is commited into the file.
+LMDB_BATCH_SIZE = 256    # Batch size for reading from LMDB (training batches). It is also the amount of image
+                         # sent at once to the process of a shard.
+LMDB_BATCH_BYTES = 64 * 1024 * 1024     # Bytes of the entries of a batch before it is commited into the file.
+LMDB_BATCH_SECONDS = 10                 # Seconds since the first entry of a batch before it is commited into the file.
 
 
 def mkdir_p(dir):
@@ -41,7 +46,7 @@ class Dataset(object):
         """
         Initializes the dataset object.
         Override this constructor to append functionality, for example loading the folders upon initialization with
-        _load_routes() method.
+        _load_routes() method. Otherwise, routes are loaded the first time they are used.
         :param root_folder: root folder of the dataset.
         :param metadata_file: file that represents the metadata (usually labels or ground truth)
         :param description: basic description of the dataset. This is useful for reports.
@@ -52,15 +57,40 @@ class Dataset(object):
         self.description = description
         self.file_extensions = ExtensionSet([".jpg"])
         self.metadata_content = {}
-        self.routes = []
+        self._routes = None
+        self._route_finder = None
 
-    def _load_routes(self):
+    @property
+    def routes(self):
         """
-        Iterates over the folder recursively in order to retrieve the files that matches the file extensions
+        Routes of the files of the dataset that match the file extensions. They are loaded the first time they are
+        used.
         """
-        for root, dirnames, filenames in os.walk(self.root_folder):
-            for filename in self.file_extensions.fnfilter(filenames):
-                self.routes.append(os.path.join(root, filename))
+        if self._routes is None:
+            self._load_routes()
+
+        return self._routes
+
+    @routes.setter
+    def routes(self, routes):
+        """
+        Sets the routes of the dataset. If set to None, they are loaded again the next time they are used.
+        """
+        self._routes = routes
+        self._route_finder = None
+
+    def _load_routes(self, persist_index=True):
+        """
+        Retrieves the files under the root folder that match the file extensions.
+        They are read from an index of the folder (see RouteIndex), where only the folders modified since the
+        previous load are listed again.
+        :param persist_index: boolean flag to store the index inside the root folder. If False, the whole folder is
+        listed and nothing is written into it.
+        """
+        route_index = RouteIndex(self.root_folder, index_filename=None if persist_index else False)
+        route_index.refresh()
+
+        self.routes = route_index.get_routes(self.file_extensions)
 
     def _load_metadata_file(self):
         """
@@ -81,15 +111,36 @@ class Dataset(object):
         """
         return list(self.routes)
 
-    def find_route(self, token_id):
+    def _get_route_finder(self):
+        """
+        Retrieves the index of the routes to find them by id. It is built the first time it is used.
+        :return: RouteFinder of the routes.
+        """
+        if self._route_finder is None:
+            self._route_finder = RouteFinder(self.routes)
+
+        return self._route_finder
+
+    def find_route(self, token_id, exact=False):
         """
         finds a route given a specific ID, usually retrieved from the metadata.
         :param token_id: id token to search for.
+        :param exact: boolean flag to match the id against the file name of the routes (with or without extension)
+        instead of searching it inside the routes.
         :return: routes that matches the specified id token. It may return more than one route if
         the ID is not specific enough.
         """
-        search_key = token_id
-        return [route for route in self.routes if search_key in route]
+        return self._get_route_finder().find_route(token_id, exact=exact)
+
+    def find_routes(self, token_ids, exact=False):
+        """
+        Finds the routes of many IDs at once. It is much faster than calling find_route() for each one.
+        :param token_ids: list of id tokens to search for.
+        :param exact: boolean flag to match the ids against the file name of the routes (with or without extension)
+        instead of searching them inside the routes.
+        :return: dict {token_id: routes that match the id token}.
+        """
+        return self._get_route_finder().find_routes(token_ids, exact=exact)
 
     def get_root_folder(self):
         """
@@ -201,4 +252,7 @@ class ExtensionSet(object):
         return filtered_files
 
 
-dataset_proto = {}
+# Dataset types available, by name. Each type is imported only when it is used.
+dataset_proto = LazyRegistry()
+dataset_proto.register("GenericImageAgeDataset", "main.dataset.generic_image_age_dataset")
+dataset_proto.register("GenericImageDataset", "main.dataset.generic_image_dataset")
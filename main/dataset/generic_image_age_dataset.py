@@ -1,18 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import json
 import os
 import random
-import caffe
-from caffe.io import array_to_datum
-from caffe.proto import caffe_pb2
-import cv2
-import lmdb
-import numpy as np
-from main.dataset.dataset import Dataset, mkdir_p, LMDB_BATCH_SIZE, dataset_proto
-from main.resource.image import Image
+from main.dataset.dataset import Dataset, mkdir_p, dataset_proto
 from main.tools.age_range import AgeRange
+from main.tools.metadata_journal import MetadataJournal
+from main.tools.metadata_loader import load_metadata_table
+from main.tools.metadata_table import MetadataTable
 import shutil
 
 __author__ = 'Iván de Paz Centeno'
@@ -51,6 +46,12 @@ class GenericImageAgeDataset(Dataset):
 
         Dataset.__init__(self, root_folder, metadata_file, description)
 
+        # Changes of the metadata are appended to a journal instead of rewriting the whole metadata file.
+        self.metadata_journal = MetadataJournal(self.metadata_file)
+
+        # Metadata is stored by columns: keys in a buffer and the code of their age range in an array.
+        self.metadata_content = MetadataTable(AgeRange.from_string, self._generate_dict_value_from_metadata)
+
         self.autoencoded_uris = {}
 
         self.dictionary_mean_to_label = {}
@@ -82,12 +83,11 @@ class GenericImageAgeDataset(Dataset):
         :param shuffle: shuffles the list before returning it.
         :return: list of keys for the find_route
         """
-        result = list(self.metadata_content.keys())
+        # The shuffle is a permutation of the rows of the metadata table, seeded from the random module so that
+        # random.seed() keeps it reproducible.
+        seed = random.getrandbits(32) if shuffle else None
 
-        if shuffle:
-            random.shuffle(result)
-            
-        return result
+        return self.metadata_content.get_keys(shuffle=shuffle, seed=seed)
 
     def get_key_metadata(self, key):
         """
@@ -103,6 +103,8 @@ class GenericImageAgeDataset(Dataset):
         Retrieves the image representing the specified key ID.
         :return:
         """
+        from main.resource.image import Image
+
         # For generic image age dataset, the key is the relative uri to the file.
         uri = self._get_key_absolute_uri(key)
         image = Image(image_id=key, uri=uri, metadata=[self.get_key_metadata(key)])
@@ -127,6 +129,7 @@ class GenericImageAgeDataset(Dataset):
         :param apply_normalizers: boolean flag to apply normalizers when the image is put into the dataset manually.
         :return:
         """
+        import cv2
 
         if autoencode_uri:
             uri = self._encode_uri_for_image(image)
@@ -173,6 +176,8 @@ class GenericImageAgeDataset(Dataset):
         :param apply_normalizers:
         :return:
         """
+        from main.resource.image import Image
+
         image = Image(uri=resource.get_uri(), metadata=resource.get_metadata())
         self.put_image(image, autoencode_uri=autoencode_uri, apply_normalizers=apply_normalizers)
 
@@ -183,17 +188,14 @@ class GenericImageAgeDataset(Dataset):
         """
         self.autoencoded_uris = {}
 
-        keys = self.get_keys()
-
-        for key in keys:
-
-            metadata = self.get_key_metadata(key)
-            age_range_hash = metadata.hash()
+        # Keys are counted by age range in the metadata table, so the hash is computed once for each age range.
+        for age_range, count in self.metadata_content.get_label_counts():
+            age_range_hash = age_range.hash()
 
             if age_range_hash not in self.autoencoded_uris:
-                self.autoencoded_uris[age_range_hash] = 1
+                self.autoencoded_uris[age_range_hash] = count
             else:
-                self.autoencoded_uris[age_range_hash] += 1
+                self.autoencoded_uris[age_range_hash] += count
 
     def _encode_uri_for_image(self, image):
         """
@@ -223,53 +225,31 @@ class GenericImageAgeDataset(Dataset):
         Loads the dataset from the specified root folder.
         """
 
-        # Let's load the routes list. This way we can reference them easily by the metadata_file content.
-        self._load_routes()
-        self._load_metadata_file()
-
-        if "".join(self.metadata_content) == "":
-            self.metadata_content = "{}"
+        # Routes are not loaded: the keys of the metadata are the relative uris of the images. They are read from the
+        # routes index the first time they are used.
+        self.routes = None
 
-        self.metadata_content = self._preprocess_metadata(self.metadata_content)
+        # The metadata file is streamed into a metadata table, which builds the AgeRange of each distinct label once.
+        self.metadata_content = load_metadata_table(self.metadata_file, AgeRange.from_string,
+                                                    self._generate_dict_value_from_metadata)
+        self.metadata_journal.replay(self.metadata_content, AgeRange.from_string)
         self._update_encoded_uris_cache()
 
-    @staticmethod
-    def _preprocess_metadata(raw_metadata):
-        """
-        Processes the metadata content in order to be framework-compliant (AgeRange classes for ages)
-        :param raw_metadata: raw metadata content to be processed.
-        :return: Metadata dict with {FileName:AgeRange} format.
-        """
-        metadata_content = json.loads("".join(raw_metadata))
-        preprocessed_metadata = {}
-
-        for key, value in metadata_content.items():
-            preprocessed_metadata[key] = AgeRange.from_string(value)
-
-        return preprocessed_metadata
-
-    @staticmethod
-    def _postprocess_metadata(preprocessed_metadata):
-        """
-        Processes the metadata to make a raw metadata again (in order to be dumped to a file for example).
-        :param preprocessed_metadata:
-        :return: raw metadata without objects, dumpable into string and/or file.
-        """
-        postprocessed_metadata = {}
-
-        for key, value in preprocessed_metadata.items():
-            postprocessed_metadata[key] = value.to_dict()["Age_range"]
-
-        return postprocessed_metadata
-
     def save_dataset(self):
         """
-        Dumps the metadata labels in JSON format inside the dataset's folder with name labels.json
+        Saves the metadata labels in JSON format inside the dataset's folder with name labels.json
+        Only the changes since the metadata was loaded are appended to its journal (labels.json.journal), which is
+        compacted into labels.json when it grows too much.
         :return:
         """
+        self.metadata_journal.save(self.metadata_content, self._generate_dict_value_from_metadata)
 
-        with open(self.metadata_file, 'w') as outfile:
-            json.dump(self._postprocess_metadata(self.metadata_content), outfile, indent=4)
+    def compact_metadata(self):
+        """
+        Compacts the journal of the metadata into labels.json, so that it contains the whole metadata.
+        :return: True if there was a journal to compact, False otherwise.
+        """
+        return self.metadata_journal.compact_file()
 
     def get_dataset_size(self):
         """
@@ -286,163 +266,100 @@ class GenericImageAgeDataset(Dataset):
 
         return dataset_size
 
-    def export_to_lmdb(self, lmdb_foldername, ages_as_means=True, map_size=-1, splitters=None, apply_normalizers=False):
+    def export_to_lmdb(self, lmdb_foldername, ages_as_means=True, map_size=-1, splitters=None, apply_normalizers=False,
+                       workers=1, seed=None, compact=False, encoding=None, resume=False, split_engine=None,
+                       max_consecutive=None, shards=1, compute_statistics=True, fast_write=False):
         """
         Exports the current dataset to LMDB format.
-        If the LMDB already exists, it will append to its content.
+        If the LMDB already exists and it is not empty, the export must be resumed (resume=True).
+        A manifest with the exported keys is written inside each LMDB, which allows to resume the export.
         :param lmdb_foldername: filename LMDB.
         :param ages_as_means: save the age_range in mean format.
-        :param map_size: size of map of the LMDB database. If set to -1, it will attempt to calculate a map_size that
-        fits this dataset. Remember however, that it won't allow to expand the LMDB database with new data and you'll
-        need to create a new one in case you want to.
+        :param map_size: initial size of map of the LMDB database. If set to -1, it is estimated from a sample of the
+        images of this dataset. The map is grown on demand when the LMDB gets full, so it also allows to expand the
+        LMDB database with new data.
         :param splitters: a set of splitters to split the dataset into multiple lmdbs. The lmdb divided by each splitter
         will be stored with the splitter's name prepended to the lmdb name. This is useful if you want to extract a
         chunk of the dataset as a test or validation lmdbs.
         :param apply_normalizers: boolean flag to apply normalizers when the image is put into the dataset manually.
-        """
+        :param workers: number of worker processes used to decode and normalize the images. The result is the same
+        regardless of the number of workers.
+        :param seed: seed for the shuffle and the splits. If set, the export is reproducible.
+        :param compact: boolean flag to compact each LMDB to its real size at the end of the export.
+        :param encoding: ImageEncoding to store the images compressed (JPEG, PNG) inside the datums. If None, the raw
+        pixels are stored.
+        :param resume: boolean flag to resume a previous export into the same LMDBs. Only the images that are not in
+        their manifests are exported, so it also allows to export incrementally the images added to the dataset.
+        :param split_engine: SplitEngine to split the dataset into multiple lmdbs with exact, deterministic
+        proportions. If set, it is used instead of the splitters.
+        :param max_consecutive: if set, the images of each LMDB are shuffled interleaving their labels, so that no more
+        than this number of consecutive images share the same label.
+        :param shards: number of LMDBs each split is written into, each one by its own process. Shards are named with
+        their index appended to the lmdb name (lmdb_train_00of08, ...).
+        :param compute_statistics: boolean flag to compute the mean image (lmdb_train_mean.binaryproto) and the mean
+        and standard deviation of each channel (lmdb_train_statistics.json) of each split while exporting.
+        :param fast_write: boolean flag to write the LMDBs without synchronous writes (writemap, map_async and no
+        sync). They are synced to disk once, when the export finishes.
+        """
+        from main.tools.lmdb_exporter import LMDBExporter
+
+        if seed is not None:
+            random.seed(seed)
+
         self.build_range_to_label_dictionary()
 
         print("SOFTMAX function labelling:\n")
         for label, age_range in self.dictionary_label_to_age_range.items():
             print("{}: {}".format(label, age_range.__str__()))
 
-        iteration = 0
-        txn_index = 0
-
         if splitters is None:
             splitters = []
 
         keys = self.get_keys(shuffle=True)
-        count = len(keys)
-        datum_id_format = "{}:0>{}{}_dbuild_{}".format("{", len(str(count)), "}", "{}")
-
-        if map_size == -1:
-            #map_size = self.get_dataset_size() + count * 30000
-            map_size = 1e12
-
-        print("Map size is {} MBytes".format(round(map_size/1000/1000, 2)))
-
-        if splitters:
-            environments = [lmdb.Environment(lmdb_foldername + "_" + splitter.get_name(), map_size=map_size) for splitter in splitters]
-        else:
-            environments = [lmdb.Environment(lmdb_foldername, map_size=map_size)]
-
-        txns = [env.begin(write=True, buffers=True) for env in environments]
-        txn = env = None
-
-        put_txns = {}
-
-        for txn in txns:
-            put_txns[txn] = 0
-
-        for key in keys:
-
-            iteration += 1
-            image = self.get_image(key)
-            image.load_from_uri()
-
-            if not image.is_loaded():
-                print("Image not valid. Omitted.")
-                continue
-
-
-            for split_id in range(len(splitters)):
-
-                splitter = splitters[split_id]
-
-                if splitter.decide(iteration):
-                    txn = txns[split_id]
-                    env = environments[split_id]
-                    txn_index = split_id
-                    break
-
-            if not txn or not env:
-                txn = txns[0]
-                env = environments[0]
-                txn_index = 0
-
-            age_range = image.get_metadata()[0]
-
-            #if ages_as_means:
-            #    label = age_range.get_mean()
-            #else:
-            #    label = age_range.get_range()[0]
-            age_mean = age_range.get_mean()
-
-            label = self.dictionary_mean_to_label[age_mean]
-
-            image_blob = image.get_blob()
-
-            if apply_normalizers:
-                for normalizer in self.normalizers:
-                    image_blob = normalizer.apply(image_blob)
-
-            #HxWxC to CxHxW in caffe
-            image_blob = np.transpose(image_blob, (2, 0, 1))
-
-            # Datum is the element map in LMDB. We associate image with label here.
-            datum = array_to_datum(image_blob, label)
-
-            # Now we encode the image id in ascii format inside the lmdb container that corresponds to this input.
-
-            txn.put(datum_id_format.format(iteration, image.get_id()).encode("ascii"), datum.SerializeToString())
-            put_txns[txn] += 1
 
-            # write batch
-            if put_txns[txn] % LMDB_BATCH_SIZE == 0:
-                txn.commit()
-                old_txn_count = put_txns[txn]
-                del put_txns[txn]
-                txn = env.begin(write=True)
-                txns[txn_index] = txn
-                put_txns[txn] = old_txn_count
-                print("[{}%] Stored batch of {} image in LMDB".format(round(iteration/count * 100, 2),
-                                                                      LMDB_BATCH_SIZE))
+        def get_label(key):
+            return self.dictionary_mean_to_label[self.get_key_metadata(key).get_mean()]
 
-        # There could be a last batch on each txn without being commited.
-        [txn.commit() or print("[{}%] Stored batch of {} image in LMDB".format(round(iteration/len(keys) * 100, 2),
-                               count % LMDB_BATCH_SIZE))
-         for txn, count in put_txns.items() if count % LMDB_BATCH_SIZE != 0]
+        exporter = LMDBExporter(self.normalizers, workers=workers, encoding=encoding)
+        label_translation = exporter.export(lmdb_foldername, keys, self._get_key_absolute_uri, get_label,
+                                            map_size=map_size, splitters=splitters,
+                                            apply_normalizers=apply_normalizers, compact=compact,
+                                            label_dictionary=self.dictionary_label_to_age_range, resume=resume,
+                                            split_engine=split_engine, max_consecutive=max_consecutive, shards=shards,
+                                            compute_statistics=compute_statistics, fast_write=fast_write)
 
-        [env.close() for env in environments]
+        # A resumed export keeps the labels of the previous one.
+        exported_labels = [(label_translation[label], age_range) for label, age_range in
+                           self.dictionary_label_to_age_range.items()]
+        self.dictionary_label_to_age_range = dict(sorted(exported_labels, key=lambda item: item[0]))
+        self.dictionary_mean_to_label = {age_range.get_mean(): label
+                                         for label, age_range in self.dictionary_label_to_age_range.items()}
 
         print("SOFTMAX function labelling:\n")
         for label, age_range in self.dictionary_label_to_age_range.items():
             print("{}: {}".format(label, age_range.__str__()))
 
-    def import_from_lmdb(self, lmdb_foldername):
+    def import_from_lmdb(self, lmdb_foldername, workers=1):
         """
         Imports the dataset from LMDB format into the root_folder.
-        :param lmdb_foldername: filename LMDB.
+        :param lmdb_foldername: filename LMDB, or a set of shards.
+        :param workers: number of processes used to import the images. Each one imports a range of the LMDB.
         """
+        from main.tools.lmdb_importer import LMDBImporter
 
-        lmdb_env = lmdb.open(lmdb_foldername)
-        lmdb_txn = lmdb_env.begin()
-        lmdb_cursor = lmdb_txn.cursor()
-
-        datum = caffe_pb2.Datum()
-
-        for key, value in lmdb_cursor:
-            key = str(key, encoding="UTF-8").split("_dbuild_", 1)[-1]
-
-            datum.ParseFromString(value)
+        importer = LMDBImporter(self.normalizers, workers=workers)
 
-            label = datum.label
-            data = caffe.io.datum_to_array(datum)
-
-            # CxHxW to HxWxC in cv2
-            image_blob = np.asarray(np.transpose(data, (1, 2, 0)), order='C')
-
-            image = Image(uri=key, image_id=key, metadata=[AgeRange(label, label)], blob_content=image_blob)
-            self.put_image(image, autoencode_uri=False)
-
-        lmdb_env.close()
+        # Metadata of all the images is collected at once, to be saved once by save_dataset().
+        self.metadata_content.update({key: AgeRange(label, label)
+                                      for key, label in importer.import_lmdb(lmdb_foldername, self.root_folder)})
 
     def export_to_zip(self, filename):
         """
         Exports the current dataset into ZIP format.
         :param filename: filename of the zip to store contents into.
         """
+        # The zip must contain the whole metadata in labels.json.
+        self.compact_metadata()
         shutil.make_archive(filename, 'zip', self.root_folder)
 
     def import_from_zip(self, filename):
@@ -451,9 +368,11 @@ class GenericImageAgeDataset(Dataset):
         :param filename: filename of the zip to store contents into.
         """
         self.load_dataset()
+
+        # The journal of the current metadata must not be replayed over the labels.json of the zip.
+        self.compact_metadata()
         shutil.unpack_archive(filename, self.root_folder, 'zip')
         previous_metadata_content = self.metadata_content
-        self.routes = []
         self.load_dataset()
 
         if not self.metadata_content:
@@ -484,20 +403,17 @@ class GenericImageAgeDataset(Dataset):
                 os.remove(absolute_uri)
                 os.remove(self.metadata_file)
 
-        self.metadata_content = {}
+        self.metadata_content.clear()
 
     def build_range_to_label_dictionary(self):
         """
         Builds the dictionary for translating the age range into a label.
         It will order the dictionary by age range mean.
         """
-        keys = self.get_keys(shuffle=True)
-
         age_ranges_table = {}
-        for key in keys:
-
-            age_range = self.get_key_metadata(key)
 
+        # The mean is computed once for each distinct age range of the metadata table.
+        for age_range, count in self.metadata_content.get_label_counts():
             age_ranges_table[age_range.get_mean()] = age_range
 
         # Now we order them and remove the duplications:
@@ -511,5 +427,8 @@ class GenericImageAgeDataset(Dataset):
             self.dictionary_label_to_age_range[iteration] = age_ranges_table[mean]
             iteration += 1
 
+    def _generate_dict_value_from_metadata(self, metadata):
+        return metadata.to_dict()["Age_range"]
+
 
 dataset_proto[GenericImageAgeDataset.__name__] = GenericImageAgeDataset
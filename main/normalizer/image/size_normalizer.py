@@ -24,6 +24,13 @@ class SizeNormalizer(Normalizer):
         blob = cv2.resize(blob, (self.width, self.height), interpolation = cv2.INTER_CUBIC)
         return blob
 
+    def tostring(self):
+        """
+        Serializes the size into a string of the format WIDTHxHEIGHT.
+        :return: string with the format WIDTHxHEIGHT.
+        """
+        return "{}x{}".format(self.width, self.height)
+
     @classmethod
     def fromstring(cls, size):
         """
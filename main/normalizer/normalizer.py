@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from main.tools.lazy_registry import LazyRegistry
 
 __author__ = 'Iván de Paz Centeno'
 
@@ -17,5 +18,15 @@ class Normalizer(object):
         """
         pass
 
+    def tostring(self):
+        """
+        Serializes the parameters of the normalizer into a string, as accepted by fromstring().
+        :return: string with the parameters of the normalizer.
+        """
+        return ""
+
 
-normalizer_proto = {}
\ No newline at end of file
+# Normalizers available, by the name of their option. Each normalizer is imported only when it is used.
+normalizer_proto = LazyRegistry()
+normalizer_proto.register("size", "main.normalizer.image.size_normalizer", "SizeNormalizer")
+normalizer_proto.register("equalize-histogram", "main.normalizer.image.histogram_normalizer", "HistogramNormalizer")
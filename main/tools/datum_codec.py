@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+__author__ = 'Iván de Paz Centeno'
+
+
+# Field numbers of caffe's Datum message (caffe.proto):
+#   optional int32 channels = 1; optional int32 height = 2; optional int32 width = 3; optional bytes data = 4;
+#   optional int32 label = 5; repeated float float_data = 6; optional bool encoded = 7;
+FIELD_CHANNELS = 1
+FIELD_HEIGHT = 2
+FIELD_WIDTH = 3
+FIELD_DATA = 4
+FIELD_LABEL = 5
+FIELD_FLOAT_DATA = 6
+FIELD_ENCODED = 7
+
+# Field numbers of caffe's BlobProto message, used for the mean files:
+#   optional int32 num = 1; optional int32 channels = 2; optional int32 height = 3; optional int32 width = 4;
+#   repeated float data = 5 [packed = true]; optional BlobShape shape = 7 (repeated int64 dim = 1 [packed = true]);
+BLOB_FIELD_NUM = 1
+BLOB_FIELD_CHANNELS = 2
+BLOB_FIELD_HEIGHT = 3
+BLOB_FIELD_WIDTH = 4
+BLOB_FIELD_DATA = 5
+BLOB_FIELD_SHAPE = 7
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+
+def _encode_varint(value):
+    """
+    Encodes an integer as a protobuf varint. Negative values are encoded as 64 bits two's complement, as protobuf
+    does with int32 fields.
+    :param value: integer to encode.
+    :return: bytes of the varint.
+    """
+    value &= 0xFFFFFFFFFFFFFFFF
+    result = bytearray()
+
+    while value > 0x7F:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    result.append(value)
+
+    return bytes(result)
+
+
+def _decode_varint(buffer, position):
+    """
+    Decodes a protobuf varint from a buffer.
+    :param buffer: buffer to read from.
+    :param position: position of the varint inside the buffer.
+    :return: tuple (value, position after the varint).
+    """
+    value = 0
+    shift = 0
+
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, position
+
+
+def _to_int32(value):
+    """
+    Truncates a decoded varint to a signed int32.
+    """
+    value &= 0xFFFFFFFF
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def _iterate_fields(serialized):
+    """
+    Iterates over the fields of a serialized protobuf message.
+    :param serialized: bytes of the message.
+    :return: generator of tuples (field number, wire type, value). The value is an integer for varints and a
+    memoryview of the content for the rest of wire types.
+    """
+    buffer = memoryview(serialized)
+    position = 0
+
+    while position < len(buffer):
+        tag, position = _decode_varint(buffer, position)
+        field_number, wire_type = tag >> 3, tag & 0x07
+
+        if wire_type == WIRE_VARINT:
+            value, position = _decode_varint(buffer, position)
+
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, position = _decode_varint(buffer, position)
+            value = buffer[position:position + length]
+            position += length
+
+        elif wire_type == WIRE_FIXED32:
+            value = buffer[position:position + 4]
+            position += 4
+
+        elif wire_type == WIRE_FIXED64:
+            value = buffer[position:position + 8]
+            position += 8
+
+        else:
+            raise Exception("Message is not correctly serialized: unknown wire type {}.".format(wire_type))
+
+        yield field_number, wire_type, value
+
+
+def _encode_tag(field_number, wire_type):
+    return _encode_varint((field_number << 3) | wire_type)
+
+
+def _encode_int32_field(field_number, value):
+    return _encode_tag(field_number, WIRE_VARINT) + _encode_varint(value)
+
+
+def _encode_float_data(float_data):
+    """
+    Encodes the float_data field, unpacked as protobuf does for proto2 repeated fields.
+    """
+    float_data = np.asarray(float_data, dtype="<f4").ravel()
+    fields = np.empty(len(float_data), dtype=[("tag", "u1"), ("value", "<f4")])
+    fields["tag"] = (FIELD_FLOAT_DATA << 3) | WIRE_FIXED32
+    fields["value"] = float_data
+
+    return fields.tobytes()
+
+
+class Datum(object):
+    """
+    Datum message of caffe, the element stored in caffe's LMDBs. It reads and writes the same wire format as
+    caffe.proto.caffe_pb2.Datum, with the same methods, but without requiring caffe nor protobuf.
+    """
+
+    def __init__(self, channels=0, height=0, width=0, data=b"", label=0, float_data=None, encoded=False):
+        self.channels = channels
+        self.height = height
+        self.width = width
+        self.data = data
+        self.label = label
+        self.float_data = [] if float_data is None else float_data
+        self.encoded = encoded
+
+    def SerializeToString(self):
+        """
+        Serializes the datum. Fields are written as caffe writes them: dimensions are only written for raw
+        datums, and encoded datums only contain their data, label and encoded flag.
+        :return: bytes of the serialized datum.
+        """
+        fields = []
+
+        if not self.encoded:
+            fields.append(_encode_int32_field(FIELD_CHANNELS, self.channels))
+            fields.append(_encode_int32_field(FIELD_HEIGHT, self.height))
+            fields.append(_encode_int32_field(FIELD_WIDTH, self.width))
+
+        if len(self.data) > 0 or len(self.float_data) == 0:
+            fields.append(_encode_tag(FIELD_DATA, WIRE_LENGTH_DELIMITED) + _encode_varint(len(self.data)))
+            fields.append(bytes(self.data))
+
+        fields.append(_encode_int32_field(FIELD_LABEL, self.label))
+
+        if len(self.float_data) > 0:
+            fields.append(_encode_float_data(self.float_data))
+
+        if self.encoded:
+            fields.append(_encode_int32_field(FIELD_ENCODED, 1))
+
+        return b"".join(fields)
+
+    def ParseFromString(self, serialized):
+        """
+        Parses a serialized datum into this datum, replacing its content.
+        :param serialized: bytes of the serialized datum.
+        """
+        self.__init__()
+        float_data = []
+
+        for field_number, wire_type, value in _iterate_fields(serialized):
+
+            if field_number == FIELD_CHANNELS:
+                self.channels = _to_int32(value)
+            elif field_number == FIELD_HEIGHT:
+                self.height = _to_int32(value)
+            elif field_number == FIELD_WIDTH:
+                self.width = _to_int32(value)
+            elif field_number == FIELD_LABEL:
+                self.label = _to_int32(value)
+            elif field_number == FIELD_ENCODED:
+                self.encoded = value != 0
+            elif field_number == FIELD_DATA:
+                self.data = bytes(value)
+            elif field_number == FIELD_FLOAT_DATA:
+                # Packed or unpacked, float_data is a sequence of little endian floats.
+                float_data.extend(np.frombuffer(value, dtype="<f4").tolist())
+
+        self.float_data = float_data
+
+
+class DatumView(object):
+    """
+    Datum parsed in place over its serialized bytes, as returned by a LMDB transaction opened with buffers=True.
+    The data of the image is not copied: the arrays returned are views over the serialized bytes. They are only
+    valid while the buffer is, that is, until the transaction ends; get a copy of them to keep them longer.
+    """
+
+    def __init__(self, serialized):
+        """
+        Parses the fields of the datum, without copying its data.
+        :param serialized: serialized datum, as bytes or as a buffer (memoryview) of the LMDB.
+        """
+        self.channels = 0
+        self.height = 0
+        self.width = 0
+        self.data = memoryview(b"")
+        self.label = 0
+        self.encoded = False
+        self.float_data = []            # memoryviews of the float_data fields (little endian floats).
+
+        for field_number, wire_type, value in _iterate_fields(serialized):
+
+            if field_number == FIELD_CHANNELS:
+                self.channels = _to_int32(value)
+            elif field_number == FIELD_HEIGHT:
+                self.height = _to_int32(value)
+            elif field_number == FIELD_WIDTH:
+                self.width = _to_int32(value)
+            elif field_number == FIELD_LABEL:
+                self.label = _to_int32(value)
+            elif field_number == FIELD_ENCODED:
+                self.encoded = value != 0
+            elif field_number == FIELD_DATA:
+                self.data = value
+            elif field_number == FIELD_FLOAT_DATA:
+                self.float_data.append(value)
+
+    def get_array(self, copy=False):
+        """
+        Retrieves the pixels of the datum in caffe's order.
+        :param copy: boolean flag to return an array that owns its data, so that it can be kept after the
+        transaction ends. Encoded images are always decoded into a new array.
+        :return: CxHxW array of the image. For raw datums it is a view of the serialized bytes, unless copy is set.
+        """
+        if self.encoded:
+            return datum_to_array(self)
+
+        shape = (self.channels, self.height, self.width)
+
+        if len(self.data) > 0:
+            array = np.frombuffer(self.data, dtype=np.uint8).reshape(shape)
+        elif len(self.float_data) == 1:
+            array = np.frombuffer(self.float_data[0], dtype="<f4").reshape(shape)
+        else:
+            array = np.concatenate([np.frombuffer(value, dtype="<f4") for value in self.float_data]).reshape(shape)
+
+        return array.copy() if copy else array
+
+    def get_blob(self, copy=False):
+        """
+        Retrieves the image of the datum in cv2's order.
+        :param copy: boolean flag to return a contiguous array that owns its data, so that it can be kept after the
+        transaction ends.
+        :return: HxWxC array of the image. For raw datums it is a transposed view of the serialized bytes (not
+        contiguous), unless copy is set.
+        """
+        if self.encoded:
+            from main.tools.image_encoding import ImageEncoding
+            return ImageEncoding.decode(self.data)
+
+        blob = np.transpose(self.get_array(), (1, 2, 0))
+
+        return np.ascontiguousarray(blob) if copy else blob
+
+    def to_datum(self):
+        """
+        Copies the datum into a Datum, independent of the serialized bytes.
+        :return: the datum.
+        """
+        float_data = []
+
+        for value in self.float_data:
+            float_data.extend(np.frombuffer(value, dtype="<f4").tolist())
+
+        return Datum(channels=self.channels, height=self.height, width=self.width, data=bytes(self.data),
+                     label=self.label, float_data=float_data, encoded=self.encoded)
+
+
+def parse_datum_label(serialized):
+    """
+    Reads only the label of a serialized datum. The rest of the fields are skipped without reading their content,
+    so the pixels of the image are never touched.
+    :param serialized: serialized datum, as bytes or as a buffer (memoryview) of the LMDB.
+    :return: the label of the datum.
+    """
+    position = 0
+    length = len(serialized)
+
+    while position < length:
+        tag, position = _decode_varint(serialized, position)
+        field_number, wire_type = tag >> 3, tag & 0x07
+
+        if wire_type == WIRE_VARINT:
+            value, position = _decode_varint(serialized, position)
+
+            if field_number == FIELD_LABEL:
+                return _to_int32(value)
+
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            field_length, position = _decode_varint(serialized, position)
+            position += field_length
+
+        elif wire_type == WIRE_FIXED32:
+            position += 4
+
+        elif wire_type == WIRE_FIXED64:
+            position += 8
+
+        else:
+            raise Exception("Datum is not correctly serialized: unknown wire type {}.".format(wire_type))
+
+    return 0
+
+
+def serialize_blob(blob, label):
+    """
+    Serializes the raw pixels of an image blob into a datum. The pixels are reordered from HxWxC to CxHxW directly
+    into the serialized buffer, so they are copied only once.
+    :param blob: HxWxC blob of the image.
+    :param label: label of the datum.
+    :return: bytearray with the serialized datum.
+    """
+    if blob.ndim == 2:
+        blob = blob[:, :, np.newaxis]
+
+    if blob.dtype != np.uint8:
+        return blob_to_datum(blob, label).SerializeToString()
+
+    height, width, channels = blob.shape
+    size = blob.size
+
+    header = b"".join([_encode_int32_field(FIELD_CHANNELS, channels), _encode_int32_field(FIELD_HEIGHT, height),
+                       _encode_int32_field(FIELD_WIDTH, width),
+                       _encode_tag(FIELD_DATA, WIRE_LENGTH_DELIMITED), _encode_varint(size)])
+    footer = _encode_int32_field(FIELD_LABEL, label)
+
+    serialized = bytearray(len(header) + size + len(footer))
+    serialized[:len(header)] = header
+    serialized[len(header) + size:] = footer
+
+    #HxWxC to CxHxW in caffe
+    pixels = np.frombuffer(serialized, dtype=np.uint8, count=size, offset=len(header))
+    pixels.reshape((channels, height, width))[...] = np.transpose(blob, (2, 0, 1))
+
+    return serialized
+
+
+def serialize_encoded(encoded_image, label):
+    """
+    Serializes an encoded image (JPEG, PNG, ...) into a datum, as caffe's convert_imageset does with --encoded.
+    :param encoded_image: bytes of the encoded image.
+    :param label: label of the datum.
+    :return: bytes with the serialized datum.
+    """
+    return encoded_to_datum(encoded_image, label).SerializeToString()
+
+
+def blob_to_datum(blob, label):
+    """
+    Builds a datum with the raw pixels of an image blob. Non uint8 blobs are stored as float data.
+    :param blob: HxWxC blob of the image.
+    :param label: label of the datum.
+    :return: datum.
+    """
+    if blob.ndim == 2:
+        blob = blob[:, :, np.newaxis]
+
+    height, width, channels = blob.shape
+
+    #HxWxC to CxHxW in caffe
+    data = np.transpose(blob, (2, 0, 1))
+
+    if blob.dtype == np.uint8:
+        return Datum(channels, height, width, data=data.tobytes(), label=label)
+
+    return Datum(channels, height, width, label=label, float_data=data.astype(np.float32).ravel())
+
+
+def encoded_to_datum(encoded_image, label):
+    """
+    Builds a datum with an encoded image (JPEG, PNG, ...).
+    :param encoded_image: bytes of the encoded image.
+    :param label: label of the datum.
+    :return: datum.
+    """
+    return Datum(data=encoded_image, label=label, encoded=True)
+
+
+def datum_to_array(datum):
+    """
+    Retrieves the pixels stored in a datum, either raw or encoded, in caffe's order.
+    :param datum: datum to read (Datum or DatumView).
+    :return: CxHxW array of the image. For raw datums it is a view of the data of the datum.
+    """
+    if datum.encoded:
+        # cv2 is only imported to decode images, so that datums can be parsed without it.
+        from main.tools.image_encoding import ImageEncoding
+        blob = ImageEncoding.decode(datum.data)
+
+        if blob.ndim == 2:
+            blob = blob[:, :, np.newaxis]
+
+        #HxWxC to CxHxW in caffe
+        return np.transpose(blob, (2, 0, 1))
+
+    if isinstance(datum, DatumView):
+        return datum.get_array()
+
+    shape = (datum.channels, datum.height, datum.width)
+
+    if len(datum.data) > 0:
+        return np.frombuffer(datum.data, dtype=np.uint8).reshape(shape)
+
+    return np.asarray(datum.float_data, dtype=np.float32).reshape(shape)
+
+
+def datum_to_blob(datum):
+    """
+    Retrieves the image blob stored in a datum, either raw or encoded.
+    :param datum: datum to read.
+    :return: HxWxC blob of the image.
+    """
+    if datum.encoded:
+        from main.tools.image_encoding import ImageEncoding
+        return ImageEncoding.decode(datum.data)
+
+    # CxHxW to HxWxC in cv2
+    return np.ascontiguousarray(np.transpose(datum_to_array(datum), (1, 2, 0)))
+
+
+def array_to_blobproto(array):
+    """
+    Serializes an array into caffe's BlobProto format, as the mean files written by caffe's compute_image_mean.
+    :param array: CxHxW array.
+    :return: bytes of the serialized blob.
+    """
+    channels, height, width = array.shape
+    data = np.asarray(array, dtype="<f4").tobytes()
+
+    return b"".join([_encode_int32_field(BLOB_FIELD_NUM, 1), _encode_int32_field(BLOB_FIELD_CHANNELS, channels),
+                     _encode_int32_field(BLOB_FIELD_HEIGHT, height), _encode_int32_field(BLOB_FIELD_WIDTH, width),
+                     _encode_tag(BLOB_FIELD_DATA, WIRE_LENGTH_DELIMITED), _encode_varint(len(data)), data])
+
+
+def blobproto_to_array(serialized):
+    """
+    Parses an array serialized in caffe's BlobProto format, like a mean file.
+    :param serialized: bytes of the serialized blob.
+    :return: CxHxW float32 array.
+    """
+    dimensions = {}
+    shape = []
+    data = []
+
+    for field_number, wire_type, value in _iterate_fields(serialized):
+
+        if field_number in [BLOB_FIELD_NUM, BLOB_FIELD_CHANNELS, BLOB_FIELD_HEIGHT, BLOB_FIELD_WIDTH]:
+            dimensions[field_number] = _to_int32(value)
+
+        elif field_number == BLOB_FIELD_DATA:
+            data.append(np.frombuffer(value, dtype="<f4"))
+
+        elif field_number == BLOB_FIELD_SHAPE:
+            for dimension_field, dimension_wire_type, dimension in _iterate_fields(value):
+                if dimension_wire_type == WIRE_LENGTH_DELIMITED:
+                    position = 0
+
+                    while position < len(dimension):
+                        size, position = _decode_varint(dimension, position)
+                        shape.append(size)
+                else:
+                    shape.append(dimension)
+
+    if not shape:
+        shape = [dimensions.get(field_number, 1) for field_number in [BLOB_FIELD_NUM, BLOB_FIELD_CHANNELS,
+                                                                      BLOB_FIELD_HEIGHT, BLOB_FIELD_WIDTH]]
+
+    # The mean is a single image: the num dimension is dropped.
+    return np.concatenate(data).astype(np.float32).reshape(shape[-3:])
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+import multiprocessing
+import numpy as np
+from main.resource.image import Image
+from main.tools.datum_codec import Datum, DatumView, datum_to_blob, serialize_blob, serialize_encoded
+from main.tools.image_encoding import ImageEncoding
+from main.tools.image_statistics import get_image_aggregates
+
+__author__ = 'Iván de Paz Centeno'
+
+
+# Normalizers, encoding and statistics flag of the current worker process. They are set once per process by the pool
+# initializer, so that they are not pickled again for each image.
+_worker_normalizers = []
+_worker_encoding = None
+_worker_statistics = False
+
+
+def _initialize_worker(normalizers, encoding, compute_statistics=False):
+    """
+    Initializes a worker process of the pipeline.
+    :param normalizers: list of normalizers to apply to each image in this process.
+    :param encoding: ImageEncoding to store the images with, or None to store raw pixels.
+    :param compute_statistics: boolean flag to compute the aggregates of each image for its statistics.
+    """
+    global _worker_normalizers, _worker_encoding, _worker_statistics
+    _worker_normalizers = normalizers
+    _worker_encoding = encoding
+    _worker_statistics = compute_statistics
+
+
+def _get_blob_aggregates(image_blob):
+    """
+    :param image_blob: HxWxC (or HxW) blob of the image.
+    :return: the aggregates of the image for its statistics, as get_image_aggregates() computes them.
+    """
+    if image_blob.ndim == 2:
+        image_blob = image_blob[:, :, np.newaxis]
+
+    # HxWxC to CxHxW in caffe
+    return get_image_aggregates(np.transpose(image_blob, (2, 0, 1)))
+
+
+def _build_encoded_datum(uri, label, normalizers, encoding, compute_statistics):
+    """
+    Builds a serialized datum with the image encoded. If the file is already in the format of the encoding, there are
+    no normalizers to apply and no quality was requested, its bytes are stored as they are, without decoding the image
+    (unless its statistics are computed).
+    :return: tuple (serialized datum, aggregates of the image or None). The serialized datum is None if the image
+    could not be loaded.
+    """
+    try:
+        with open(uri, "rb") as image_file:
+            file_bytes = image_file.read()
+
+    except OSError:
+        return None, None
+
+    # A requested quality requires encoding the image again, even if it is already in the format of the encoding.
+    if not normalizers and encoding.quality is None and encoding.matches(file_bytes):
+        serialized_datum = serialize_encoded(file_bytes, label)
+        if not compute_statistics:
+            return serialized_datum, None
+
+        return serialized_datum, get_image_aggregates(DatumView(serialized_datum).get_array())
+
+    image_blob = ImageEncoding.decode(file_bytes)
+
+    if image_blob is None:
+        return None, None
+
+    for normalizer in normalizers:
+        image_blob = normalizer.apply(image_blob)
+
+    # Statistics are computed from the pixels before they are encoded.
+    aggregates = _get_blob_aggregates(image_blob) if compute_statistics else None
+
+    return serialize_encoded(encoding.encode(image_blob), label), aggregates
+
+
+def build_datum(task, normalizers=None, encoding=None, compute_statistics=None):
+    """
+    Loads, normalizes and serializes an image into a Datum.
+    :param task: tuple (uri, label, apply_normalizers) describing the image to process.
+    :param normalizers: list of normalizers to apply. If None, the normalizers of the worker process are used.
+    :param encoding: ImageEncoding to store the image with. If None, the encoding of the worker process is used.
+    :param compute_statistics: boolean flag to compute the aggregates of the image for its statistics. If None, the
+    flag of the worker process is used.
+    :return: tuple (serialized datum, aggregates of the image or None). The serialized datum is None if the image
+    could not be loaded.
+    """
+    uri, label, apply_normalizers = task
+
+    if normalizers is None:
+        normalizers = _worker_normalizers
+        encoding = _worker_encoding
+
+    if compute_statistics is None:
+        compute_statistics = _worker_statistics
+
+    if not apply_normalizers:
+        normalizers = []
+
+    if encoding is not None:
+        return _build_encoded_datum(uri, label, normalizers, encoding, compute_statistics)
+
+    image = Image(uri=uri)
+    image.load_from_uri()
+
+    if not image.is_loaded():
+        return None, None
+
+    image_blob = image.get_blob()
+
+    for normalizer in normalizers:
+        image_blob = normalizer.apply(image_blob)
+
+    aggregates = _get_blob_aggregates(image_blob) if compute_statistics else None
+
+    # Datum is the element map in LMDB. We associate image with label here.
+    return serialize_blob(image_blob, label), aggregates
+
+
+def transform_datum(task, normalizers=None, encoding=None, compute_statistics=None):
+    """
+    Normalizes a datum already serialized, as read from another LMDB. Without normalizers, its bytes are kept as they
+    are. Encoded images are encoded again in the format they had.
+    :param task: tuple (serialized datum, label, apply_normalizers) describing the datum to process.
+    :param normalizers: list of normalizers to apply. If None, the normalizers of the worker process are used.
+    :param encoding: not used: the encoding of the datum is kept.
+    :param compute_statistics: boolean flag to compute the aggregates of the image for its statistics. If None, the
+    flag of the worker process is used.
+    :return: tuple (serialized datum, aggregates of the image or None). The serialized datum is None if its image
+    could not be decoded or it is encoded in a format that can't be encoded again (neither JPEG nor PNG).
+    """
+    serialized_datum, label, apply_normalizers = task
+
+    if normalizers is None:
+        normalizers = _worker_normalizers
+
+    if compute_statistics is None:
+        compute_statistics = _worker_statistics
+
+    if not apply_normalizers or not normalizers:
+        if not compute_statistics:
+            return serialized_datum, None
+
+        return serialized_datum, get_image_aggregates(DatumView(serialized_datum).get_array())
+
+    datum = Datum()
+    datum.ParseFromString(serialized_datum)
+    encoding = ImageEncoding.detect(datum.data) if datum.encoded else None
+
+    if datum.encoded and encoding is None:
+        return None, None
+
+    image_blob = datum_to_blob(datum)
+
+    if image_blob is None:
+        return None, None
+
+    for normalizer in normalizers:
+        image_blob = normalizer.apply(image_blob)
+
+    aggregates = _get_blob_aggregates(image_blob) if compute_statistics else None
+
+    if encoding is not None:
+        return serialize_encoded(encoding.encode(image_blob), label), aggregates
+
+    return serialize_blob(image_blob, label), aggregates
+
+
+class DatumPipeline(object):
+    """
+    Decodes, normalizes and serializes images into Datums, optionally in a pool of worker processes.
+    Results are always retrieved in the same order as the tasks were given, so the output does not depend on the
+    number of workers.
+    """
+
+    def __init__(self, normalizers=None, workers=1, queue_depth=None, encoding=None, datum_builder=build_datum):
+        """
+        Initialization of the pipeline.
+        :param normalizers: list of normalizers to apply to the images.
+        :param workers: number of worker processes. If 1, images are processed in the current process.
+        :param queue_depth: maximum number of images being processed or waiting to be retrieved at the same time.
+        This bounds the memory used by the pipeline. By default it is 4 times the number of workers.
+        :param encoding: ImageEncoding to store the images with. If None, raw pixels are stored.
+        :param datum_builder: module-level function that processes each task into a serialized datum and the
+        aggregates of its image, as build_datum() or transform_datum().
+        """
+        if normalizers is None:
+            normalizers = []
+
+        if queue_depth is None:
+            queue_depth = max(1, int(workers)) * 4
+
+        self.normalizers = normalizers
+        self.workers = max(1, int(workers))
+        self.queue_depth = max(1, int(queue_depth))
+        self.encoding = encoding
+        self.datum_builder = datum_builder
+
+    def imap(self, tasks, compute_statistics=False):
+        """
+        Processes the tasks and yields the serialized datums in the same order.
+        :param tasks: iterable of tasks for the datum builder. For build_datum(), tuples (uri, label,
+        apply_normalizers).
+        :param compute_statistics: boolean flag to compute the aggregates of each image for its statistics
+        (see ImageStatistics.add_aggregates()) in the workers, while its pixels are in memory.
+        :return: generator of tuples (serialized datum, aggregates of the image or None). The serialized datum is
+        None for images that couldn't be loaded.
+        """
+        if self.workers == 1:
+            for task in tasks:
+                yield self.datum_builder(task, self.normalizers, self.encoding, compute_statistics)
+
+            return
+
+        pool = multiprocessing.Pool(self.workers, initializer=_initialize_worker,
+                                    initargs=(self.normalizers, self.encoding, compute_statistics))
+
+        try:
+            pending = deque()
+
+            for task in tasks:
+                pending.append(pool.apply_async(self.datum_builder, (task,)))
+
+                if len(pending) >= self.queue_depth:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+
+            pool.close()
+
+        finally:
+            pool.terminate()
+            pool.join()
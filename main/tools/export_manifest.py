@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import lmdb
+
+__author__ = 'Iván de Paz Centeno'
+
+
+MANIFEST_FILENAME = "manifest.json"             # Description of the export, rewritten on each checkpoint.
+MANIFEST_KEYS_FILENAME = "manifest.keys"        # Keys of the dataset exported into the LMDB, one per line.
+
+
+def split_datum_key(lmdb_key):
+    """
+    Splits a key of an exported LMDB into its index and the key of the dataset.
+    :param lmdb_key: key of the LMDB, as bytes or string. Format: <zero-padded index>_dbuild_<dataset key>
+    :return: tuple (index, dataset key).
+    """
+    if not isinstance(lmdb_key, str):
+        lmdb_key = str(bytes(lmdb_key), encoding="UTF-8")
+
+    index, key = lmdb_key.split("_dbuild_", 1)
+
+    return int(index), key
+
+
+class ExportManifest(object):
+    """
+    Keeps track of what has been exported into a LMDB: the keys of the dataset stored in it and a description of
+    the export (split, label dictionary, normalizers, ...). It is stored inside the LMDB folder and it is updated each
+    time a batch is committed, so that an export can be resumed or extended with new images.
+    """
+
+    def __init__(self, lmdb_foldername):
+        """
+        Initialization of the manifest.
+        :param lmdb_foldername: filename LMDB the manifest belongs to.
+        """
+        self.lmdb_foldername = lmdb_foldername
+        self.description = {}
+        self.keys = set()
+
+    def _get_filename(self, filename):
+        return os.path.join(self.lmdb_foldername, filename)
+
+    def exists(self):
+        """
+        Checks if the manifest exists for the LMDB.
+        :return: True if it exists, False otherwise.
+        """
+        return os.path.exists(self._get_filename(MANIFEST_FILENAME))
+
+    def load(self):
+        """
+        Loads the manifest of the LMDB. The keys are checked against the LMDB content: if the LMDB contains entries
+        that are not in the manifest (the export was interrupted right after a commit), they are read from the LMDB.
+        """
+        self.description = {}
+        self.keys = set()
+
+        if self.exists():
+            with open(self._get_filename(MANIFEST_FILENAME)) as manifest_file:
+                self.description = json.load(manifest_file)
+
+        if os.path.exists(self._get_filename(MANIFEST_KEYS_FILENAME)):
+            with open(self._get_filename(MANIFEST_KEYS_FILENAME), encoding="UTF-8") as keys_file:
+                self.keys = set(line.rstrip("\n") for line in keys_file if line != "\n")
+
+        if os.path.exists(self._get_filename("data.mdb")):
+            self._synchronize_with_lmdb()
+
+    def _synchronize_with_lmdb(self):
+        """
+        Makes the keys and the next index of the manifest match the content of the LMDB.
+        """
+        lmdb_env = lmdb.open(self.lmdb_foldername, readonly=True, lock=False)
+
+        with lmdb_env.begin() as lmdb_txn:
+            entries = lmdb_env.stat()['entries']
+            lmdb_cursor = lmdb_txn.cursor()
+
+            if entries != len(self.keys):
+                self.keys = set(split_datum_key(key)[1] for key in lmdb_cursor.iternext(keys=True, values=False))
+                self._rewrite_keys()
+
+            if lmdb_cursor.last():
+                last_index = split_datum_key(lmdb_cursor.key())[0]
+                self.description['next_index'] = max(self.description.get('next_index', 0), last_index + 1)
+
+        lmdb_env.close()
+
+    def _rewrite_keys(self):
+        """
+        Rewrites the file with the keys of the manifest.
+        """
+        filename = self._get_filename(MANIFEST_KEYS_FILENAME)
+
+        with open(filename + ".tmp", "w", encoding="UTF-8") as keys_file:
+            keys_file.writelines(["{}\n".format(key) for key in self.keys])
+
+        os.replace(filename + ".tmp", filename)
+
+    def reset(self, description):
+        """
+        Starts a new manifest for the LMDB, discarding the previous one.
+        :param description: dict describing the export.
+        """
+        self.description = dict(description)
+        self.keys = set()
+
+        if os.path.exists(self._get_filename(MANIFEST_KEYS_FILENAME)):
+            os.remove(self._get_filename(MANIFEST_KEYS_FILENAME))
+
+    def get_description(self):
+        """
+        Getter for the description of the export.
+        :return:
+        """
+        return self.description
+
+    def get_keys(self):
+        """
+        Getter for the keys of the dataset exported into the LMDB.
+        :return: set of keys.
+        """
+        return self.keys
+
+    def checkpoint(self, keys, next_index):
+        """
+        Records the keys of a batch that has been committed into the LMDB.
+        :param keys: keys of the dataset committed.
+        :param next_index: next index to use for a new entry of the LMDB.
+        """
+        os.makedirs(self.lmdb_foldername, exist_ok=True)
+
+        with open(self._get_filename(MANIFEST_KEYS_FILENAME), "a", encoding="UTF-8") as keys_file:
+            keys_file.writelines(["{}\n".format(key) for key in keys])
+            keys_file.flush()
+            os.fsync(keys_file.fileno())
+
+        self.keys.update(keys)
+        self.description['next_index'] = next_index
+        self.description['entries'] = len(self.keys)
+        self.save()
+
+    def save(self):
+        """
+        Writes the description of the export into the LMDB folder. The file is replaced atomically.
+        """
+        os.makedirs(self.lmdb_foldername, exist_ok=True)
+        filename = self._get_filename(MANIFEST_FILENAME)
+
+        with open(filename + ".tmp", "w") as manifest_file:
+            json.dump(self.description, manifest_file, indent=4)
+
+        os.replace(filename + ".tmp", filename)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import cv2
+import numpy as np
+
+__author__ = 'Iván de Paz Centeno'
+
+
+# For each format: extension for cv2, encoding parameter for the quality and magic bytes of the files in that format.
+ENCODING_FORMATS = {
+    "jpg": (".jpg", cv2.IMWRITE_JPEG_QUALITY, b"\xff\xd8\xff"),
+    "png": (".png", cv2.IMWRITE_PNG_COMPRESSION, b"\x89PNG\r\n\x1a\n"),
+}
+
+
+class ImageEncoding(object):
+    """
+    Compressed format (JPEG or PNG) used to store images in datums.
+    """
+
+    def __init__(self, image_format="jpg", quality=None):
+        """
+        Constructor for the image encoding.
+        :param image_format: format of the encoding, "jpg" or "png".
+        :param quality: quality of the encoding (0-100 for jpg, compression level 0-9 for png). If None, the default
+        of OpenCV is used.
+        """
+        image_format = image_format.lower().replace(".", "")
+
+        if image_format == "jpeg":
+            image_format = "jpg"
+
+        if image_format not in ENCODING_FORMATS:
+            raise Exception("Encoding format \"{}\" is not valid! It must be one of {}".format(
+                image_format, ", ".join(ENCODING_FORMATS)))
+
+        self.image_format = image_format
+        self.quality = None if quality is None else int(quality)
+
+    def get_format(self):
+        """
+        Getter for the format of the encoding.
+        :return:
+        """
+        return self.image_format
+
+    def encode(self, blob):
+        """
+        Encodes the image blob into the format of this encoding.
+        :param blob: HxWxC blob of the image.
+        :return: bytes of the encoded image.
+        """
+        extension, quality_flag, _ = ENCODING_FORMATS[self.image_format]
+
+        params = [] if self.quality is None else [int(quality_flag), self.quality]
+        result, encoded_image = cv2.imencode(extension, blob, params)
+
+        if not result:
+            raise Exception("Image could not be encoded in {} format.".format(self.image_format))
+
+        return encoded_image.tobytes()
+
+    def matches(self, file_bytes):
+        """
+        Checks if the bytes of a file are already an image in the format of this encoding.
+        :param file_bytes: content of the file.
+        :return: True if the file is in the format of this encoding, False otherwise.
+        """
+        return file_bytes.startswith(ENCODING_FORMATS[self.image_format][2])
+
+    @classmethod
+    def detect(cls, file_bytes):
+        """
+        Finds the encoding of the bytes of a file.
+        :param file_bytes: content of the file.
+        :return: the encoding of the file, or None if it isn't an image in any of the formats.
+        """
+        for image_format, (extension, quality_flag, magic_bytes) in ENCODING_FORMATS.items():
+            if bytes(file_bytes[:len(magic_bytes)]) == magic_bytes:
+                return cls(image_format)
+
+        return None
+
+    def matches_extension(self, uri):
+        """
+        Checks if the extension of a file corresponds to the format of this encoding.
+        :param uri: uri of the file.
+        :return: True if the file should contain an image in the format of this encoding, False otherwise.
+        """
+        extension = os.path.splitext(uri)[1].lower()
+
+        if extension == ".jpeg":
+            extension = ".jpg"
+
+        return extension == ENCODING_FORMATS[self.image_format][0]
+
+    @staticmethod
+    def decode(file_bytes):
+        """
+        Decodes the bytes of an encoded image into a HxWxC blob.
+        :param file_bytes: content of the encoded image.
+        :return: blob of the image, or None if it couldn't be decoded.
+        """
+        return cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def __str__(self):
+        """
+        :return: string representation of the encoding, as accepted by fromstring().
+        """
+        if self.quality is None:
+            return self.image_format
+
+        return "{}:{}".format(self.image_format, self.quality)
+
+    @classmethod
+    def fromstring(cls, text):
+        """
+        Creates the instance from a string of the format FORMAT[:QUALITY].
+        :param text: string with the format FORMAT[:QUALITY]. Example: jpg:90
+        :return: instance of the class
+        """
+        components = text.split(":")
+
+        if len(components) > 2:
+            raise Exception("Format of encoding \"{}\" is not valid! It must be FORMAT[:QUALITY]. "
+                            "Example: jpg:90".format(text))
+
+        return cls(*components)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy as np
+from main.tools.datum_codec import array_to_blobproto, blobproto_to_array
+from main.tools.lmdb_reader import LMDBReader
+
+__author__ = 'Iván de Paz Centeno'
+
+
+MEAN_FILENAME_SUFFIX = "_mean.binaryproto"          # Mean image of a LMDB: <lmdb>_mean.binaryproto
+STATISTICS_FILENAME_SUFFIX = "_statistics.json"     # Summary of the statistics of a LMDB: <lmdb>_statistics.json
+
+
+def get_image_aggregates(pixels):
+    """
+    Computes the aggregates of an image that ImageStatistics accumulates. Their cost is in this function, so the
+    pipeline workers compute them while they have the pixels, and the process that accumulates them only merges them.
+    :param pixels: CxHxW array of the image.
+    :return: tuple (pixels, pixels of each channel, mean of each channel, m2 of each channel), being m2 the sum of the
+    squared differences to the mean.
+    """
+    channels = pixels.shape[0]
+
+    # Per channel mean and variance of the image, to be merged with the accumulated ones (Chan et al.).
+    flat_pixels = pixels.reshape(channels, -1).astype(np.float64)
+    image_mean = flat_pixels.mean(axis=1)
+    image_m2 = np.square(flat_pixels - image_mean[:, np.newaxis]).sum(axis=1)
+
+    return pixels, flat_pixels.shape[1], image_mean, image_m2
+
+
+class ImageStatistics(object):
+    """
+    Accumulates the mean image and the per-channel mean and standard deviation of a set of images, one image at a
+    time, as caffe's compute_image_mean does over a finished LMDB.
+    Images are CxHxW arrays, in the order of the channels stored in the LMDB. The mean image is only computed if all
+    the images have the same size.
+    """
+
+    def __init__(self):
+        self.images = 0
+        self.shape = None
+        self.pixel_sum = None           # float64 accumulator of each pixel, for the mean image.
+
+        self.channel_pixels = 0         # Pixels accumulated for each channel.
+        self.channel_mean = None
+        self.channel_m2 = None          # Sum of squared differences to the mean of each channel.
+
+    def add(self, pixels):
+        """
+        Accumulates an image.
+        :param pixels: CxHxW array of the image.
+        """
+        self.add_aggregates(get_image_aggregates(pixels))
+
+    def add_aggregates(self, aggregates):
+        """
+        Accumulates an image from its aggregates, computed by get_image_aggregates(), so that the work on its pixels
+        can be done by other processes.
+        :param aggregates: tuple (pixels, pixels of each channel, mean of each channel, m2 of each channel).
+        """
+        pixels, image_pixels, image_mean, image_m2 = aggregates
+        channels = pixels.shape[0]
+
+        if self.images == 0:
+            self.shape = pixels.shape
+            self.pixel_sum = np.zeros(pixels.shape, dtype=np.float64)
+            self.channel_mean = np.zeros(channels, dtype=np.float64)
+            self.channel_m2 = np.zeros(channels, dtype=np.float64)
+
+        elif pixels.shape[0] != self.shape[0]:
+            raise Exception("Images with different number of channels can't be accumulated together.")
+
+        elif self.pixel_sum is not None and pixels.shape != self.shape:
+            print("Warning: images have different sizes. The mean image won't be computed.")
+            self.pixel_sum = None
+
+        if self.pixel_sum is not None:
+            self.pixel_sum += pixels
+
+        self._merge_channels(image_pixels, image_mean, image_m2)
+        self.images += 1
+
+    def _merge_channels(self, pixels, mean, m2):
+        total_pixels = self.channel_pixels + pixels
+        delta = mean - self.channel_mean
+
+        self.channel_mean += delta * pixels / total_pixels
+        self.channel_m2 += m2 + np.square(delta) * self.channel_pixels * pixels / total_pixels
+        self.channel_pixels = total_pixels
+
+    def add_lmdb(self, lmdb_foldername):
+        """
+        Accumulates all the images stored in a LMDB.
+        :param lmdb_foldername: filename LMDB.
+        """
+        # The pixels are accumulated straight from the memory of the LMDB.
+        with LMDBReader(lmdb_foldername) as reader:
+            for key, datum in reader.iterate():
+                self.add(datum.get_array())
+
+    def get_images(self):
+        """
+        Getter for the number of images accumulated.
+        :return:
+        """
+        return self.images
+
+    def get_mean_image(self):
+        """
+        :return: CxHxW float32 mean image, or None if it can't be computed.
+        """
+        if self.pixel_sum is None:
+            return None
+
+        return (self.pixel_sum / self.images).astype(np.float32)
+
+    def get_channel_mean(self):
+        """
+        :return: list with the mean of each channel.
+        """
+        return [] if self.channel_mean is None else self.channel_mean.tolist()
+
+    def get_channel_std(self):
+        """
+        :return: list with the standard deviation of each channel.
+        """
+        return [] if self.channel_m2 is None else np.sqrt(self.channel_m2 / self.channel_pixels).tolist()
+
+    def save(self, lmdb_foldername):
+        """
+        Writes the mean image (<lmdb_foldername>_mean.binaryproto) and a summary of the statistics
+        (<lmdb_foldername>_statistics.json) next to the LMDB.
+        :param lmdb_foldername: filename LMDB the statistics belong to.
+        """
+        mean_image = self.get_mean_image()
+        mean_filename = lmdb_foldername + MEAN_FILENAME_SUFFIX
+
+        if mean_image is not None:
+            with open(mean_filename, "wb") as mean_file:
+                mean_file.write(array_to_blobproto(mean_image))
+
+        elif os.path.exists(mean_filename):
+            os.remove(mean_filename)
+
+        summary = {
+            "images": self.images,
+            "channels": None if self.shape is None else self.shape[0],
+            "shape": None if mean_image is None else list(mean_image.shape),
+            "mean_image": None if mean_image is None else os.path.basename(mean_filename),
+            "channel_mean": self.get_channel_mean(),
+            "channel_std": self.get_channel_std(),
+            "channel_pixels": self.channel_pixels,
+            "channel_m2": [] if self.channel_m2 is None else self.channel_m2.tolist(),
+        }
+
+        with open(lmdb_foldername + STATISTICS_FILENAME_SUFFIX, "w") as summary_file:
+            json.dump(summary, summary_file, indent=4)
+
+    @classmethod
+    def load(cls, lmdb_foldername):
+        """
+        Loads the statistics saved next to a LMDB, so that more images can be accumulated to them.
+        :param lmdb_foldername: filename LMDB the statistics belong to.
+        :return: the statistics, or None if they don't exist.
+        """
+        summary_filename = lmdb_foldername + STATISTICS_FILENAME_SUFFIX
+
+        if not os.path.exists(summary_filename):
+            return None
+
+        with open(summary_filename) as summary_file:
+            summary = json.load(summary_file)
+
+        statistics = cls()
+
+        if not summary["images"]:
+            return statistics
+
+        statistics.images = summary["images"]
+        statistics.shape = (summary["channels"],) if summary["shape"] is None else tuple(summary["shape"])
+        statistics.channel_pixels = summary["channel_pixels"]
+        statistics.channel_mean = np.array(summary["channel_mean"], dtype=np.float64)
+        statistics.channel_m2 = np.array(summary["channel_m2"], dtype=np.float64)
+
+        if summary["mean_image"] is not None:
+            with open(lmdb_foldername + MEAN_FILENAME_SUFFIX, "rb") as mean_file:
+                mean_image = blobproto_to_array(mean_file.read())
+
+            statistics.pixel_sum = mean_image.astype(np.float64) * statistics.images
+
+        return statistics
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import importlib
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class LazyRegistry(object):
+    """
+    Registry of classes by name, used as a dict {name: class}.
+    Classes are registered with the name of the module that defines them, and the module is only imported the first
+    time the class is requested. This way, listing the registered names or using one of the classes does not load the
+    dependencies of all the others.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.classes = {}
+
+    def register(self, name, module_name, class_name=None):
+        """
+        Registers a class by the module that defines it, without importing it.
+        :param name: name to register the class with.
+        :param module_name: full name of the module that defines the class.
+        :param class_name: name of the class inside the module. By default, the same as the name.
+        """
+        self.modules[name] = (module_name, class_name or name)
+
+    def __setitem__(self, name, proto):
+        self.classes[name] = proto
+
+    def __getitem__(self, name):
+        if name not in self.classes:
+            if name not in self.modules:
+                raise KeyError(name)
+
+            module_name, class_name = self.modules[name]
+            self.classes[name] = getattr(importlib.import_module(module_name), class_name)
+
+        return self.classes[name]
+
+    def __contains__(self, name):
+        return name in self.modules or name in self.classes
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        """
+        Getter for the registered names, without importing any class.
+        :return: list of names.
+        """
+        return list(self.modules) + [name for name in self.classes if name not in self.modules]
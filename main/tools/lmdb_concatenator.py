@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import random
+import lmdb
+from main.tools.datum_codec import parse_datum_label
+from main.tools.lmdb_shards import find_lmdb_foldernames
+from main.tools.lmdb_summary import LMDBSummary
+from main.tools.lmdb_util import LMDBUtil
+from main.tools.lmdb_writer import LMDBWriter
+from main.tools.shuffle import interleave_evenly
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class LMDBConcatenator(object):
+    """
+    Concatenates several LMDBs (or sets of shards) into a single one.
+    The keys are rewritten into a new sequence of zero-padded indexes, so they are written in append mode. The values
+    are copied as they are, without decoding the datums: only their labels are read for the summary.
+    """
+
+    def __init__(self, map_size=-1):
+        """
+        Initialization of the concatenator.
+        :param map_size: initial size of map of the new LMDB. If set to -1, it is estimated.
+        """
+        self.map_size = map_size
+
+    @staticmethod
+    def merge_label_dictionaries(sources):
+        """
+        Merges the label dictionaries of the sources.
+        :param sources: list of LMDB sources.
+        :return: dict translating each label into the string of its metadata.
+        """
+        label_dictionary = {}
+
+        for source in sources:
+            for label, metadata in LMDBUtil(source).get_label_dictionary().items():
+
+                if label_dictionary.get(label, metadata) != metadata:
+                    raise Exception("Label {} means \"{}\" in {} but \"{}\" in a previous source. LMDBs with "
+                                    "different labels can't be concatenated.".format(label, metadata, source,
+                                                                                  label_dictionary[label]))
+
+                label_dictionary[label] = metadata
+
+        return label_dictionary
+
+    def concat(self, lmdb_foldername, sources, shuffle=False, seed=None, compact=False, fast_write=False):
+        """
+        Writes the entries of the sources into a new LMDB.
+        :param lmdb_foldername: filename of the new LMDB.
+        :param sources: list of LMDB sources: LMDB folders, names of sets of shards or index files of sets of shards.
+        :param shuffle: boolean flag to interleave the sources randomly, spreading each of them evenly along the new
+        LMDB. The order of the entries of each source is kept. If False, the sources are written one after another.
+        :param seed: seed for the interleaving of the sources.
+        :param compact: boolean flag to compact the new LMDB to its real size at the end.
+        :param fast_write: boolean flag to write the new LMDB without synchronous writes. It is synced to disk once,
+        when it is closed.
+        :return: number of entries written.
+        """
+        lmdb_folders = []
+
+        for source in sources:
+            source_folders = find_lmdb_foldernames(source)
+
+            if not source_folders:
+                raise Exception("LMDB source {} wasn't found.".format(source))
+
+            lmdb_folders += source_folders
+
+        if len(set(lmdb_folders)) != len(lmdb_folders):
+            raise Exception("A LMDB is included more than once in the sources.")
+
+        label_dictionary = self.merge_label_dictionaries(sources)
+
+        environments = [lmdb.open(lmdb_folder, readonly=True, lock=False) for lmdb_folder in lmdb_folders]
+        counts = [environment.stat()['entries'] for environment in environments]
+        total = sum(counts)
+
+        key_width = len(str(total))
+        datum_id_format = "{}:0>{}{}_dbuild_{}".format("{", key_width, "}", "{}")
+
+        # Values are buffers of the sources: they are valid until the read transactions end, after the last commit.
+        transactions = [environment.begin(buffers=True) for environment in environments]
+        cursors = [iter(transaction.cursor()) for transaction in transactions]
+
+        if shuffle:
+            order = interleave_evenly(counts, random.Random(seed))
+        else:
+            order = (lmdb_index for lmdb_index, count in enumerate(counts) for _ in range(count))
+
+        writer = LMDBWriter(lmdb_foldername, map_size=self.map_size, expected_entries=total, append=True,
+                            fast_write=fast_write)
+        summary = LMDBSummary()
+
+        try:
+            for index, lmdb_index in enumerate(order, 1):
+                key, value = next(cursors[lmdb_index])
+                datum_id = str(bytes(key), encoding="UTF-8").split("_dbuild_", 1)[-1]
+
+                summary.add(parse_datum_label(value))
+
+                committed = writer.put(datum_id_format.format(index, datum_id).encode("UTF-8"), value)
+
+                if committed:
+                    print("[{}%] Stored batch of {} image in LMDB".format(round(index / total * 100, 2), committed))
+
+            writer.close(compact=compact)
+
+        finally:
+            for transaction in transactions:
+                transaction.abort()
+
+            for environment in environments:
+                environment.close()
+
+        summary.save(lmdb_foldername, {
+            "sources": list(sources),
+            "label_dictionary": label_dictionary,
+        })
+
+        print("Concatenated {} entries from {} LMDBs into {}".format(total, len(lmdb_folders), lmdb_foldername))
+
+        return total
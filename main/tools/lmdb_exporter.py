@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+import array
+import math
+import os
+from main.tools.datum_pipeline import DatumPipeline, build_datum
+from main.tools.export_manifest import ExportManifest, split_datum_key
+from main.tools.image_statistics import ImageStatistics
+from main.tools.lmdb_shards import ShardWriter, get_shard_foldername, write_shard_index
+from main.tools.lmdb_summary import LMDBSummary
+from main.tools.lmdb_util import LMDBUtil
+from main.tools.lmdb_writer import LMDBWriter
+from main.tools.shuffle import interleaved_shuffle, merge_evenly
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class LMDBExporter(object):
+    """
+    Writes dataset entries into one or more LMDB files.
+    Images are decoded, normalized and serialized by a DatumPipeline, while this object is the single writer of the
+    LMDB transactions.
+    """
+
+    def __init__(self, normalizers=None, workers=1, encoding=None, datum_builder=build_datum):
+        """
+        Initialization of the exporter.
+        :param normalizers: list of normalizers to apply to the images.
+        :param workers: number of worker processes used to decode and normalize the images.
+        :param encoding: ImageEncoding to store the images with. If None, raw pixels are stored.
+        :param datum_builder: function that builds the datum of each key from its uri, label and the flag to apply
+        the normalizers. By default, the image is loaded from the uri (see DatumPipeline).
+        """
+        self.pipeline = DatumPipeline(normalizers, workers=workers, encoding=encoding, datum_builder=datum_builder)
+
+    def export(self, lmdb_foldername, keys, get_uri, get_label, map_size=-1, splitters=None,
+               apply_normalizers=False, compact=False, label_dictionary=None, resume=False, split_engine=None,
+               max_consecutive=None, shards=1, compute_statistics=True, fast_write=False):
+        """
+        Exports the keys to LMDB format.
+        A manifest is written inside each LMDB with the keys exported into it, so that the export can be resumed.
+        :param lmdb_foldername: filename LMDB.
+        :param keys: list of keys to export, in the order they must be stored.
+        :param get_uri: function that retrieves the absolute uri of the image of a key. With a datum builder other
+        than the default one, it retrieves whatever that builder takes as input.
+        :param get_label: function that retrieves the label of a key.
+        :param map_size: initial size of map of the LMDB database. If set to -1, it is estimated from the first batch
+        of images. In any case, it is grown on demand when the LMDB gets full.
+        :param splitters: a set of splitters to split the entries into multiple lmdbs. The lmdb divided by each
+        splitter will be stored with the splitter's name appended to the lmdb name.
+        :param apply_normalizers: boolean flag to apply normalizers to the images.
+        :param compact: boolean flag to compact each LMDB to its real size at the end of the export.
+        :param label_dictionary: dict translating each label into the string of its metadata. It is stored in the
+        manifest.
+        :param resume: boolean flag to resume a previous export into the same LMDBs. Only the entries that are not
+        in the manifests are exported. This allows to continue an interrupted export or to append new entries.
+        :param split_engine: SplitEngine to split the entries into multiple lmdbs deterministically. If set, the
+        splitters are ignored.
+        :param max_consecutive: if set, the keys of each split are reordered interleaving their labels, so that no
+        more than this number of consecutive entries share the same label.
+        :param shards: number of LMDBs each split is written into. If greater than 1, each shard is written by its own
+        process and it is named with its index appended to the lmdb name (lmdb_train_00of08, ...). An index of the
+        shards of each split is written next to them.
+        :param compute_statistics: boolean flag to compute the mean image and the mean and standard deviation of
+        each channel of each split while exporting. They are written next to the LMDB of each split
+        (lmdb_train_mean.binaryproto and lmdb_train_statistics.json). The aggregates of each image are computed by
+        the pipeline workers, before the image is encoded.
+        :param fast_write: boolean flag to write the LMDBs without synchronous writes. They are synced to disk once,
+        when they are closed.
+        :return: dict {label: label in the LMDBs}. When the export is resumed, labels keep the meaning of the
+        previous export, and labels of new metadata are appended after them.
+        Keys are written in increasing order into each LMDB (also when resuming, since their indexes continue the
+        previous ones), so they are appended without searching their place in the LMDB.
+        A summary of the labels of each LMDB (entries, entries of each class, maximum consecutive entries of each
+        class, label dictionary and normalizers) is written inside it, so that it can be described without reading it.
+        """
+        if splitters is None or split_engine is not None:
+            splitters = []
+
+        if label_dictionary is None:
+            label_dictionary = {}
+
+        if split_engine is not None:
+            splits = list(zip(split_engine.get_names(), split_engine.get_percentages()))
+        else:
+            splits = [(splitter.get_name(), splitter.get_split_percentage()) for splitter in splitters]
+
+        if splits:
+            split_foldernames = [lmdb_foldername + "_" + name for name, percentage in splits]
+        else:
+            split_foldernames = [lmdb_foldername]
+
+        # LMDBs are ordered by split and, inside each split, by shard.
+        if shards > 1:
+            lmdb_foldernames = [get_shard_foldername(foldername, shard, shards)
+                                for foldername in split_foldernames for shard in range(shards)]
+        else:
+            lmdb_foldernames = split_foldernames
+
+        description = {
+            "splits": {name: percentage for name, percentage in splits},
+            "label_dictionary": {str(label): str(metadata) for label, metadata in label_dictionary.items()},
+            "normalizers": self._get_normalizers_signature(apply_normalizers),
+            "shards": shards,
+            "key_width": len(str(len(keys))),
+            "next_index": 1,
+        }
+
+        manifests = [ExportManifest(foldername) for foldername in lmdb_foldernames]
+
+        if resume:
+            previous_assignment, label_translation = self._resume_manifests(manifests, description, shards)
+        else:
+            previous_assignment = {}
+            label_translation = {int(label): int(label) for label in label_dictionary}
+
+            # Appending to a LMDB without resuming would leave its manifest and summary without its previous entries.
+            self._check_empty_lmdbs(lmdb_foldernames)
+
+            for manifest, foldername in zip(manifests, lmdb_foldernames):
+                manifest.reset(dict(description, lmdb=os.path.basename(foldername)))
+
+        if any([label != exported_label for label, exported_label in label_translation.items()]):
+            get_dataset_label = get_label
+
+            # Labels are stored with the meaning they were given in the previous export.
+            def get_label(key):
+                label = get_dataset_label(key)
+                return label_translation.get(label, label)
+
+        statistics = None
+
+        if compute_statistics:
+            statistics = [self._get_split_statistics(foldername, manifests[index * shards:(index + 1) * shards],
+                                                     resume)
+                          for index, foldername in enumerate(split_foldernames)]
+
+        summaries = [self._get_lmdb_summary(manifest, resume) for manifest in manifests]
+
+        pending_positions = [position for position in range(len(keys)) if keys[position] not in previous_assignment]
+        pending_count = max(1, len(pending_positions))
+
+        assignment = None
+
+        if split_engine is not None:
+            classes = [get_label(key) for key in keys] if split_engine.stratify else None
+            assignment = split_engine.assign(keys, classes, previous_assignment)
+            expected_entries = [0] * len(split_foldernames)
+
+            for position in pending_positions:
+                expected_entries[assignment[position]] += 1
+
+        elif splitters:
+            expected_entries = [int(pending_count * share) for share in self._get_split_shares(splitters)]
+
+        else:
+            expected_entries = [pending_count]
+
+        # Entries of each split are distributed among its shards in turns, so that shards get the same size.
+        shard_turns = [0] * len(split_foldernames)
+
+        if assignment is not None and shards > 1:
+            assignment = array.array("I", list(assignment))
+
+            for position in pending_positions:
+                split_index = assignment[position]
+                assignment[position] = split_index * shards + shard_turns[split_index] % shards
+                shard_turns[split_index] += 1
+
+        if max_consecutive is not None:
+            pending_positions = self._interleave_labels(pending_positions, keys, get_label, assignment,
+                                                        max_consecutive)
+
+        key_width = description['key_width']
+        iteration = description['next_index'] - 1
+
+        if len(str(iteration + pending_count)) > key_width:
+            raise Exception("The LMDB keys were exported with {} digits and they are not enough for {} more entries. "
+                            "It must be exported again from scratch.".format(key_width, pending_count))
+
+        datum_id_format = "{}:0>{}{}_dbuild_{}".format("{", key_width, "}", "{}")
+
+        def commit_callback(manifest):
+            return lambda batch: manifest.checkpoint([split_datum_key(key)[1] for key, value in batch], iteration + 1)
+
+        if shards > 1:
+            # Each shard process keeps the manifest of its shard.
+            writers = [ShardWriter(foldername, map_size=map_size,
+                                   expected_entries=int(math.ceil(expected_entries[index // shards] / shards)),
+                                   manifest=manifest, append=True, fast_write=fast_write)
+                       for index, (foldername, manifest) in enumerate(zip(lmdb_foldernames, manifests))]
+        else:
+            writers = [LMDBWriter(foldername, map_size=map_size, expected_entries=expected,
+                                  commit_callback=commit_callback(manifest), append=True, fast_write=fast_write)
+                       for foldername, expected, manifest in zip(lmdb_foldernames, expected_entries, manifests)]
+
+        # Positions of the keys that are being processed by the pipeline, in order.
+        positions = deque()
+
+        def tasks():
+            for position in pending_positions:
+                key = keys[position]
+                positions.append(position)
+                yield get_uri(key), get_label(key), apply_normalizers
+
+        processed = 0
+
+        for serialized_datum, aggregates in self.pipeline.imap(tasks(), compute_statistics=statistics is not None):
+
+            iteration += 1
+            processed += 1
+            position = positions.popleft()
+
+            if serialized_datum is None:
+                print("Image not valid. Omitted.")
+                continue
+
+            if assignment is not None:
+                writer_index = assignment[position]
+            else:
+                split_index = 0
+
+                for split_id in range(len(splitters)):
+
+                    if splitters[split_id].decide(iteration):
+                        split_index = split_id
+                        break
+
+                writer_index = split_index * shards + shard_turns[split_index] % shards
+                shard_turns[split_index] += 1
+
+            summaries[writer_index].add(get_label(keys[position]))
+
+            if statistics is not None:
+                # The aggregates of the image were computed by the pipeline: they are only merged here.
+                statistics[writer_index // shards].add_aggregates(aggregates)
+
+            # Now we encode the image id in ascii format inside the lmdb container that corresponds to this input.
+            committed = writers[writer_index].put(datum_id_format.format(iteration, keys[position]).encode("ascii"),
+                                                  serialized_datum)
+
+            if committed:
+                print("[{}%] Stored batch of {} image in LMDB".format(round(processed/pending_count * 100, 2),
+                                                                      committed))
+
+        # There could be a last batch on each writer without being commited.
+        for writer, manifest in zip(writers, manifests):
+            committed = writer.close(compact=compact)
+
+            if shards == 1:
+                manifest.save()
+
+            if committed:
+                print("[{}%] Stored batch of {} image in LMDB".format(round(processed/pending_count * 100, 2),
+                                                                      committed))
+
+        for summary, foldername in zip(summaries, lmdb_foldernames):
+            summary.save(foldername, {
+                "lmdb": os.path.basename(foldername),
+                "label_dictionary": description["label_dictionary"],
+                "normalizers": description["normalizers"],
+            })
+
+        if statistics is not None:
+            for split_statistics, foldername in zip(statistics, split_foldernames):
+                split_statistics.save(foldername)
+
+        if shards > 1:
+            for index, foldername in enumerate(split_foldernames):
+                write_shard_index(foldername, lmdb_foldernames[index * shards:(index + 1) * shards])
+
+        if resume:
+            print("Exported {} new images. {} images were already exported.".format(processed,
+                                                                                    len(previous_assignment)))
+
+        return label_translation
+
+    @staticmethod
+    def _interleave_labels(positions, keys, get_label, assignment, max_consecutive):
+        """
+        Reorders the positions of the keys interleaving their labels inside each LMDB (split or shard).
+        Splits decided by splitters are unknown until the entries are written, so in that case the labels are
+        interleaved over all the keys.
+        :param positions: positions of the keys to reorder.
+        :param keys: list of keys.
+        :param get_label: function that retrieves the label of a key.
+        :param assignment: index of the LMDB of each key, or None if unknown.
+        :param max_consecutive: maximum number of consecutive entries with the same label.
+        :return: list with the positions reordered.
+        """
+        positions_by_lmdb = {}
+
+        for position in positions:
+            lmdb_index = 0 if assignment is None else assignment[position]
+            positions_by_lmdb.setdefault(lmdb_index, []).append(position)
+
+        interleaved_splits = [interleaved_shuffle(split_positions, [get_label(keys[position])
+                                                                    for position in split_positions],
+                                                  max_consecutive)
+                              for lmdb_index, split_positions in sorted(positions_by_lmdb.items())]
+
+        # The order of each LMDB is kept, while they are merged to advance all of them at the same pace.
+        return merge_evenly(interleaved_splits)
+
+    @staticmethod
+    def _get_split_statistics(split_foldername, manifests, resume):
+        """
+        Builds the statistics of a split. When resuming, the statistics of the previous export are kept if they cover
+        all the entries already exported; otherwise, they are computed again from the LMDBs.
+        :param split_foldername: filename of the LMDB of the split, without the shard.
+        :param manifests: manifests of the LMDBs (shards) of the split.
+        :param resume: boolean flag to continue the statistics of a previous export.
+        :return: ImageStatistics of the split.
+        """
+        exported_entries = sum([len(manifest.get_keys()) for manifest in manifests])
+
+        if not resume or exported_entries == 0:
+            return ImageStatistics()
+
+        statistics = ImageStatistics.load(split_foldername)
+
+        if statistics is None or statistics.get_images() != exported_entries:
+            print("Computing statistics of the images already exported into {}...".format(split_foldername))
+            statistics = ImageStatistics()
+
+            for manifest in manifests:
+                if manifest.get_keys():
+                    statistics.add_lmdb(manifest.lmdb_foldername)
+
+        return statistics
+
+    @staticmethod
+    def _get_lmdb_summary(manifest, resume):
+        """
+        Builds the summary of the labels of a LMDB. When resuming, the summary of the previous export is continued if
+        it covers all the entries already exported; otherwise, the labels of the LMDB are scanned again.
+        :param manifest: manifest of the LMDB.
+        :param resume: boolean flag to continue the summary of a previous export.
+        :return: LMDBSummary of the LMDB.
+        """
+        exported_entries = len(manifest.get_keys())
+
+        if not resume or exported_entries == 0:
+            return LMDBSummary()
+
+        summary, content = LMDBSummary.load(manifest.lmdb_foldername)
+
+        if summary is None or summary.entries != exported_entries:
+            print("Scanning the labels already exported into {}...".format(manifest.lmdb_foldername))
+            summary = LMDBSummary.from_scan(LMDBUtil(manifest.lmdb_foldername, rescan=True).scan_lmdbs()[0])
+
+        return summary
+
+    @staticmethod
+    def _check_empty_lmdbs(lmdb_foldernames):
+        """
+        Checks that the LMDBs of an export that is not resumed don't exist yet or are empty.
+        :param lmdb_foldernames: list of filenames of the LMDBs.
+        """
+        for foldername in lmdb_foldernames:
+            if not os.path.exists(os.path.join(foldername, "data.mdb")):
+                continue
+
+            entries = LMDBUtil(foldername).get_size()
+
+            if entries > 0:
+                raise Exception("The LMDB {} already contains {} entries. Resume the export to add the images that "
+                                "are not in it yet, or remove it to export it from scratch.".format(
+                                    foldername, entries))
+
+    @staticmethod
+    def _resume_manifests(manifests, description, shards=1):
+        """
+        Loads the manifests of a previous export and checks that they are compatible with the new one.
+        The key width and next index of the description are updated from the manifests.
+        :param manifests: list of manifests of the LMDBs, ordered by split and shard.
+        :param description: dict describing the new export.
+        :param shards: number of shards of each split.
+        :return: tuple (dict {key: split index} with the keys already exported into each LMDB, dict {label: label in
+        the LMDBs} translating the labels of the new export into the labels of the previous one).
+        """
+        previous_assignment = {}
+
+        for manifest in manifests:
+            manifest.load()
+
+            if not manifest.exists() and manifest.get_keys():
+                raise Exception("The LMDB {} contains entries but it has no manifest. It can't be resumed: it must be "
+                                "exported again from scratch.".format(manifest.lmdb_foldername))
+
+        previous_descriptions = [manifest.get_description() for manifest in manifests if manifest.get_description()]
+
+        if previous_descriptions:
+            label_translation = LMDBExporter._translate_labels(previous_descriptions[0].get("label_dictionary", {}),
+                                                               description)
+        else:
+            label_translation = {int(label): int(label) for label in description["label_dictionary"]}
+
+        for lmdb_index, manifest in enumerate(manifests):
+            previous_description = manifest.get_description()
+
+            if not previous_description:
+                # This LMDB didn't exist before. Its manifest is started from scratch.
+                manifest.reset(dict(description, lmdb=os.path.basename(manifest.lmdb_foldername)))
+                continue
+
+            # New labels can be appended to the label dictionary, but the previous labels must keep their meaning.
+            previous_labels = previous_description.get("label_dictionary", {})
+            labels_kept = all([description["label_dictionary"].get(label) == metadata
+                               for label, metadata in previous_labels.items()])
+
+            for field, compatible in [("splits", previous_description.get("splits") == description["splits"]),
+                                      ("label_dictionary", labels_kept),
+                                      ("normalizers", previous_description.get("normalizers") ==
+                                       description["normalizers"]),
+                                      ("shards", previous_description.get("shards", 1) == description["shards"])]:
+                if not compatible:
+                    raise Exception("The LMDB {} was exported with different {} ({} instead of {}). It can't be "
+                                    "resumed.".format(manifest.lmdb_foldername, field.replace("_", " "),
+                                                      previous_description.get(field), description[field]))
+
+            previous_description["label_dictionary"] = description["label_dictionary"]
+
+            description['key_width'] = previous_description.get('key_width', description['key_width'])
+            description['next_index'] = max(description['next_index'], previous_description.get('next_index', 1))
+            previous_assignment.update({key: lmdb_index // shards for key in manifest.get_keys()})
+
+        return previous_assignment, label_translation
+
+    @staticmethod
+    def _translate_labels(previous_labels, description):
+        """
+        Translates the labels of a new export into the labels of a previous one, so that they keep their meaning when
+        the export is resumed. Labels whose metadata was not exported before are appended after the previous ones.
+        :param previous_labels: dict {label: metadata} of the previous export, as strings.
+        :param description: dict describing the new export. Its label dictionary is replaced by the translated one.
+        :return: dict {label: label in the LMDBs} with the labels of the new export.
+        """
+        previous_by_metadata = {metadata: label for label, metadata in previous_labels.items()}
+        label_dictionary = dict(previous_labels)
+        next_label = max([int(label) for label in previous_labels] + [-1]) + 1
+        label_translation = {}
+
+        for label, metadata in sorted(description["label_dictionary"].items(), key=lambda item: int(item[0])):
+            if metadata not in previous_by_metadata:
+                previous_by_metadata[metadata] = str(next_label)
+                label_dictionary[str(next_label)] = metadata
+                next_label += 1
+
+            label_translation[int(label)] = int(previous_by_metadata[metadata])
+
+        description["label_dictionary"] = label_dictionary
+
+        return label_translation
+
+    def _get_normalizers_signature(self, apply_normalizers):
+        """
+        Describes the transformations applied to the images, in order to check that a resumed export is compatible.
+        :param apply_normalizers: boolean flag to apply normalizers to the images.
+        :return: list of strings describing each normalizer and the encoding.
+        """
+        signature = []
+
+        if apply_normalizers:
+            signature = ["{}({})".format(type(normalizer).__name__, normalizer.tostring())
+                         for normalizer in self.pipeline.normalizers]
+
+        if self.pipeline.encoding is not None:
+            signature.append("encoding({})".format(self.pipeline.encoding))
+
+        return signature
+
+    @staticmethod
+    def _get_split_shares(splitters):
+        """
+        Computes the expected share of the entries that goes to each splitter. Each splitter is asked only for the
+        entries that the previous splitters didn't take.
+        :param splitters: list of splitters.
+        :return: list with the expected share (0 to 1) for each splitter.
+        """
+        shares = []
+        remaining = 1.0
+
+        for splitter in splitters:
+            share = remaining * min(1.0, splitter.get_split_percentage())
+            shares.append(share)
+            remaining -= share
+
+        return shares
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import functools
+import os
+import cv2
+from main.dataset.dataset import mkdir_p
+from main.tools.image_encoding import ImageEncoding
+from main.tools.lmdb_reader import LMDBReader
+from main.tools.lmdb_util import LMDBUtil
+
+__author__ = 'Iván de Paz Centeno'
+
+
+RANGES_PER_WORKER = 4       # Ranges of keys for each worker, so that the workers that finish first take more ranges.
+
+
+def _write_datum(datum, uri, normalizers):
+    """
+    Writes the image of a datum into a file.
+    Encoded images are written as they are if they don't need to be normalized and they are already in the format
+    of the extension of the file. Otherwise, they are decoded and encoded again in the format of the file.
+    :param datum: DatumView of the datum with the image.
+    :param uri: uri of the file.
+    :param normalizers: list of normalizers to apply to the image before writing it.
+    :return: True if the bytes of the datum were written as they are, False if the image was encoded again.
+    """
+    if datum.encoded and not normalizers:
+        encoding = ImageEncoding.detect(datum.data)
+
+        if encoding is not None and encoding.matches_extension(uri):
+            with open(uri, "wb") as image_file:
+                image_file.write(datum.data)
+
+            return True
+
+    # Normalizers may modify the image in place, so they get a copy of the pixels of the LMDB.
+    image_blob = datum.get_blob(copy=len(normalizers) > 0)
+
+    for normalizer in normalizers:
+        image_blob = normalizer.apply(image_blob)
+
+    if not cv2.imwrite(uri, image_blob):
+        raise Exception("OpenCV could not write the image")
+
+    return False
+
+
+def _import_range(key_range, root_folder, normalizers):
+    """
+    Writes the images of a range of keys of a LMDB into a folder. Runs in a worker process.
+    :param key_range: tuple (lmdb foldername, start key, end key) of the range.
+    :param root_folder: folder to write the images into. Each image is written in the uri of its key.
+    :param normalizers: list of normalizers to apply to the images before writing them.
+    :return: list of tuples (key, label) of the images written.
+    """
+    lmdb_folder, start_key, end_key = key_range
+    imported = []
+    copied = 0
+
+    # Folders already created by this process, to avoid creating them for each image.
+    created_folders = set()
+
+    # Datums are parsed in place: the pixels are written from the memory of the LMDB.
+    with LMDBReader(lmdb_folder) as reader:
+        for lmdb_key, datum in reader.iterate(start_key, end_key):
+            key = str(bytes(lmdb_key), encoding="UTF-8").split("_dbuild_", 1)[-1]
+            uri = os.path.join(root_folder, key)
+
+            try:
+                if os.path.isabs(key):
+                    raise Exception("Uri for storing into dataset must be relative, not absolute")
+
+                folder = os.path.dirname(uri)
+
+                if folder not in created_folders:
+                    mkdir_p(folder)
+                    created_folders.add(folder)
+
+                copied += _write_datum(datum, uri, normalizers)
+                imported.append((key, datum.label))
+
+            except Exception as ex:
+                print("Could not write image \"{}\" into dataset.Reason: {}".format(key, ex))
+
+    print("Imported {} images from {} ({} copied without encoding them again, {} normalizers "
+          "applied)".format(len(imported), lmdb_folder, copied, len(normalizers)))
+
+    return imported
+
+
+class LMDBImporter(object):
+    """
+    Writes the images stored in a LMDB (or in a set of shards) into a dataset folder.
+    The key space of the LMDB is divided into ranges that are imported by different processes. Encoded images are
+    copied without decoding them when possible.
+    """
+
+    def __init__(self, normalizers=None, workers=1):
+        """
+        Initialization of the importer.
+        :param normalizers: list of normalizers to apply to the images.
+        :param workers: number of processes that import the images.
+        """
+        if normalizers is None:
+            normalizers = []
+
+        self.normalizers = normalizers
+        self.workers = workers
+
+    def import_lmdb(self, lmdb_foldername, root_folder):
+        """
+        Writes the images of the LMDB into the root folder.
+        :param lmdb_foldername: filename LMDB, name of a set of shards or index file of a set of shards.
+        :param root_folder: folder to write the images into.
+        :return: list of tuples (key, label) of the images written, in the order of the LMDB.
+        """
+        lmdb_util = LMDBUtil(lmdb_foldername, workers=self.workers)
+        import_range = functools.partial(_import_range, root_folder=root_folder, normalizers=self.normalizers)
+
+        chunks = 1 if self.workers == 1 else self.workers * RANGES_PER_WORKER
+        imported_ranges = lmdb_util.map_ranges(import_range, lmdb_util.get_key_ranges(chunks=chunks))
+
+        return [entry for imported in imported_ranges for entry in imported]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import lmdb
+from main.tools.datum_codec import DatumView
+from main.tools.lmdb_util import iterate_range
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class LMDBReader(object):
+    """
+    Reads the datums of a LMDB without copying them.
+    The read transaction is opened with buffers, so values are not copied into bytes, and datums are parsed in place
+    (DatumView): the arrays they return are views over the memory map of the LMDB. They are only valid while the
+    reader is open; get a copy of them (get_array(copy=True)) to keep them after closing it.
+    It is meant to be used as a context manager:
+
+        with LMDBReader("/path/to/lmdb") as reader:
+            for key, datum in reader.iterate():
+                pixels = datum.get_array()
+    """
+
+    def __init__(self, lmdb_foldername):
+        """
+        Initialization of the reader.
+        :param lmdb_foldername: filename LMDB.
+        """
+        self.lmdb_foldername = lmdb_foldername
+        self.environment = None
+        self.transaction = None
+
+    def open(self):
+        """
+        Opens the LMDB and its read transaction.
+        """
+        if self.environment is None:
+            self.environment = lmdb.open(self.lmdb_foldername, readonly=True, lock=False)
+            self.transaction = self.environment.begin(buffers=True)
+
+    def close(self):
+        """
+        Ends the read transaction and closes the LMDB. The views returned by the reader are not valid anymore.
+        """
+        if self.environment is not None:
+            self.transaction.abort()
+            self.environment.close()
+
+        self.environment = None
+        self.transaction = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        """
+        :return: the number of entries of the LMDB.
+        """
+        self.open()
+        return self.environment.stat()['entries']
+
+    def get(self, key):
+        """
+        Reads the datum of a key.
+        :param key: LMDB key (bytes).
+        :return: DatumView of the datum, or None if the key is not in the LMDB.
+        """
+        self.open()
+        value = self.transaction.get(key)
+
+        if value is None:
+            return None
+
+        return DatumView(value)
+
+    def iterate(self, start_key=None, end_key=None):
+        """
+        Iterates over the datums of a range of keys.
+        :param start_key: first key of the range (bytes), or None to start at the first entry.
+        :param end_key: key where the range ends, excluded (bytes), or None to end at the last entry.
+        :return: generator of tuples (key, DatumView). The key is a buffer, as the datum.
+        """
+        self.open()
+
+        for key, value in iterate_range(self.transaction, start_key, end_key):
+            yield key, DatumView(value)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import array
+import bisect
+import random
+import lmdb
+import numpy as np
+from main.tools.datum_codec import DatumView
+from main.tools.lmdb_shards import find_lmdb_foldernames
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class LMDBSampleReader(object):
+    """
+    Random access to the samples of a LMDB (or of a set of shards) by their position, to feed training loops.
+    Keys of the LMDBs exported by dtb start with a zero-padded index, so only the index of each position is kept in
+    memory and each sample is found directly with the index of its key. The shards are read one after the other, as a
+    single LMDB.
+    Samples are returned as arrays that own their data, in caffe's order (CxHxW).
+    """
+
+    def __init__(self, lmdb_source):
+        """
+        Initialization of the reader. The keys of the LMDBs are read once to know the position of each sample.
+        :param lmdb_source: LMDB folder, name of a set of shards or index file of a set of shards.
+        """
+        self.lmdb_folders = find_lmdb_foldernames(lmdb_source) or [lmdb_source]
+        self.environments = [lmdb.open(lmdb_folder, readonly=True, lock=False) for lmdb_folder in self.lmdb_folders]
+
+        # For each LMDB, the index of the key of each position (or the keys themselves, if they don't have index)
+        # and the width of the index in the keys.
+        self.key_indexes = []
+        self.key_widths = []
+        self.offsets = [0]
+
+        for environment in self.environments:
+            key_indexes, key_width = self._read_key_indexes(environment)
+
+            self.key_indexes.append(key_indexes)
+            self.key_widths.append(key_width)
+            self.offsets.append(self.offsets[-1] + len(key_indexes))
+
+    @staticmethod
+    def _read_key_indexes(environment):
+        """
+        Reads the keys of a LMDB, without their values.
+        :param environment: LMDB environment.
+        :return: tuple (indexes, width). Indexes is an array with the index of each key, in order. If the keys don't
+        start with an index, it is the list of keys and width is None.
+        """
+        key_indexes = array.array("Q")
+        key_width = None
+
+        with environment.begin() as lmdb_txn:
+            try:
+                for key in lmdb_txn.cursor().iternext(keys=True, values=False):
+                    if key_width is None:
+                        key_width = key.index(b"_dbuild_")
+
+                    if key[key_width:key_width + 8] != b"_dbuild_":
+                        raise ValueError()
+
+                    key_indexes.append(int(key[:key_width]))
+
+            except ValueError:
+                return list(lmdb_txn.cursor().iternext(keys=True, values=False)), None
+
+        return key_indexes, key_width
+
+    def close(self):
+        """
+        Closes the LMDBs.
+        """
+        for environment in self.environments:
+            environment.close()
+
+        self.environments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        """
+        :return: the number of samples.
+        """
+        return self.offsets[-1]
+
+    def _locate(self, position):
+        """
+        Finds the LMDB of a position.
+        :param position: position of the sample, from 0 to len() - 1.
+        :return: tuple (index of the LMDB, position inside the LMDB).
+        """
+        if position < 0:
+            position += len(self)
+
+        if not 0 <= position < len(self):
+            raise IndexError("Sample {} is out of range. There are {} samples.".format(position, len(self)))
+
+        lmdb_index = bisect.bisect_right(self.offsets, position) - 1
+
+        return lmdb_index, position - self.offsets[lmdb_index]
+
+    def _read(self, lmdb_cursor, lmdb_index, local_position):
+        """
+        Reads the datum of a position of a LMDB.
+        :param lmdb_cursor: cursor of a read transaction of the LMDB, opened with buffers.
+        :param lmdb_index: index of the LMDB.
+        :param local_position: position inside the LMDB.
+        :return: DatumView of the sample, valid while the transaction is.
+        """
+        key_width = self.key_widths[lmdb_index]
+
+        if key_width is None:
+            key = self.key_indexes[lmdb_index][local_position]
+        else:
+            key = "{:0>{}}_dbuild_".format(self.key_indexes[lmdb_index][local_position], key_width).encode("ascii")
+
+        if not lmdb_cursor.set_range(key) or not bytes(lmdb_cursor.key()).startswith(key):
+            raise Exception("Key {} was not found in {}. The LMDB has changed since it was opened.".format(
+                key, self.lmdb_folders[lmdb_index]))
+
+        return DatumView(lmdb_cursor.value())
+
+    def get_many(self, positions):
+        """
+        Reads a batch of samples. Positions are read sorted, with a single read transaction for each LMDB, so that
+        the reads are as sequential as possible.
+        :param positions: list of positions of the samples.
+        :return: tuple (images, labels) with a NxCxHxW array of the images (uint8 for raw or encoded datums) and an
+        array with the label of each image, in the order of the positions.
+        """
+        images = None
+        labels = np.empty(len(positions), dtype=np.int32)
+
+        located = sorted([self._locate(position) + (slot,) for slot, position in enumerate(positions)])
+        lmdb_txns = {}
+
+        try:
+            for lmdb_index, local_position, slot in located:
+                if lmdb_index not in lmdb_txns:
+                    lmdb_txns[lmdb_index] = self.environments[lmdb_index].begin(buffers=True)
+                    lmdb_cursor = lmdb_txns[lmdb_index].cursor()
+
+                datum = self._read(lmdb_cursor, lmdb_index, local_position)
+                pixels = datum.get_array()
+
+                if images is None:
+                    images = np.empty((len(positions),) + pixels.shape, dtype=pixels.dtype)
+
+                elif pixels.shape != images.shape[1:]:
+                    raise Exception("Samples have different sizes ({} and {}). They can't be read in the same "
+                                    "batch.".format(pixels.shape, images.shape[1:]))
+
+                # The pixels are copied from the memory of the LMDB into the batch.
+                images[slot] = pixels
+                labels[slot] = datum.label
+
+        finally:
+            for lmdb_txn in lmdb_txns.values():
+                lmdb_txn.abort()
+
+        if images is None:
+            images = np.empty((0, 0, 0, 0), dtype=np.uint8)
+
+        return images, labels
+
+    def __getitem__(self, position):
+        """
+        Reads a sample.
+        :param position: position of the sample. Negative positions count from the end.
+        :return: tuple (image, label) with the CxHxW array of the image and its label.
+        """
+        images, labels = self.get_many([position])
+
+        return images[0], int(labels[0])
+
+    def iterate_batches(self, batch_size, shuffle=True, seed=None, epoch=0, prefetch=2, threads=2, drop_last=False):
+        """
+        Iterates over all the samples in batches. The next batches are read by a pool of threads while the current
+        one is used.
+        :param batch_size: number of samples of each batch.
+        :param shuffle: boolean flag to visit the samples in a random order.
+        :param seed: seed for the order of the samples. The same seed and epoch give the same order.
+        :param epoch: number of the epoch. Each epoch visits the samples in a different order.
+        :param prefetch: number of batches read in advance.
+        :param threads: number of threads that read the batches.
+        :param drop_last: boolean flag to skip the last batch if it has less than batch_size samples.
+        :return: generator of tuples (images, labels), as returned by get_many().
+        """
+        positions = list(range(len(self)))
+
+        if shuffle:
+            random.Random(None if seed is None else "{}:{}".format(seed, epoch)).shuffle(positions)
+
+        batches = [positions[start:start + batch_size] for start in range(0, len(positions), batch_size)]
+
+        if drop_last and batches and len(batches[-1]) < batch_size:
+            batches.pop()
+
+        with ThreadPoolExecutor(max(1, threads)) as executor:
+            pending = deque()
+
+            for batch in batches:
+                pending.append(executor.submit(self.get_many, batch))
+
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import multiprocessing
+import os
+import queue
+import lmdb
+from main.dataset.dataset import LMDB_BATCH_SIZE
+from main.tools.export_manifest import split_datum_key
+from main.tools.lmdb_writer import LMDBWriter
+
+__author__ = 'Iván de Paz Centeno'
+
+
+SHARD_INDEX_SUFFIX = "_shards.json"     # Index of a shard set, stored next to its shards: <lmdb>_shards.json
+SHARD_QUEUE_DEPTH = 4                   # Batches waiting to be written by each shard process.
+
+
+def get_shard_foldername(lmdb_foldername, shard, shards):
+    """
+    Builds the filename of a shard of a LMDB.
+    :param lmdb_foldername: filename of the LMDB as a whole.
+    :param shard: index of the shard, starting at 0.
+    :param shards: number of shards of the LMDB.
+    :return: filename of the shard. Example: /path/lmdb_train_03of08
+    """
+    return "{}_{:0>2}of{:0>2}".format(lmdb_foldername, shard, shards)
+
+
+def get_lmdb_entries(lmdb_foldername):
+    """
+    Retrieves the number of entries of a LMDB.
+    :param lmdb_foldername: filename LMDB.
+    :return: number of entries.
+    """
+    lmdb_env = lmdb.open(lmdb_foldername, readonly=True, lock=False)
+    entries = lmdb_env.stat()['entries']
+    lmdb_env.close()
+
+    return entries
+
+
+def write_shard_index(lmdb_foldername, shard_foldernames):
+    """
+    Writes the index of a shard set, listing its shards and their number of entries.
+    :param lmdb_foldername: filename of the LMDB as a whole. The index is stored as <lmdb_foldername>_shards.json
+    :param shard_foldernames: filenames of the shards, in order.
+    """
+    shards = [{"lmdb": os.path.basename(foldername), "entries": get_lmdb_entries(foldername)}
+              for foldername in shard_foldernames]
+
+    index = {
+        "shards": shards,
+        "entries": sum([shard["entries"] for shard in shards]),
+    }
+
+    index_filename = lmdb_foldername + SHARD_INDEX_SUFFIX
+
+    with open(index_filename + ".tmp", "w") as index_file:
+        json.dump(index, index_file, indent=4)
+
+    os.replace(index_filename + ".tmp", index_filename)
+
+
+def find_lmdb_foldernames(lmdb_source):
+    """
+    Finds the LMDB folders of a source, which can be a LMDB folder, a shard set (<lmdb_foldername> of its index) or
+    the index file of a shard set.
+    :param lmdb_source: source to look for.
+    :return: list of LMDB foldernames. Empty if the source doesn't exist.
+    """
+    lmdb_source = lmdb_source.rstrip(os.sep)
+
+    if lmdb_source.endswith(SHARD_INDEX_SUFFIX):
+        index_filename = lmdb_source
+    else:
+        index_filename = lmdb_source + SHARD_INDEX_SUFFIX
+
+    if os.path.isfile(index_filename):
+        with open(index_filename) as index_file:
+            index = json.load(index_file)
+
+        index_folder = os.path.dirname(index_filename)
+        return [os.path.join(index_folder, shard["lmdb"]) for shard in index["shards"]]
+
+    if os.path.isdir(lmdb_source):
+        return [lmdb_source]
+
+    return []
+
+
+def _write_shard(batches_queue, lmdb_foldername, map_size, expected_entries, manifest, writer_options):
+    """
+    Writes the batches received from the queue into a LMDB. Runs in the process of a shard.
+    """
+    def checkpoint(batch):
+        keys = [split_datum_key(key)[1] for key, value in batch]
+        manifest.checkpoint(keys, split_datum_key(batch[-1][0])[0] + 1)
+
+    writer = LMDBWriter(lmdb_foldername, map_size=map_size, expected_entries=expected_entries,
+                        commit_callback=None if manifest is None else checkpoint, **writer_options)
+
+    while True:
+        message, content = batches_queue.get()
+
+        if message == "close":
+            writer.close(compact=content)
+            break
+
+        for key, value in content:
+            writer.put(key, value)
+
+    if manifest is not None:
+        manifest.save()
+
+
+class ShardWriter(object):
+    """
+    Writes key/value pairs into a LMDB from a separate process, so that several LMDBs (the shards) can be written at
+    the same time. It has the same interface as LMDBWriter. Entries are sent to the process in batches.
+    """
+
+    def __init__(self, lmdb_foldername, map_size=-1, expected_entries=None, batch_size=LMDB_BATCH_SIZE,
+                 manifest=None, **writer_options):
+        """
+        Initialization of the writer. The process of the shard is started.
+        :param lmdb_foldername: filename LMDB of the shard.
+        :param map_size: initial map size of the LMDB. If set to -1, it is estimated.
+        :param expected_entries: number of entries that are expected to be written. Used to estimate the map size.
+        :param batch_size: amount of entries sent to the process at once.
+        :param manifest: ExportManifest of the shard, updated by the process each time a batch is committed.
+        :param writer_options: other arguments of the LMDBWriter of the process (append, batch_bytes, batch_seconds,
+        fast_write).
+        """
+        self.lmdb_foldername = lmdb_foldername
+        self.batch_size = batch_size
+        self.batch = []
+
+        self.queue = multiprocessing.Queue(SHARD_QUEUE_DEPTH)
+        self.process = multiprocessing.Process(target=_write_shard, args=(self.queue, lmdb_foldername, map_size,
+                                                                          expected_entries, manifest,
+                                                                          writer_options))
+        self.process.start()
+
+    def _send(self, message, content):
+        """
+        Sends a message to the process of the shard. It waits while the queue is full, unless the process died.
+        """
+        while True:
+            try:
+                self.queue.put((message, content), timeout=1)
+                break
+
+            except queue.Full:
+                if not self.process.is_alive():
+                    raise Exception("The writer of the LMDB {} stopped unexpectedly.".format(self.lmdb_foldername))
+
+    def put(self, key, value):
+        """
+        Puts the key/value pair into the LMDB. It is sent to the process of the shard when the batch is full.
+        :param key: key of the entry, in bytes.
+        :param value: value of the entry, in bytes.
+        :return: number of entries sent to the process with this entry, 0 if the batch wasn't sent.
+        """
+        self.batch.append((key, value))
+
+        if len(self.batch) >= self.batch_size:
+            return self.flush()
+
+        return 0
+
+    def flush(self):
+        """
+        Sends the current batch to the process of the shard.
+        :return: number of entries sent.
+        """
+        if not self.batch:
+            return 0
+
+        self._send("put", self.batch)
+
+        sent = len(self.batch)
+        self.batch = []
+
+        return sent
+
+    def close(self, compact=False):
+        """
+        Sends the pending batch and waits for the process of the shard to write everything and close the LMDB.
+        :param compact: boolean flag to compact the LMDB to its real size after writing.
+        :return: number of entries sent in the last batch.
+        """
+        sent = self.flush()
+        self._send("close", compact)
+        self.process.join()
+
+        if self.process.exitcode != 0:
+            raise Exception("The writer of the LMDB {} failed.".format(self.lmdb_foldername))
+
+        return sent
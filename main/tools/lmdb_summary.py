@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+import lmdb
+
+__author__ = 'Iván de Paz Centeno'
+
+
+SUMMARY_FILENAME = "summary.json"       # Summary of the content of a LMDB, stored inside its folder.
+
+
+class LMDBSummary(object):
+    """
+    Summary of the labels stored in a LMDB: number of entries, entries of each class and maximum number of
+    consecutive entries of each class. It is built while the LMDB is written, one label at a time, and stored inside
+    the LMDB folder, so that the LMDB can be described without reading it.
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self.max_consecutive = {}
+        self.entries = 0
+        self.first_run = (None, 0)
+        self.last_run = (None, 0)
+        self.created = None
+
+    def add(self, label):
+        """
+        Accumulates the label of an entry written after the previous ones.
+        :param label: label of the entry.
+        """
+        last_label, last_count = self.last_run
+        count = last_count + 1 if label == last_label else 1
+
+        self.classes[label] = self.classes.get(label, 0) + 1
+        self.max_consecutive[label] = max(count, self.max_consecutive.get(label, 0))
+        self.entries += 1
+        self.last_run = (label, count)
+
+        if count == self.entries:
+            self.first_run = (label, count)
+
+    @classmethod
+    def from_scan(cls, scan_result):
+        """
+        Builds a summary from the scan of a LMDB.
+        :param scan_result: scan of a single LMDB, with its first and last runs.
+        :return: the summary.
+        """
+        summary = cls()
+        summary.classes = dict(scan_result["classes"])
+        summary.max_consecutive = dict(scan_result["max_consecutive"])
+        summary.entries = scan_result["entries"]
+        summary.first_run = tuple(scan_result["first_run"])
+        summary.last_run = tuple(scan_result["last_run"])
+
+        return summary
+
+    def to_scan(self):
+        """
+        :return: the summary as a scan of the LMDB.
+        """
+        return {
+            "classes": dict(self.classes),
+            "max_consecutive": dict(self.max_consecutive),
+            "entries": self.entries,
+            "first_run": self.first_run,
+            "last_run": self.last_run,
+        }
+
+    def save(self, lmdb_foldername, description=None):
+        """
+        Writes the summary into the LMDB folder. The file is replaced atomically.
+        :param lmdb_foldername: filename LMDB.
+        :param description: dict describing the export (label dictionary, normalizers, ...), stored with the summary.
+        """
+        if self.created is None:
+            self.created = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        summary = dict(description or {})
+        summary.update({
+            "entries": self.entries,
+            "classes": {str(label): count for label, count in self.classes.items()},
+            "max_consecutive": {str(label): count for label, count in self.max_consecutive.items()},
+            "first_run": list(self.first_run),
+            "last_run": list(self.last_run),
+            "created": self.created,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+
+        filename = os.path.join(lmdb_foldername, SUMMARY_FILENAME)
+
+        with open(filename + ".tmp", "w") as summary_file:
+            json.dump(summary, summary_file, indent=4)
+
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, lmdb_foldername):
+        """
+        Loads the summary stored inside a LMDB folder. It is discarded if the LMDB has changed since it was written.
+        :param lmdb_foldername: filename LMDB.
+        :return: tuple (summary, content of the summary file), or (None, None) if there is no valid summary.
+        """
+        filename = os.path.join(lmdb_foldername, SUMMARY_FILENAME)
+
+        if not os.path.exists(filename):
+            return None, None
+
+        with open(filename) as summary_file:
+            content = json.load(summary_file)
+
+        lmdb_env = lmdb.open(lmdb_foldername, readonly=True, lock=False)
+        entries = lmdb_env.stat()['entries']
+        lmdb_env.close()
+
+        if content.get("entries") != entries:
+            return None, None
+
+        summary = cls()
+        summary.classes = {int(label): count for label, count in content["classes"].items()}
+        summary.max_consecutive = {int(label): count for label, count in content["max_consecutive"].items()}
+        summary.entries = content["entries"]
+        summary.first_run = tuple(content["first_run"])
+        summary.last_run = tuple(content["last_run"])
+        summary.created = content.get("created")
+
+        return summary, content
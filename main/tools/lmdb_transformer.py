@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import random
+import lmdb
+from main.tools.datum_codec import parse_datum_label
+from main.tools.datum_pipeline import transform_datum
+from main.tools.lmdb_exporter import LMDBExporter
+from main.tools.lmdb_util import LMDBUtil, iterate_range
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class LMDBTransformer(object):
+    """
+    Writes the datums of a LMDB (or of a set of shards) into new LMDBs, shuffled, split again or normalized, without
+    going through the image files of a dataset.
+    Only the keys and labels of the source are held in memory: the datums are read from the source as they are
+    written. Datums that are not normalized are copied as they are, without decoding them.
+    """
+
+    def __init__(self, normalizers=None, workers=1):
+        """
+        Initialization of the transformer.
+        :param normalizers: list of normalizers to apply to the images.
+        :param workers: number of worker processes used to normalize the images.
+        """
+        if normalizers is None:
+            normalizers = []
+
+        self.normalizers = normalizers
+        self.exporter = LMDBExporter(normalizers, workers=workers, datum_builder=transform_datum)
+
+    def transform(self, source_foldername, lmdb_foldername, split_engine=None, shuffle=False, seed=None,
+                  map_size=-1, compact=False, max_consecutive=None, shards=1, compute_statistics=True,
+                  fast_write=False):
+        """
+        Transforms the source LMDB into new LMDBs.
+        :param source_foldername: filename of the source LMDB, name of a set of shards or index file of a set of
+        shards.
+        :param lmdb_foldername: filename of the new LMDB.
+        :param split_engine: SplitEngine to split the entries into multiple lmdbs. If None, a single LMDB is written.
+        :param shuffle: boolean flag to shuffle the entries.
+        :param seed: seed for the shuffle. If set, the transform is reproducible.
+        :param map_size: initial size of map of the new LMDBs. If set to -1, it is estimated.
+        :param compact: boolean flag to compact each LMDB to its real size at the end.
+        :param max_consecutive: if set, no more than this number of consecutive entries share the same label.
+        :param shards: number of LMDBs each split is written into.
+        :param compute_statistics: boolean flag to compute the mean image and the channels statistics of each split.
+        :param fast_write: boolean flag to write the new LMDBs without synchronous writes. They are synced to disk
+        once, when they are closed.
+        """
+        lmdb_util = LMDBUtil(source_foldername)
+
+        # Entries of the source: (key as exported from the dataset, index of its source LMDB, position in it, LMDB
+        # key, label).
+        entries = []
+        key_counts = {}
+
+        for lmdb_index, lmdb_folder in enumerate(lmdb_util.lmdb_folders):
+            lmdb_env = lmdb.open(lmdb_folder, readonly=True, lock=False)
+
+            with lmdb_env.begin(buffers=True) as lmdb_txn:
+                for position, (lmdb_key, value) in enumerate(iterate_range(lmdb_txn, None, None)):
+                    lmdb_key = bytes(lmdb_key)
+                    key = str(lmdb_key, encoding="UTF-8").split("_dbuild_", 1)[-1]
+
+                    entries.append((key, lmdb_index, position, lmdb_key, parse_datum_label(value)))
+                    key_counts[key] = key_counts.get(key, 0) + 1
+
+            lmdb_env.close()
+
+        # Key of each entry => (index of its source LMDB, LMDB key).
+        source_keys = {}
+        labels = {}
+
+        # LMDBs of different collection campaigns, concatenated together, share the same dataset keys. The duplicated
+        # keys are prefixed with their source LMDB and their position in it, so that every entry keeps a unique key.
+        for key, lmdb_index, position, lmdb_key, label in entries:
+            if key_counts[key] > 1:
+                key = "{}_{}/{}".format(lmdb_index, position, key)
+
+            source_keys[key] = (lmdb_index, lmdb_key)
+            labels[key] = label
+
+        del entries
+
+        keys = list(source_keys.keys())
+
+        if shuffle:
+            random.Random(seed).shuffle(keys)
+
+        label_dictionary = lmdb_util.get_label_dictionary()
+
+        print("Transforming {} entries from {}".format(len(keys), source_foldername))
+
+        # The datums are read in the order they are written, each one from the read transaction of its LMDB.
+        lmdb_envs = [lmdb.open(lmdb_folder, readonly=True, lock=False) for lmdb_folder in lmdb_util.lmdb_folders]
+        lmdb_txns = [lmdb_env.begin() for lmdb_env in lmdb_envs]
+
+        def get_datum(key):
+            lmdb_index, lmdb_key = source_keys[key]
+            return lmdb_txns[lmdb_index].get(lmdb_key)
+
+        try:
+            self.exporter.export(lmdb_foldername, keys, get_datum, labels.__getitem__, map_size=map_size,
+                                 apply_normalizers=len(self.normalizers) > 0, compact=compact,
+                                 label_dictionary=label_dictionary, split_engine=split_engine,
+                                 max_consecutive=max_consecutive, shards=shards,
+                                 compute_statistics=compute_statistics, fast_write=fast_write)
+
+        finally:
+            for lmdb_txn in lmdb_txns:
+                lmdb_txn.abort()
+
+            for lmdb_env in lmdb_envs:
+                lmdb_env.close()
@@ -1,90 +1,453 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import caffe
-from caffe.proto import caffe_pb2
+import json
+import math
+import multiprocessing
+import os
+import random
 import lmdb
+from main.tools.datum_codec import parse_datum_label
+from main.tools.export_manifest import MANIFEST_FILENAME, ExportManifest, split_datum_key
+from main.tools.lmdb_shards import find_lmdb_foldernames
+from main.tools.lmdb_summary import LMDBSummary
 
 __author__ = 'Iván de Paz Centeno'
 
 
+def iterate_range(lmdb_txn, start_key, end_key, values=True):
+    """
+    Iterates over the entries of a range of keys of a LMDB.
+    :param lmdb_txn: read transaction of the LMDB.
+    :param start_key: first key of the range (bytes), or None to start at the first entry.
+    :param end_key: key where the range ends, excluded (bytes), or None to end at the last entry.
+    :param values: boolean flag to retrieve the values. If False, values are None.
+    :return: generator of tuples (key, value).
+    """
+    lmdb_cursor = lmdb_txn.cursor()
+
+    if start_key is None:
+        found = lmdb_cursor.first()
+    else:
+        found = lmdb_cursor.set_range(start_key)
+
+    if not found:
+        return
+
+    if values:
+        entries = lmdb_cursor.iternext(keys=True, values=True)
+    else:
+        entries = ((key, None) for key in lmdb_cursor.iternext(keys=True, values=False))
+
+    for key, value in entries:
+        if end_key is not None and bytes(key) >= end_key:
+            break
+
+        yield key, value
+
+
+def _scan_range(key_range):
+    """
+    Scans the labels of a range of keys of a LMDB. Only the label of each datum is decoded.
+    :param key_range: tuple (lmdb foldername, start key, end key) of the range.
+    :return: dict with the classes, max consecutive counts and entries of the range, plus its first and last runs
+    of labels, so that it can be stitched with the adjacent ranges.
+    """
+    lmdb_folder, start_key, end_key = key_range
+
+    classes = {}
+    max_consecutive_labels = {}
+    entries = 0
+
+    first_label, first_count = None, 0
+    consecutive_label, consecutive_count = None, 0
+
+    lmdb_env = lmdb.open(lmdb_folder, readonly=True, lock=False)
+
+    # Buffers avoid copying the values: only the bytes of the fields that are decoded are read.
+    with lmdb_env.begin(buffers=True) as lmdb_txn:
+        for key, value in iterate_range(lmdb_txn, start_key, end_key):
+            label = parse_datum_label(value)
+
+            classes[label] = classes.get(label, 0) + 1
+            entries += 1
+
+            if label == consecutive_label:
+                consecutive_count += 1
+            else:
+                consecutive_label = label
+                consecutive_count = 1
+
+            if consecutive_count > max_consecutive_labels.get(label, 0):
+                max_consecutive_labels[label] = consecutive_count
+
+            if consecutive_count == entries:
+                # The first run hasn't been broken yet.
+                first_label, first_count = label, consecutive_count
+
+    lmdb_env.close()
+
+    return {
+        "classes": classes,
+        "max_consecutive": max_consecutive_labels,
+        "entries": entries,
+        "first_run": (first_label, first_count),
+        "last_run": (consecutive_label, consecutive_count),
+    }
+
+
+def _stitch_scans(scans):
+    """
+    Merges the scans of contiguous ranges of a LMDB, in order. Runs of labels that cross the boundary between two
+    ranges are joined.
+    :param scans: list of scans of contiguous ranges, in the order of the keys.
+    :return: scan of the whole range.
+    """
+    merged = None
+
+    for scan in scans:
+        if scan["entries"] == 0:
+            continue
+
+        if merged is None:
+            merged = {
+                "classes": dict(scan["classes"]),
+                "max_consecutive": dict(scan["max_consecutive"]),
+                "entries": scan["entries"],
+                "first_run": scan["first_run"],
+                "last_run": scan["last_run"],
+            }
+            continue
+
+        for label, count in scan["classes"].items():
+            merged["classes"][label] = merged["classes"].get(label, 0) + count
+
+        for label, count in scan["max_consecutive"].items():
+            merged["max_consecutive"][label] = max(count, merged["max_consecutive"].get(label, 0))
+
+        last_label, last_count = merged["last_run"]
+        first_label, first_count = scan["first_run"]
+
+        if last_label == first_label:
+            joined_count = last_count + first_count
+            merged["max_consecutive"][last_label] = max(joined_count, merged["max_consecutive"][last_label])
+
+            # A range made of a single run extends the runs of the ranges around it.
+            if merged["first_run"][1] == merged["entries"]:
+                merged["first_run"] = (last_label, joined_count)
+
+            if first_count == scan["entries"]:
+                merged["last_run"] = (last_label, joined_count)
+            else:
+                merged["last_run"] = scan["last_run"]
+
+        else:
+            merged["last_run"] = scan["last_run"]
+
+        merged["entries"] += scan["entries"]
+
+    if merged is None:
+        merged = {"classes": {}, "max_consecutive": {}, "entries": 0, "first_run": (None, 0), "last_run": (None, 0)}
+
+    return merged
+
+
+def _get_index_bounds(lmdb_folder):
+    """
+    Retrieves the indexes of the first and last keys of a LMDB exported by dtb.
+    :param lmdb_folder: LMDB folder.
+    :return: tuple (first index, last index, width of the index in the keys), or None if the LMDB is empty or its
+    keys don't start with an index.
+    """
+    lmdb_env = lmdb.open(lmdb_folder, readonly=True, lock=False)
+
+    with lmdb_env.begin() as lmdb_txn:
+        lmdb_cursor = lmdb_txn.cursor()
+        first_key = lmdb_cursor.key() if lmdb_cursor.first() else None
+        last_key = lmdb_cursor.key() if lmdb_cursor.last() else None
+
+    lmdb_env.close()
+
+    try:
+        first_index = split_datum_key(first_key)[0]
+        last_index = split_datum_key(last_key)[0]
+        key_width = len(str(first_key, encoding="UTF-8").split("_dbuild_", 1)[0])
+
+    except (TypeError, ValueError):
+        return None
+
+    return first_index, last_index, key_width
+
+
 class LMDBUtil(object):
     """
     Wraps a LMDB database to know information about it.
+    A set of shards (the name of the set or its index file) is wrapped as a single database.
+    LMDBs exported by dtb can be scanned in parallel: their keys start with a zero-padded index, so the key space is
+    divided into contiguous ranges that are scanned by different processes.
+    LMDBs that have an up to date summary (written by the export) are not scanned: their summary is read instead.
     """
 
-    def __init__(self, lmdb_folder):
+    def __init__(self, lmdb_folder, workers=1, rescan=False):
+        """
+        Initialization of the util.
+        :param lmdb_folder: LMDB folder, name of a set of shards or index file of a set of shards.
+        :param workers: number of processes used to scan the LMDB.
+        :param rescan: boolean flag to scan the LMDB even if it has a summary.
+        """
         self.lmdb_folder = lmdb_folder
+        self.lmdb_folders = find_lmdb_foldernames(lmdb_folder) or [lmdb_folder]
+        self.workers = max(1, int(workers))
+        self.rescan = rescan
+        self.summaries = {}
+        self.lmdb_scans = None
+        self.scan_result = None
 
     def get_size(self):
         """
-        :return: the amount of elements inside the LMDB file.
+        :return: the amount of elements inside the LMDB file. It is read from the statistics of the LMDB, unless a
+        rescan was requested: then, the keys are counted one by one.
         """
-        classes = self.get_classes()
-        return sum([value for key, value in classes.items()])
+        size = 0
 
-    def get_classes(self):
+        for lmdb_folder in self.lmdb_folders:
+            lmdb_env = lmdb.open(lmdb_folder, readonly=True, lock=False)
+
+            if self.rescan:
+                with lmdb_env.begin() as lmdb_txn:
+                    size += sum([1 for key, value in iterate_range(lmdb_txn, None, None, values=False)])
+            else:
+                size += lmdb_env.stat()['entries']
+
+            lmdb_env.close()
+
+        return size
+
+    def get_key_ranges(self, chunks=None, lmdb_folders=None):
         """
-        :return: the different classes available inside the LMDB file.
+        Divides the keys of each LMDB into contiguous ranges of similar size, by the index of the keys. LMDBs whose
+        keys don't start with an index are not divided.
+        :param chunks: number of ranges for each LMDB. By default, the number of workers.
+        :param lmdb_folders: LMDBs to divide. By default, all of them.
+        :return: list of tuples (lmdb foldername, start key, end key), in order. Start key is None for the first
+        range of a LMDB and end key (excluded) is None for the last one.
         """
-        lmdb_env = lmdb.open(self.lmdb_folder)
-        lmdb_txn = lmdb_env.begin()
-        lmdb_cursor = lmdb_txn.cursor()
+        if chunks is None:
+            chunks = self.workers
 
-        classes = {}
+        if lmdb_folders is None:
+            lmdb_folders = self.lmdb_folders
 
-        datum = caffe_pb2.Datum()
-        for key, value in lmdb_cursor:
-            datum.ParseFromString(value)
+        key_ranges = []
 
-            label = datum.label
+        for lmdb_folder in lmdb_folders:
+            index_bounds = _get_index_bounds(lmdb_folder)
 
-            if label not in classes:
-                classes[label] = 0
+            if index_bounds is None:
+                key_ranges.append((lmdb_folder, None, None))
+                continue
 
-            classes[label] += 1
+            first_index, last_index, key_width = index_bounds
 
-        lmdb_env.close()
+            ranges_count = max(1, min(chunks, last_index - first_index + 1))
+            boundaries = [first_index + (last_index - first_index + 1) * chunk // ranges_count
+                          for chunk in range(1, ranges_count)]
+            boundary_keys = [None] + ["{:0>{}}".format(boundary, key_width).encode("ascii")
+                                      for boundary in boundaries] + [None]
 
-        return classes
+            key_ranges += [(lmdb_folder, boundary_keys[index], boundary_keys[index + 1])
+                           for index in range(ranges_count)]
 
-    def get_max_consecutive_counts(self):
-        lmdb_env = lmdb.open(self.lmdb_folder)
-        lmdb_txn = lmdb_env.begin()
-        lmdb_cursor = lmdb_txn.cursor()
+        return key_ranges
+
+    def map_ranges(self, function, key_ranges=None):
+        """
+        Applies a function to each range of keys of the LMDB, in a pool of processes if there is more than one worker.
+        :param function: module-level function that receives a tuple (lmdb foldername, start key, end key).
+        :param key_ranges: ranges of keys, as returned by get_key_ranges(). By default, one range per worker.
+        :return: list with the result of each range, in the order of the keys.
+        """
+        if key_ranges is None:
+            key_ranges = self.get_key_ranges()
+
+        if self.workers == 1 or len(key_ranges) == 1:
+            return [function(key_range) for key_range in key_ranges]
+
+        with multiprocessing.Pool(min(self.workers, len(key_ranges))) as pool:
+            return pool.map(function, key_ranges)
+
+    def sample_windows(self, entries, window_size, seed=None):
+        """
+        Reads the labels of random windows of consecutive entries. Each window is found directly by the index of its
+        first key, so only the entries of the windows are read. Windows are distributed among the LMDBs (shards)
+        proportionally to their size, and they never cross from one LMDB to another.
+        :param entries: approximate number of entries to read. It is rounded up to whole windows.
+        :param window_size: number of consecutive entries of each window.
+        :param seed: seed for the position of the windows.
+        :return: list of windows, each one a list of consecutive labels.
+        """
+        rng = random.Random(seed)
+        windows_count = max(1, int(math.ceil(entries / window_size)))
+
+        lmdb_bounds = []
+
+        for lmdb_folder in self.lmdb_folders:
+            lmdb_env = lmdb.open(lmdb_folder, readonly=True, lock=False)
+            lmdb_entries = lmdb_env.stat()['entries']
+            lmdb_env.close()
+
+            if lmdb_entries == 0:
+                continue
+
+            index_bounds = _get_index_bounds(lmdb_folder)
+
+            if index_bounds is None:
+                raise Exception("The keys of the LMDB {} don't start with an index. It can't be sampled.".format(
+                    lmdb_folder))
+
+            lmdb_bounds.append((lmdb_folder, lmdb_entries) + index_bounds)
+
+        if not lmdb_bounds:
+            return []
+
+        # Each window is assigned to a LMDB at random, weighted by the entries of the LMDB.
+        chosen_lmdbs = rng.choices(range(len(lmdb_bounds)), weights=[bounds[1] for bounds in lmdb_bounds],
+                                   k=windows_count)
+        windows = []
+
+        for lmdb_index, (lmdb_folder, lmdb_entries, first_index, last_index, key_width) in enumerate(lmdb_bounds):
+            # Indexes of a shard are sparse: the last window starts early enough to find window_size entries.
+            indexes_per_entry = (last_index - first_index + 1) / lmdb_entries
+            last_start = max(first_index, int(last_index - (window_size - 1) * indexes_per_entry))
+
+            lmdb_env = lmdb.open(lmdb_folder, readonly=True, lock=False)
+
+            with lmdb_env.begin(buffers=True) as lmdb_txn:
+                for _ in range(chosen_lmdbs.count(lmdb_index)):
+                    start_key = "{:0>{}}".format(rng.randint(first_index, last_start), key_width).encode("ascii")
+                    window = []
+
+                    for key, value in iterate_range(lmdb_txn, start_key, None):
+                        window.append(parse_datum_label(value))
+
+                        if len(window) == window_size:
+                            break
+
+                    windows.append(window)
+
+            lmdb_env.close()
+
+        return windows
 
+    def scan_lmdbs(self):
+        """
+        Retrieves the labels of each LMDB. The summary of a LMDB is used if it is up to date and a rescan was not
+        requested; otherwise, the labels are read in a single pass, split in ranges among the workers. Only the label
+        of each datum is decoded: the pixels are skipped without being read.
+        :return: list with the scan of each LMDB, in order: dict with the number of elements of each class
+        ("classes"), the maximum number of consecutive elements of each class ("max_consecutive"), the number of
+        elements ("entries") and the first and last runs of labels ("first_run", "last_run").
+        """
+        if self.lmdb_scans is not None:
+            return self.lmdb_scans
+
+        scans_by_lmdb = {}
+
+        if not self.rescan:
+            for lmdb_folder in self.lmdb_folders:
+                summary, content = LMDBSummary.load(lmdb_folder)
+
+                if summary is not None:
+                    scans_by_lmdb[lmdb_folder] = summary.to_scan()
+                    self.summaries[lmdb_folder] = content
+
+        pending_folders = [lmdb_folder for lmdb_folder in self.lmdb_folders if lmdb_folder not in scans_by_lmdb]
+
+        if pending_folders:
+            key_ranges = self.get_key_ranges(lmdb_folders=pending_folders)
+            range_scans = self.map_ranges(_scan_range, key_ranges)
+            range_scans_by_lmdb = {}
+
+            for (lmdb_folder, start_key, end_key), range_scan in zip(key_ranges, range_scans):
+                range_scans_by_lmdb.setdefault(lmdb_folder, []).append(range_scan)
+
+            # Ranges are stitched inside each LMDB.
+            for lmdb_folder, scans in range_scans_by_lmdb.items():
+                scans_by_lmdb[lmdb_folder] = _stitch_scans(scans)
+
+        self.lmdb_scans = [scans_by_lmdb[lmdb_folder] for lmdb_folder in self.lmdb_folders]
+
+        return self.lmdb_scans
+
+    def scan(self):
+        """
+        Retrieves the labels of all the elements, from the summaries of the LMDBs or reading them (see scan_lmdbs()).
+        The result is kept, so the LMDB is scanned only once.
+        :return: dict with the number of elements of each class ("classes"), the maximum number of consecutive
+        elements of each class ("max_consecutive") and the total number of elements ("entries"). For a set of shards,
+        consecutive elements are counted inside each shard, as each shard is read on its own.
+        """
+        if self.scan_result is not None:
+            return self.scan_result
+
+        lmdb_scans = self.scan_lmdbs()
+
+        # The LMDBs are merged without joining their runs.
+        classes = {}
         max_consecutive_labels = {}
 
-        datum = caffe_pb2.Datum()
+        for lmdb_scan in lmdb_scans:
+            for label, count in lmdb_scan["classes"].items():
+                classes[label] = classes.get(label, 0) + count
 
-        consecutive_label_name = ""
-        consecutive_label_count = 0
+            for label, count in lmdb_scan["max_consecutive"].items():
+                max_consecutive_labels[label] = max(count, max_consecutive_labels.get(label, 0))
 
-        for key, value in lmdb_cursor:
-            datum.ParseFromString(value)
+        self.scan_result = {
+            "classes": classes,
+            "max_consecutive": max_consecutive_labels,
+            "entries": sum([lmdb_scan["entries"] for lmdb_scan in lmdb_scans]),
+        }
 
-            label = datum.label
+        return self.scan_result
 
-            if consecutive_label_name == "":
-                consecutive_label_name = label
+    def get_summaries(self):
+        """
+        :return: dict {lmdb folder: content of its summary} with the summaries used by the scan. LMDBs that were read
+        are not included.
+        """
+        self.scan_lmdbs()
+        return self.summaries
 
-            if label == consecutive_label_name:
-                consecutive_label_count += 1
+    def get_label_dictionary(self):
+        """
+        Retrieves the label dictionary of the export, from the summaries of the LMDBs or, if they don't have one,
+        from their manifests. The LMDB is not read.
+        :return: dict translating each label (as a string) into the string of its metadata. Empty if it is unknown.
+        """
+        label_dictionary = {}
 
-            else:
-                if consecutive_label_name in max_consecutive_labels:
-                    max_consecutive_label = max_consecutive_labels[consecutive_label_name]
-                else:
-                    max_consecutive_label = 0
+        for lmdb_folder in self.lmdb_folders:
+            summary, content = LMDBSummary.load(lmdb_folder)
 
-                max_consecutive_labels[consecutive_label_name] = max(consecutive_label_count, max_consecutive_label)
-                consecutive_label_name = label
-                consecutive_label_count = 1
+            if content is None and ExportManifest(lmdb_folder).exists():
+                with open(os.path.join(lmdb_folder, MANIFEST_FILENAME)) as manifest_file:
+                    content = json.load(manifest_file)
 
-        if consecutive_label_name and consecutive_label_name not in max_consecutive_labels:
-            max_consecutive_labels[consecutive_label_name] = consecutive_label_count
+            if content is None:
+                continue
 
-        lmdb_env.close()
+            label_dictionary.update(content.get("label_dictionary", {}))
 
-        return max_consecutive_labels
+        return label_dictionary
 
+    def get_classes(self):
+        """
+        :return: the different classes available inside the LMDB file, with their number of elements.
+        """
+        return self.scan()["classes"]
 
+    def get_max_consecutive_counts(self):
+        """
+        :return: the maximum number of consecutive elements of each class.
+        """
+        return self.scan()["max_consecutive"]
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import time
+import lmdb
+from main.dataset.dataset import LMDB_BATCH_BYTES, LMDB_BATCH_SECONDS, mkdir_p
+
+__author__ = 'Iván de Paz Centeno'
+
+
+MIN_MAP_SIZE = 10 * 1024 * 1024     # Map size is never estimated below this size (10 MBytes).
+MAP_SIZE_OVERHEAD = 1.2             # Factor applied to the estimated size of the entries to allocate the map.
+MAP_SIZE_GROWTH_FACTOR = 2          # Factor applied to the map size each time the LMDB gets full.
+LMDB_PAGE_SIZE = 4096
+
+
+class LMDBWriter(object):
+    """
+    Writes key/value pairs into a LMDB environment in batches.
+    A batch is committed when its entries reach a budget of bytes or when it has been open for a budget of time, so
+    that small and big entries are committed in transactions of a similar size and the progress is saved regularly.
+    The map size of the environment is estimated from the first batch written and it is grown on demand each time
+    the LMDB gets full, replaying the batch that failed. This way it is not required to reserve a huge map size.
+    """
+
+    def __init__(self, lmdb_foldername, map_size=-1, expected_entries=None, batch_size=None,
+                 growth_factor=MAP_SIZE_GROWTH_FACTOR, commit_callback=None, append=False,
+                 batch_bytes=LMDB_BATCH_BYTES, batch_seconds=LMDB_BATCH_SECONDS, fast_write=False):
+        """
+        Initialization of the writer.
+        :param lmdb_foldername: filename LMDB.
+        :param map_size: initial map size of the LMDB. If set to -1, it is estimated from the size of the entries of
+        the first batch and the number of expected entries.
+        :param expected_entries: number of entries that are expected to be written. Used to estimate the map size.
+        :param batch_size: amount of entries before a batch is committed into the file. If None, only the budgets
+        of bytes and time are used.
+        :param growth_factor: factor applied to the map size each time the LMDB gets full.
+        :param commit_callback: function called with the list of (key, value) pairs of each batch once it is
+        committed into the file.
+        :param append: boolean flag to write the entries in append mode. Keys must be written in increasing order and
+        after the keys already in the LMDB: they are appended to the end of the database without searching their
+        place. A batch whose keys can't be appended is written with regular puts.
+        :param batch_bytes: bytes of the keys and values of a batch before it is committed into the file.
+        :param batch_seconds: seconds since the first entry of a batch before it is committed into the file. It is
+        checked each time an entry is put.
+        :param fast_write: boolean flag to open the LMDB without synchronous writes (writemap, map_async, no sync). The
+        file is only synced to disk when the writer is closed, so a crash of the system (not of the process) while
+        writing may corrupt the LMDB.
+        """
+        self.lmdb_foldername = lmdb_foldername
+        self.map_size = map_size
+        self.expected_entries = expected_entries
+        self.batch_size = batch_size
+        self.growth_factor = growth_factor
+        self.commit_callback = commit_callback
+        self.append = append
+        self.batch_bytes = batch_bytes
+        self.batch_seconds = batch_seconds
+        self.fast_write = fast_write
+
+        self.environment = None
+        self.batch = []
+        self.pending_bytes = 0
+        self.batch_start = None
+        self.entries = 0
+
+        if self.map_size != -1:
+            self._open()
+
+    def _open(self):
+        """
+        Opens the LMDB environment. If the map size is not defined, it is estimated from the current batch.
+        """
+        if self.map_size == -1:
+            self.map_size = self._estimate_map_size()
+
+        self.map_size = int(self.map_size)
+
+        print("Map size of {} is {} MBytes".format(self.lmdb_foldername, round(self.map_size/1000/1000, 2)))
+
+        if self.fast_write:
+            self.environment = lmdb.Environment(self.lmdb_foldername, map_size=self.map_size, writemap=True,
+                                                map_async=True, sync=False, metasync=False)
+        else:
+            self.environment = lmdb.Environment(self.lmdb_foldername, map_size=self.map_size)
+
+    def _estimate_map_size(self):
+        """
+        Estimates the map size required for the expected entries by sampling the size of the entries in the batch.
+        :return: estimated map size in bytes.
+        """
+        if not self.batch:
+            return MIN_MAP_SIZE
+
+        # Values bigger than a page are stored in overflow pages, which wastes half a page per entry on average.
+        entry_size = sum([len(key) + len(value) for key, value in self.batch]) / len(self.batch) + LMDB_PAGE_SIZE / 2
+
+        expected_entries = max(self.expected_entries or 0, len(self.batch))
+
+        return max(MIN_MAP_SIZE, int(entry_size * expected_entries * MAP_SIZE_OVERHEAD))
+
+    def _grow(self):
+        """
+        Grows the map size of the environment geometrically.
+        """
+        self.map_size = int(self.map_size * self.growth_factor)
+        self.environment.set_mapsize(self.map_size)
+        print("LMDB {} is full. Map size grown to {} MBytes".format(self.lmdb_foldername,
+                                                                    round(self.map_size/1000/1000, 2)))
+
+    def put(self, key, value):
+        """
+        Puts the key/value pair into the LMDB. It is written when the batch reaches its budget of bytes or time (or
+        its size, if set).
+        :param key: key of the entry, in bytes.
+        :param value: value of the entry, in bytes.
+        :return: number of entries committed into the file with this entry, 0 if the batch wasn't committed.
+        """
+        if not self.batch:
+            self.batch_start = time.monotonic()
+
+        self.batch.append((key, value))
+        self.pending_bytes += len(key) + len(value)
+
+        full = (self.pending_bytes >= self.batch_bytes or
+                time.monotonic() - self.batch_start >= self.batch_seconds or
+                (self.batch_size is not None and len(self.batch) >= self.batch_size))
+
+        if full:
+            return self.flush()
+
+        return 0
+
+    def flush(self):
+        """
+        Commits the current batch into the file. If the LMDB gets full, its map size is grown and the batch is
+        written again.
+        :return: number of entries committed.
+        """
+        if not self.batch:
+            return 0
+
+        if self.environment is None:
+            self._open()
+
+        while True:
+            txn = self.environment.begin(write=True)
+
+            try:
+                self._write_batch(txn)
+                txn.commit()
+                break
+
+            except lmdb.MapFullError:
+                txn.abort()
+                self._grow()
+
+        if self.commit_callback is not None:
+            self.commit_callback(self.batch)
+
+        committed = len(self.batch)
+        self.entries += committed
+        self.batch = []
+        self.pending_bytes = 0
+
+        return committed
+
+    def _write_batch(self, txn):
+        """
+        Writes the current batch into a write transaction. In append mode, the batch is appended to the end of the
+        database; if any of its keys is not after the last one of the LMDB, it is written again with regular puts.
+        :param txn: write transaction.
+        """
+        if self.append:
+            consumed, added = txn.cursor().putmulti(self.batch, append=True)
+
+            if added == len(self.batch):
+                return
+
+            # LMDB skips the keys that can't be appended. The whole batch is written again in its place.
+            print("Keys of a batch can't be appended to {}. They are written with regular puts.".format(
+                self.lmdb_foldername))
+
+        for key, value in self.batch:
+            txn.put(key, value)
+
+    def get_entries(self):
+        """
+        Getter for the number of entries committed by this writer.
+        :return:
+        """
+        return self.entries
+
+    def compact(self):
+        """
+        Rewrites the LMDB without free pages, so that its file is shrunk to the real size of its content.
+        The environment is closed after compacting it.
+        """
+        compacted_foldername = self.lmdb_foldername + ".compact"
+        mkdir_p(compacted_foldername)
+
+        self.environment.copy(compacted_foldername, compact=True)
+        self.environment.close()
+        self.environment = None
+
+        os.replace(os.path.join(compacted_foldername, "data.mdb"), os.path.join(self.lmdb_foldername, "data.mdb"))
+        shutil.rmtree(compacted_foldername)
+
+    def close(self, compact=False):
+        """
+        Commits the pending batch and closes the environment.
+        :param compact: boolean flag to compact the LMDB to its real size after writing.
+        :return: number of entries committed in the last batch.
+        """
+        committed = self.flush()
+
+        if self.environment is None and self.map_size == -1:
+            # Nothing was written. We still create the LMDB so that it exists.
+            self._open()
+
+        if self.fast_write:
+            self.environment.sync(True)
+
+        if compact:
+            self.compact()
+        else:
+            self.environment.close()
+            self.environment = None
+
+        return committed
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+
+__author__ = 'Iván de Paz Centeno'
+
+
+JOURNAL_SUFFIX = ".journal"             # The journal of a metadata file is stored next to it (labels.json.journal).
+COMPACTION_MIN_RECORDS = 10000          # Records of the journal before it can be compacted automatically.
+COMPACTION_RATIO = 0.5                  # Records of the journal, relative to the entries of the metadata file, before
+                                        # it is compacted automatically.
+
+
+class MetadataDict(dict):
+    """
+    Dict of metadata that records the keys put or deleted since it was loaded or saved, so that only the changes need
+    to be saved.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed_keys = set()
+        self.cleared = False
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed_keys.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed_keys.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+    def pop(self, key, *args):
+        self.changed_keys.add(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.changed_keys.add(key)
+        return key, value
+
+    def clear(self):
+        dict.clear(self)
+        self.changed_keys = set()
+        self.cleared = True
+
+    def reset_changes(self):
+        """
+        Forgets the changes recorded, once they are saved.
+        """
+        self.changed_keys = set()
+        self.cleared = False
+
+
+class MetadataJournal(object):
+    """
+    Journal of the changes of a metadata file (labels.json).
+    Saving a few changes into a huge metadata file doesn't rewrite it: the keys put or deleted are appended to a
+    journal next to it, one JSON record per line. When the metadata is loaded, the journal is replayed over the
+    metadata file. The journal is compacted into the metadata file when it grows too much, or on demand. The metadata
+    file is always replaced atomically, so it is never left half written, and it keeps its format.
+    """
+
+    def __init__(self, metadata_filename):
+        """
+        Initialization of the journal.
+        :param metadata_filename: filename of the metadata (labels.json).
+        """
+        self.metadata_filename = metadata_filename
+        self.journal_filename = metadata_filename + JOURNAL_SUFFIX
+        self.metadata_entries = 0
+        self.journal_records = 0
+
+    def replay(self, metadata, build_metadata):
+        """
+        Applies the records of the journal to the metadata loaded from the metadata file.
+        A record that was half written (the process was killed while appending it) is discarded and removed from the
+        journal.
+        :param metadata: MetadataDict or MetadataTable loaded from the metadata file. Its recorded changes are reset.
+        :param build_metadata: function that builds the metadata object of a key from its value in the file.
+        """
+        self.metadata_entries = len(metadata)
+        self.journal_records = 0
+
+        if os.path.exists(self.journal_filename):
+            valid_length = 0
+
+            with open(self.journal_filename, "rb") as journal_file:
+                for line in journal_file:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Record is not complete")
+
+                        record = json.loads(line.decode("utf-8"))
+
+                    except ValueError:
+                        print("Last record of the metadata journal {} is not complete. It is "
+                              "discarded.".format(self.journal_filename))
+                        break
+
+                    if record[0] == "put":
+                        metadata[record[1]] = build_metadata(record[2])
+                    else:
+                        metadata.pop(record[1], None)
+
+                    valid_length += len(line)
+                    self.journal_records += 1
+
+            if valid_length < os.path.getsize(self.journal_filename):
+                with open(self.journal_filename, "r+b") as journal_file:
+                    journal_file.truncate(valid_length)
+
+        metadata.reset_changes()
+
+    def save(self, metadata, generate_value):
+        """
+        Saves the metadata. If it records its changes (MetadataDict, MetadataTable), only its changes are appended to
+        the journal; the journal is compacted if it grew too much. Otherwise, or if the metadata file doesn't exist
+        yet, the whole metadata is written into the metadata file.
+        :param metadata: dict with the metadata of each key.
+        :param generate_value: function that translates the metadata object of a key into its value in the file.
+        """
+        records_changes = getattr(metadata, "changed_keys", None) is not None
+
+        if not records_changes or metadata.cleared or not os.path.exists(self.metadata_filename):
+            self.compact(metadata, generate_value)
+            return
+
+        if not metadata.changed_keys:
+            return
+
+        records = [["put", key, generate_value(metadata[key])] if key in metadata else ["delete", key]
+                   for key in metadata.changed_keys]
+
+        with open(self.journal_filename, "a", encoding="utf-8") as journal_file:
+            journal_file.write("".join([json.dumps(record) + "\n" for record in records]))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        self.journal_records += len(records)
+        metadata.reset_changes()
+
+        if self.journal_records >= max(COMPACTION_MIN_RECORDS, self.metadata_entries * COMPACTION_RATIO):
+            self.compact(metadata, generate_value)
+
+    def compact(self, metadata, generate_value):
+        """
+        Writes the whole metadata into the metadata file, in its JSON format, and removes the journal.
+        The file is written into a temporary file that replaces the previous one, so a crash never leaves it half
+        written. If the process is killed before removing the journal, replaying it again gives the same metadata.
+        :param metadata: dict with the metadata of each key.
+        :param generate_value: function that translates the metadata object of a key into its value in the file.
+        """
+        temp_filename = self.metadata_filename + ".tmp"
+
+        with open(temp_filename, "w") as outfile:
+            json.dump({key: generate_value(value) for key, value in metadata.items()}, outfile, indent=4)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+        os.replace(temp_filename, self.metadata_filename)
+
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+
+        self.metadata_entries = len(metadata)
+        self.journal_records = 0
+
+        if hasattr(metadata, "reset_changes"):
+            metadata.reset_changes()
+
+    def compact_file(self):
+        """
+        Compacts the journal into the metadata file without building the metadata objects: the values of the journal
+        are written as they are.
+        :return: True if there was a journal to compact, False otherwise.
+        """
+        if not os.path.exists(self.journal_filename):
+            return False
+
+        metadata = MetadataDict()
+
+        if os.path.exists(self.metadata_filename):
+            with open(self.metadata_filename) as metadata_file:
+                metadata = MetadataDict(json.load(metadata_file))
+
+        self.replay(metadata, lambda value: value)
+        self.compact(metadata, lambda value: value)
+
+        return True
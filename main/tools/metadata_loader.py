@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+from main.tools.metadata_table import MetadataTable
+
+__author__ = 'Iván de Paz Centeno'
+
+
+CHUNK_SIZE = 4 * 1024 * 1024    # Characters read from the metadata file at once.
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+NUMBER_END = " \t\n\r,}]"
+
+# A pair "key": "value" followed by the comma or the brace after it, when both are strings without escapes. It is the
+# format of the pairs of labels.json, so most of them are parsed with a single match.
+SIMPLE_PAIR = re.compile(r'[ \t\n\r]*"([^"\\\x00-\x1f]*)"[ \t\n\r]*:[ \t\n\r]*"([^"\\\x00-\x1f]*)"[ \t\n\r]*([,}])')
+
+
+class JSONObjectStream(object):
+    """
+    Reads the pairs of a JSON object from a file one by one, without loading the whole file in memory. Only a chunk of
+    the file is held at a time.
+    Pairs with a key and a value without escapes are parsed with a regular expression. Any other pair is parsed with
+    the decoder of the json module.
+    """
+
+    def __init__(self, json_file, chunk_size=CHUNK_SIZE):
+        """
+        Initialization of the stream.
+        :param json_file: file object opened in text mode, with a JSON object.
+        :param chunk_size: number of characters read at once.
+        """
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Reads the next chunk of the file into the buffer, discarding the part already parsed.
+        """
+        chunk = self.json_file.read(self.chunk_size)
+
+        if not chunk:
+            self.eof = True
+
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def _skip_whitespace(self):
+        """
+        Moves the position to the next character that is not whitespace, reading more chunks if required.
+        """
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+
+            if self.position < len(self.buffer) or self.eof:
+                return
+
+            self._fill()
+
+    def _next_char(self):
+        """
+        :return: the next character that is not whitespace, or an empty string at the end of the file.
+        """
+        self._skip_whitespace()
+
+        if self.position >= len(self.buffer):
+            return ""
+
+        char = self.buffer[self.position]
+        self.position += 1
+
+        return char
+
+    def _decode(self):
+        """
+        Decodes the JSON value at the position, reading more chunks while it is not complete.
+        :return: the value.
+        """
+        self._skip_whitespace()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+
+                # A number could continue in the next chunk (12 of 12.5): it is complete when something else follows.
+                is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+
+                if self.eof or (end < len(self.buffer) and (not is_number or self.buffer[end] in NUMBER_END)):
+                    self.position = end
+                    return value
+
+            except ValueError:
+                if self.eof:
+                    raise
+
+            self._fill()
+
+    def __iter__(self):
+        """
+        :return: generator of the pairs (key, value) of the object, in the order of the file.
+        """
+        self._fill()
+        char = self._next_char()
+
+        if char == "":
+            # Empty file, as an empty object.
+            return
+
+        if char != "{":
+            raise ValueError("The JSON file must contain an object.")
+
+        self._skip_whitespace()
+
+        if self.buffer.startswith("}", self.position):
+            return
+
+        while True:
+            if len(self.buffer) - self.position < self.chunk_size // 2 and not self.eof:
+                self._fill()
+
+            match = SIMPLE_PAIR.match(self.buffer, self.position)
+
+            if match is not None:
+                self.position = match.end()
+                yield match.group(1), match.group(2)
+                delimiter = match.group(3)
+
+            else:
+                key = self._decode()
+
+                if not isinstance(key, str) or self._next_char() != ":":
+                    raise ValueError("Invalid JSON object at character {} of the chunk.".format(self.position))
+
+                yield key, self._decode()
+                delimiter = self._next_char()
+
+            if delimiter == "}":
+                return
+
+            if delimiter != ",":
+                raise ValueError("Invalid JSON object at character {} of the chunk.".format(self.position))
+
+
+def load_metadata_table(metadata_filename, build_metadata, generate_value):
+    """
+    Loads a metadata file (labels.json) streaming its content into a MetadataTable, which stores the keys and the
+    codes of their labels in arrays instead of a dict of objects.
+    :param metadata_filename: filename of the metadata.
+    :param build_metadata: function that builds the metadata object of a key from its value in the file. It is called
+    once for each distinct value.
+    :param generate_value: function that translates the metadata object of a key into its value in the file.
+    :return: MetadataTable with the metadata of each key. It is empty if the file doesn't exist.
+    """
+    metadata = MetadataTable(build_metadata, generate_value)
+
+    if not os.path.exists(metadata_filename):
+        return metadata
+
+    with open(metadata_filename, encoding="utf-8") as metadata_file:
+        metadata.load(JSONObjectStream(metadata_file))
+
+    return metadata
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from array import array
+import json
+import numpy as np
+
+__author__ = 'Iván de Paz Centeno'
+
+
+HASH_MASK = 0xFFFFFFFF      # Hashes of the keys are truncated to 32 bits; collisions are resolved comparing the keys.
+MERGE_MIN_KEYS = 100000     # Keys added after the table was built before they can be merged into its arrays.
+MERGE_RATIO = 0.25          # Keys added, relative to the keys of the arrays, before they are merged into them.
+
+
+def _get_value_key(value):
+    """
+    :return: hashable key for a value of the metadata file. Values that are not hashable (lists, objects) are
+    identified by their JSON representation.
+    """
+    try:
+        hash(value)
+        return value
+
+    except TypeError:
+        return json.dumps(value, sort_keys=True)
+
+
+class MetadataTable(object):
+    """
+    Table with the metadata of each key, stored by columns instead of as a dict of objects.
+    The keys are encoded into a single buffer of bytes, delimited by an array of offsets. The metadata of each key is
+    a small integer code into the list of distinct labels, so each label object exists only once. Keys are found
+    through a sorted array of their hashes. This way, each key costs its length in bytes and a few integers, instead
+    of a string, a dict entry and a metadata object.
+    Counting the keys of each label or shuffling the keys is done over the arrays of codes and rows.
+    The table is used as a dict {key: metadata object}, and records the keys put or deleted since it was loaded or
+    saved (as MetadataDict does), so that the metadata journal only saves the changes. Shared label objects must not
+    be modified in place.
+    Keys added after the table was built are kept in a dict, and merged into the arrays when they are too many.
+    """
+
+    def __init__(self, build_metadata, generate_value):
+        """
+        Initialization of an empty table.
+        :param build_metadata: function that builds the metadata object of a key from its value in the metadata file.
+        :param generate_value: function that translates the metadata object of a key into its value in the file.
+        """
+        self.build_metadata = build_metadata
+        self.generate_value = generate_value
+
+        # Distinct label objects, indexed by their code, and code of each value of the metadata file.
+        self.labels = []
+        self.label_codes = {}
+
+        self._set_rows(bytearray(), array("q", [0]), array("I"), array("i"))
+
+        # Key => code, for the keys added after the table was built.
+        self.extra = {}
+
+        self.changed_keys = set()
+        self.cleared = False
+
+    def _set_rows(self, keys_buffer, offsets, hashes, codes):
+        """
+        Replaces the arrays of the table.
+        :param keys_buffer: bytearray with the keys encoded in UTF-8, one after another.
+        :param offsets: array with the start of each key in the buffer, plus the end of the last one.
+        :param hashes: array with the truncated hash of each key.
+        :param codes: array with the code of the label of each key.
+        """
+        self.keys_buffer = keys_buffer
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.codes = np.frombuffer(codes, dtype=np.int32)
+
+        hashes = np.frombuffer(hashes, dtype=np.uint32)
+        self.order = np.argsort(hashes, kind="stable").astype(np.uint32 if len(hashes) < 2**32 else np.int64)
+        self.sorted_hashes = hashes[self.order]
+
+        # Rows of deleted keys keep their place with code -1.
+        self.rows_count = len(self.codes)
+        self.deleted_rows = 0
+
+    def _build_rows(self, pairs):
+        """
+        Builds the arrays of the table from its keys.
+        :param pairs: iterable of tuples (key, code of its label).
+        """
+        keys_buffer = bytearray()
+        offsets = array("q", [0])
+        hashes = array("I")
+        codes = array("i")
+
+        for key, code in pairs:
+            keys_buffer += key.encode("utf-8")
+            offsets.append(len(keys_buffer))
+            hashes.append(hash(key) & HASH_MASK)
+            codes.append(code)
+
+        self._set_rows(keys_buffer, offsets, hashes, codes)
+        self.extra = {}
+
+    def load(self, pairs):
+        """
+        Fills the table with the keys and values of a metadata file. The metadata object of each distinct value is
+        built only once. Loaded keys are not recorded as changes.
+        :param pairs: iterable of tuples (key, value in the metadata file). A repeated key keeps its last value, as
+        json.load() does.
+        """
+        self._build_rows((key, self._get_value_code(value)) for key, value in pairs)
+        self._drop_repeated_keys()
+
+    def _drop_repeated_keys(self):
+        """
+        Deletes the rows of the keys that are repeated in later rows. Repeated keys have the same hash, so only the
+        rows whose hash is shared with other rows are compared.
+        """
+        repeated = np.flatnonzero(self.sorted_hashes[1:] == self.sorted_hashes[:-1])
+        rows = sorted(set(self.order[repeated].tolist() + self.order[repeated + 1].tolist()))
+        last_rows = {}
+
+        for row in rows:
+            key = self._get_key(row)
+
+            if key in last_rows:
+                self.codes[last_rows[key]] = -1
+                self.deleted_rows += 1
+
+            last_rows[key] = row
+
+    def _get_value_code(self, value, metadata=None):
+        """
+        :param value: value of a key in the metadata file.
+        :param metadata: metadata object of the value. If None, it is built from the value when it is new.
+        :return: code of the label of the value.
+        """
+        value_key = _get_value_key(value)
+        code = self.label_codes.get(value_key)
+
+        if code is None:
+            code = len(self.labels)
+            self.labels.append(self.build_metadata(value) if metadata is None else metadata)
+            self.label_codes[value_key] = code
+
+        return code
+
+    def _get_key(self, row):
+        """
+        :return: key of a row of the arrays.
+        """
+        return self.keys_buffer[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+
+    def _get_keys(self, rows):
+        """
+        :param rows: array of rows of the arrays.
+        :return: list with the key of each row.
+        """
+        starts = self.offsets[rows].tolist()
+        ends = self.offsets[rows + 1].tolist()
+        keys_buffer = self.keys_buffer
+
+        return [keys_buffer[start:end].decode("utf-8") for start, end in zip(starts, ends)]
+
+    def _get_live_rows(self):
+        """
+        :return: array with the rows of the arrays whose keys are not deleted, in order.
+        """
+        if self.deleted_rows:
+            return np.flatnonzero(self.codes >= 0)
+
+        return np.arange(self.rows_count)
+
+    def _find_row(self, key):
+        """
+        Finds the row of a key in the arrays, even if the key was deleted. If the key has several rows (it was
+        repeated in the metadata file), the row that is not deleted is preferred.
+        :param key: key to find.
+        :return: row of the key, or None if it is not in the arrays.
+        """
+        key_hash = hash(key) & HASH_MASK
+
+        # The hash is searched with the type of the array, otherwise the whole array would be converted on each search.
+        index = int(self.sorted_hashes.searchsorted(np.uint32(key_hash)))
+        encoded_key = key.encode("utf-8")
+        found_row = None
+
+        while index < self.rows_count and self.sorted_hashes[index] == key_hash:
+            row = int(self.order[index])
+
+            if self.keys_buffer[self.offsets[row]:self.offsets[row + 1]] == encoded_key:
+                found_row = row
+
+                if self.codes[row] >= 0:
+                    break
+
+            index += 1
+
+        return found_row
+
+    def _get_code(self, key):
+        """
+        :return: code of the label of a key, or None if the key is not in the table.
+        """
+        code = self.extra.get(key)
+
+        if code is None:
+            row = self._find_row(key)
+
+            if row is not None and self.codes[row] >= 0:
+                code = int(self.codes[row])
+
+        return code
+
+    def _merge(self):
+        """
+        Merges the keys added after the table was built into its arrays, and removes the rows of the deleted keys.
+        """
+        rows = self._get_live_rows()
+        pairs = list(zip(self._get_keys(rows), self.codes[rows].tolist())) + list(self.extra.items())
+        self._build_rows(pairs)
+
+    def __len__(self):
+        return self.rows_count - self.deleted_rows + len(self.extra)
+
+    def __contains__(self, key):
+        return self._get_code(key) is not None
+
+    def __getitem__(self, key):
+        code = self._get_code(key)
+
+        if code is None:
+            raise KeyError(key)
+
+        return self.labels[code]
+
+    def get(self, key, default=None):
+        code = self._get_code(key)
+
+        return default if code is None else self.labels[code]
+
+    def __setitem__(self, key, metadata):
+        code = self._get_value_code(self.generate_value(metadata), metadata)
+        row = None if key in self.extra else self._find_row(key)
+
+        if row is None:
+            self.extra[key] = code
+
+            if len(self.extra) >= max(MERGE_MIN_KEYS, self.rows_count * MERGE_RATIO):
+                self._merge()
+
+        else:
+            if self.codes[row] < 0:
+                self.deleted_rows -= 1
+
+            self.codes[row] = code
+
+        self.changed_keys.add(key)
+
+    def __delitem__(self, key):
+        if key in self.extra:
+            del self.extra[key]
+
+        else:
+            row = self._find_row(key)
+
+            if row is None or self.codes[row] < 0:
+                raise KeyError(key)
+
+            self.codes[row] = -1
+            self.deleted_rows += 1
+
+        self.changed_keys.add(key)
+
+    def pop(self, key, *args):
+        self.changed_keys.add(key)
+
+        if key not in self:
+            if args:
+                return args[0]
+
+            raise KeyError(key)
+
+        metadata = self[key]
+        del self[key]
+
+        return metadata
+
+    def update(self, *args, **kwargs):
+        for key, metadata in dict(*args, **kwargs).items():
+            self[key] = metadata
+
+    def clear(self):
+        self.labels = []
+        self.label_codes = {}
+        self._build_rows([])
+        self.changed_keys = set()
+        self.cleared = True
+
+    def reset_changes(self):
+        """
+        Forgets the changes recorded, once they are saved.
+        """
+        self.changed_keys = set()
+        self.cleared = False
+
+    def __iter__(self):
+        return iter(self.get_keys())
+
+    def keys(self):
+        return self.get_keys()
+
+    def values(self):
+        return [metadata for key, metadata in self.items()]
+
+    def items(self):
+        """
+        :return: generator of the tuples (key, metadata object), in the order the keys were added.
+        """
+        rows = self._get_live_rows()
+        labels = self.labels
+
+        for key, code in zip(self._get_keys(rows), self.codes[rows].tolist()):
+            yield key, labels[code]
+
+        for key, code in list(self.extra.items()):
+            yield key, labels[code]
+
+    def get_keys(self, shuffle=False, seed=None):
+        """
+        Retrieves the keys of the table as a list.
+        :param shuffle: boolean flag to shuffle the keys. The rows are permuted before the keys are decoded.
+        :param seed: seed of the shuffle. If None, the shuffle is not reproducible.
+        :return: list of keys, in the order they were added unless shuffled.
+        """
+        rows = self._get_live_rows()
+
+        if not shuffle:
+            return self._get_keys(rows) + list(self.extra)
+
+        permutation = np.random.RandomState(seed).permutation(len(rows) + len(self.extra))
+
+        if not self.extra:
+            return self._get_keys(rows[permutation])
+
+        keys = self._get_keys(rows) + list(self.extra)
+
+        return [keys[index] for index in permutation.tolist()]
+
+    def get_label_counts(self):
+        """
+        Counts the keys of each label, without visiting the keys.
+        :return: list of tuples (label object, number of keys), for the labels with keys, ordered by code.
+        """
+        if self.deleted_rows:
+            codes = self.codes[self.codes >= 0]
+        else:
+            codes = self.codes
+
+        counts = np.bincount(codes, minlength=len(self.labels))
+
+        if self.extra:
+            counts += np.bincount(np.fromiter(self.extra.values(), dtype=np.int32, count=len(self.extra)),
+                                  minlength=len(self.labels))
+
+        return [(self.labels[code], count) for code, count in enumerate(counts.tolist()) if count > 0]
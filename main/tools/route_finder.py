@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+import bisect
+import os
+import re
+
+__author__ = 'Iván de Paz Centeno'
+
+
+WORD_PATTERN = re.compile(r"[^\W_]+")   # Words of a route: letters and digits between separators (/, _, -, ., ...).
+WORDS_PASS_THRESHOLD = 64               # Tokens inside words from which they are searched in a single pass over the
+                                        # words, instead of one search for each token.
+
+
+class RouteFinder(object):
+    """
+    Index of a list of routes to find the routes that contain a token without comparing it against all of them.
+    Each route is split into words (letters and digits between separators) and every word points to the routes that
+    contain it. The words of a token tell which words the matching routes must have: a word of the token surrounded by
+    separators is a whole word of the route, a word at the start of the token is the end of a word of the route, a word
+    at the end of the token is the start of a word of the route, and a token without separators is inside a word of
+    the route. Only the routes with those words are compared against the token, so the result is the same as searching
+    the token in every route.
+    Routes can also be found by their exact file name, with or without extension.
+    """
+
+    def __init__(self, routes):
+        """
+        Initialization of the finder. The indexes are built the first time they are needed.
+        :param routes: list of routes.
+        """
+        self.routes = list(routes)
+
+        # Part shared by all the routes (usually the root folder), up to a separator. It is not indexed.
+        prefix = os.path.commonprefix(self.routes) if self.routes else ""
+        self.prefix = prefix[:prefix.rfind(os.sep) + 1]
+
+        # File name (and file name without extension) => indexes of the routes.
+        self.names = None
+
+        # Word => indexes of the routes that contain it, in order.
+        self.postings = None
+
+        # Sorted words (and reversed words) to find the words that start (or end) with a string.
+        self.words = None
+        self.reversed_words = None
+
+        # All the words in a single string, to find the words that contain a string. Built on demand.
+        self.vocabulary = None
+        self.offsets = None
+
+    def _build_names_index(self):
+        """
+        Builds the index of the routes by their file name, with and without extension.
+        """
+        self.names = defaultdict(list)
+
+        for route_index, route in enumerate(self.routes):
+            filename = route[route.rfind(os.sep) + 1:]
+            self.names[filename].append(route_index)
+
+            # As os.path.splitext(), dots at the start of the file name don't start an extension.
+            extension_start = filename.rfind(".")
+
+            if extension_start > len(filename) - len(filename.lstrip(".")):
+                self.names[filename[:extension_start]].append(route_index)
+
+    def _build_words_index(self):
+        """
+        Builds the index of the routes by their words. Routes usually share their folders, so the words of each folder
+        are extracted only once.
+        """
+        self.postings = defaultdict(list)
+        folder_words = {}
+        prefix_length = len(self.prefix)
+
+        for route_index, route in enumerate(self.routes):
+            filename_start = route.rfind(os.sep) + 1
+            folder = route[prefix_length:filename_start]
+
+            if folder not in folder_words:
+                folder_words[folder] = set(WORD_PATTERN.findall(folder))
+
+            words = folder_words[folder].union(WORD_PATTERN.findall(route, max(filename_start, prefix_length)))
+
+            for word in words:
+                self.postings[word].append(route_index)
+
+        self.words = sorted(self.postings)
+        self.reversed_words = sorted([word[::-1] for word in self.words])
+
+    def _overlaps_prefix(self, token):
+        """
+        Checks if the token could be found in a route partially or completely inside the part shared by all the
+        routes, which is not indexed.
+        :param token: token to search.
+        :return: True if the token may start inside the prefix.
+        """
+        return token in self.prefix or any([self.prefix.endswith(token[:length])
+                                            for length in range(1, min(len(token), len(self.prefix)) + 1)])
+
+    def _get_words_with_prefix(self, string):
+        """
+        :return: list of indexed words that start with the string.
+        """
+        words = []
+        index = bisect.bisect_left(self.words, string)
+
+        while index < len(self.words) and self.words[index].startswith(string):
+            words.append(self.words[index])
+            index += 1
+
+        return words
+
+    def _get_words_with_suffix(self, string):
+        """
+        :return: list of indexed words that end with the string.
+        """
+        reversed_string = string[::-1]
+        words = []
+        index = bisect.bisect_left(self.reversed_words, reversed_string)
+
+        while index < len(self.reversed_words) and self.reversed_words[index].startswith(reversed_string):
+            words.append(self.reversed_words[index][::-1])
+            index += 1
+
+        return words
+
+    def _get_words_containing(self, string):
+        """
+        :return: list of indexed words that contain the string.
+        """
+        if self.vocabulary is None:
+            self.offsets = []
+            position = 0
+
+            for word in self.words:
+                self.offsets.append(position)
+                position += len(word) + 1
+
+            self.offsets.append(position)
+            self.vocabulary = "\n".join(self.words) + "\n"
+
+        words = []
+        position = self.vocabulary.find(string)
+
+        while position >= 0:
+            word_index = bisect.bisect_right(self.offsets, position) - 1
+            words.append(self.words[word_index])
+
+            # The next search starts in the next word.
+            position = self.vocabulary.find(string, self.offsets[word_index + 1])
+
+        return words
+
+    def _get_words_containing_many(self, strings):
+        """
+        Finds the indexed words that contain each string, in a single pass over the words: the substrings of each word
+        with the lengths of the strings are looked up among the strings.
+        :param strings: set of strings.
+        :return: dict {string: list of indexed words that contain it}.
+        """
+        strings = set(strings)
+        words_containing = {string: [] for string in strings}
+        lengths = sorted(set([len(string) for string in strings]))
+
+        for word in self.words:
+            contained = set()
+
+            for length in lengths:
+                if length > len(word):
+                    break
+
+                contained.update([word[start:start + length] for start in range(len(word) - length + 1)])
+
+            for string in contained.intersection(strings):
+                words_containing[string].append(word)
+
+        return words_containing
+
+    def _get_candidates(self, token, cache):
+        """
+        Retrieves the indexes of the routes that may contain the token, from the words of the token.
+        :param token: token to search.
+        :param cache: dict with the words found for each (kind of search, string), shared by the tokens of a batch.
+        :return: sorted list of indexes of routes, or None if all the routes must be compared.
+        """
+        if not token or self._overlaps_prefix(token):
+            return None
+
+        best_words = None
+        best_count = 0
+
+        for match in WORD_PATTERN.finditer(token):
+            left_bounded = match.start() > 0
+            right_bounded = match.end() < len(token)
+            word = match.group()
+
+            if left_bounded and right_bounded:
+                search = ("word", word)
+            elif left_bounded:
+                search = ("prefix", word)
+            elif right_bounded:
+                search = ("suffix", word)
+            else:
+                search = ("contains", word)
+
+            if search not in cache:
+                if search[0] == "word":
+                    cache[search] = [word] if word in self.postings else []
+                elif search[0] == "prefix":
+                    cache[search] = self._get_words_with_prefix(word)
+                elif search[0] == "suffix":
+                    cache[search] = self._get_words_with_suffix(word)
+                else:
+                    cache[search] = self._get_words_containing(word)
+
+            # The word of the token that leads to less routes is used.
+            words = cache[search]
+            count = sum([len(self.postings[word]) for word in words])
+
+            if best_words is None or count < best_count:
+                best_words = words
+                best_count = count
+
+            if best_count == 0:
+                break
+
+        if best_words is None:
+            # The token is only made of separators.
+            return None
+
+        if len(best_words) == 1:
+            return self.postings[best_words[0]]
+
+        return sorted(set([route_index for word in best_words for route_index in self.postings[word]]))
+
+    def find_routes(self, tokens, exact=False):
+        """
+        Finds the routes of a batch of tokens. The index is used for all of them, and the tokens that can't use it
+        are searched together in a single pass over the routes.
+        :param tokens: list of tokens to search.
+        :param exact: boolean flag to find the routes whose file name is the token, with or without extension,
+        instead of the routes that contain the token.
+        :return: dict {token: list of routes}, with the routes in their original order.
+        """
+        found = {}
+
+        if exact:
+            if self.names is None:
+                self._build_names_index()
+
+            for token in tokens:
+                found[token] = [self.routes[route_index] for route_index in sorted(set(self.names.get(token, [])))]
+
+            return found
+
+        if self.postings is None:
+            self._build_words_index()
+
+        cache = {}
+        unindexed_tokens = []
+
+        # Tokens without separators are searched inside the words. When there are many of them, all of them are
+        # searched at once.
+        inner_strings = set([token for token in tokens if WORD_PATTERN.fullmatch(token)])
+
+        if len(inner_strings) >= WORDS_PASS_THRESHOLD:
+            cache.update({("contains", string): words
+                          for string, words in self._get_words_containing_many(inner_strings).items()})
+
+        for token in tokens:
+            if token in found:
+                continue
+
+            candidates = self._get_candidates(token, cache)
+
+            if candidates is None:
+                found[token] = []
+                unindexed_tokens.append(token)
+            else:
+                found[token] = [self.routes[route_index] for route_index in candidates
+                                if token in self.routes[route_index]]
+
+        if unindexed_tokens:
+            for route in self.routes:
+                for token in unindexed_tokens:
+                    if token in route:
+                        found[token].append(route)
+
+        return found
+
+    def find_route(self, token, exact=False):
+        """
+        Finds the routes of a token.
+        :param token: token to search.
+        :param exact: boolean flag to find the routes whose file name is the token, with or without extension,
+        instead of the routes that contain the token.
+        :return: list of routes, in their original order.
+        """
+        return self.find_routes([token], exact=exact)[token]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+__author__ = 'Iván de Paz Centeno'
+
+
+ROUTES_INDEX_FILENAME = os.path.join(".dtb_cache", "routes.json")   # Index of the files, inside the root folder.
+ROUTES_INDEX_VERSION = 1
+RACY_MTIME_SECONDS = 2      # Folders modified this close to a refresh are listed again on the next one.
+
+
+class RouteIndex(object):
+    """
+    Index of the files under a folder, kept up to date without walking the whole tree.
+    The names of the files and subfolders of each folder are stored with the modification time of the folder. A
+    folder only changes its modification time when entries are added, removed or renamed inside it, so on each refresh
+    only the folders with a different modification time are listed again; the others just need a stat.
+    The index is stored in a JSON file, by default in a hidden folder inside the root folder. That folder is not
+    indexed, so that writing the index doesn't change the tree.
+    """
+
+    def __init__(self, root_folder, index_filename=None):
+        """
+        Initialization of the index.
+        :param root_folder: folder to index.
+        :param index_filename: file to store the index. If None, it is stored inside the root folder. If False, the
+        index is not stored and the tree is listed completely on each refresh.
+        """
+        if index_filename is None:
+            index_filename = os.path.join(root_folder, ROUTES_INDEX_FILENAME)
+
+        self.root_folder = root_folder
+        self.index_filename = index_filename
+        self.index_folder = None
+
+        if index_filename:
+            self.index_folder = os.path.relpath(os.path.dirname(os.path.abspath(index_filename)),
+                                                os.path.abspath(root_folder))
+
+        # Relative path of each folder => [modification time (ns), names of the files, names of the subfolders].
+        # Folders are ordered top-down, as os.walk() visits them.
+        self.folders = {}
+
+    def load(self):
+        """
+        Reads the index from its file. A missing or invalid file leaves the index empty.
+        """
+        self.folders = {}
+
+        if not self.index_filename or not os.path.exists(self.index_filename):
+            return
+
+        try:
+            with open(self.index_filename) as index_file:
+                content = json.load(index_file)
+
+        except ValueError:
+            print("Routes index {} is not valid. It will be built again.".format(self.index_filename))
+            return
+
+        if content.get("version") == ROUTES_INDEX_VERSION:
+            self.folders = content["folders"]
+
+    def save(self):
+        """
+        Writes the index into its file. The file is replaced atomically. Errors writing it are reported but ignored,
+        since the index can always be built again.
+        """
+        if not self.index_filename:
+            return
+
+        temp_filename = self.index_filename + ".tmp"
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_filename)), exist_ok=True)
+
+            with open(temp_filename, "w") as index_file:
+                json.dump({"version": ROUTES_INDEX_VERSION, "folders": self.folders}, index_file)
+
+            os.replace(temp_filename, self.index_filename)
+
+        except OSError as ex:
+            print("Routes index {} could not be written. Reason: {}".format(self.index_filename, ex))
+
+    @staticmethod
+    def _list_folder(folder):
+        """
+        Lists the entries of a folder, as os.walk() does: symbolic links to folders are listed as subfolders, but
+        they are not followed.
+        :param folder: folder to list.
+        :return: tuple (names of the files, names of the subfolders to descend into).
+        """
+        filenames = []
+        subfolders = []
+
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if not is_dir:
+                    filenames.append(entry.name)
+                elif not entry.is_symlink():
+                    subfolders.append(entry.name)
+
+        return filenames, subfolders
+
+    def refresh(self):
+        """
+        Brings the index up to date with the tree, listing again only the folders that changed since the last
+        refresh. The index file is rewritten if anything changed.
+        :return: number of folders listed again.
+        """
+        if not self.folders:
+            self.load()
+
+        scan_time = time.time_ns()
+        racy_time = scan_time - RACY_MTIME_SECONDS * 1000000000
+
+        folders = {}
+        listed = 0
+        pending = [""]
+
+        while pending:
+            relative_folder = pending.pop()
+
+            if relative_folder == self.index_folder:
+                continue
+
+            folder = os.path.join(self.root_folder, relative_folder) if relative_folder else self.root_folder
+
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                continue
+
+            cached = self.folders.get(relative_folder)
+
+            if cached is not None and cached[0] == mtime:
+                entry = cached
+            else:
+                try:
+                    filenames, subfolders = self._list_folder(folder)
+                except OSError as ex:
+                    print("Folder {} could not be listed. Reason: {}".format(folder, ex))
+                    continue
+
+                # A folder modified right now could be modified again within the same mtime: it is not trusted.
+                entry = [mtime if mtime < racy_time else -1, filenames, subfolders]
+                listed += 1
+
+            folders[relative_folder] = entry
+            pending.extend([os.path.join(relative_folder, subfolder) for subfolder in reversed(entry[2])])
+
+        changed = listed > 0 or folders.keys() != self.folders.keys()
+        self.folders = folders
+
+        if changed:
+            self.save()
+
+        return listed
+
+    def get_routes(self, extension_set):
+        """
+        Retrieves the routes of the files that match the extensions. The index must be refreshed before.
+        :param extension_set: ExtensionSet with the extensions of the files.
+        :return: list of routes, relative to the working directory as the root folder is.
+        """
+        routes = []
+
+        for relative_folder, (mtime, filenames, subfolders) in self.folders.items():
+            folder = os.path.join(self.root_folder, relative_folder) if relative_folder else self.root_folder
+            routes += [os.path.join(folder, filename) for filename in extension_set.fnfilter(filenames)]
+
+        return routes
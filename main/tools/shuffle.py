@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+import heapq
+import math
+import random
+
+__author__ = 'Iván de Paz Centeno'
+
+
+def _spread(items, stream_id, jitter=None):
+    """
+    Assigns to each item of a sequence an evenly spaced position between 0 and 1, keeping their order.
+    :param items: sequence of items.
+    :param stream_id: identifier of the sequence, used to break ties with other sequences.
+    :param jitter: function returning a random offset between 0 and 1 for each item inside its slot. If None, items
+    are placed in the middle of their slots.
+    :return: generator of tuples (position, stream_id, item).
+    """
+    count = len(items)
+
+    for index, item in enumerate(items):
+        offset = 0.5 if jitter is None else jitter()
+        yield (index + offset) / count, stream_id, item
+
+
+def _insert_evenly(sequence, items, item_class, max_consecutive):
+    """
+    Inserts items of a class evenly along a sequence, without exceeding the maximum consecutive items of the class.
+    If there is not enough room for all of them, the remaining ones are appended at the end.
+    :param sequence: list of tuples (class, item).
+    :param items: items of the class to insert.
+    :param item_class: class of the items to insert.
+    :param max_consecutive: maximum number of consecutive items of the same class.
+    :return: list of tuples (class, item) with the items inserted.
+    """
+    # Room for items of the class before each element of the sequence and at the end of it.
+    capacities = []
+    run_length = 0
+
+    for current_class, item in sequence:
+        if current_class == item_class:
+            capacities.append(0)
+            run_length += 1
+        else:
+            capacities.append(max_consecutive - run_length)
+            run_length = 0
+
+    capacities.append(max_consecutive - run_length)
+
+    total_capacity = sum(capacities)
+    items = deque(items)
+    inserted = 0
+    cumulative_capacity = 0
+    result = []
+
+    for index, capacity in enumerate(capacities):
+        if capacity > 0 and items:
+            cumulative_capacity += capacity
+            target = min(inserted + capacity, len(items) + inserted,
+                         (len(items) + inserted) * cumulative_capacity // total_capacity)
+
+            result.extend([(item_class, items.popleft()) for _ in range(target - inserted)])
+            inserted = target
+
+        if index < len(sequence):
+            result.append(sequence[index])
+
+    result.extend([(item_class, item) for item in items])
+
+    return result
+
+
+def merge_evenly(sequences):
+    """
+    Merges several sequences into one, spreading each of them evenly along the result and keeping their order.
+    :param sequences: list of sequences to merge.
+    :return: list with the items of all the sequences.
+    """
+    streams = [_spread(sequence, stream_id) for stream_id, sequence in enumerate(sequences) if sequence]
+    return [item for position, stream_id, item in heapq.merge(*streams)]
+
+
+def interleave_evenly(counts, rng=None):
+    """
+    Decides the order in which several sequences are merged, spreading each of them evenly along the result and
+    keeping their order. Only the lengths of the sequences are needed, so they can be read as they are merged.
+    :param counts: list with the length of each sequence.
+    :param rng: random generator (an instance of random.Random or the random module) to place each item at a random
+    point of its slot, so that the sequences are shuffled among them. If None, items are placed in the middle of their
+    slots.
+    :return: generator with the index of the sequence of each item of the result.
+    """
+    jitter = None if rng is None else rng.random
+    streams = [_spread(range(count), stream_id, jitter) for stream_id, count in enumerate(counts) if count]
+
+    for position, stream_id, item in heapq.merge(*streams):
+        yield stream_id
+
+
+def interleaved_shuffle(items, classes, max_consecutive=None, rng=random):
+    """
+    Shuffles the items interleaving their classes, so that each class is spread evenly along the result and
+    every window of the result keeps approximately the proportion of the classes.
+    It runs in O(n log k), being k the number of classes.
+    :param items: list of items to shuffle.
+    :param classes: list with the class of each item.
+    :param max_consecutive: maximum number of consecutive items of the same class. If the classes are too imbalanced
+    to respect it, the smallest feasible number is used instead. If None, runs are only limited by the spreading.
+    :param rng: random generator to use (an instance of random.Random or the random module).
+    :return: list with the shuffled items.
+    """
+    items_by_class = {}
+
+    for item, item_class in zip(items, classes):
+        items_by_class.setdefault(item_class, []).append(item)
+
+    if not items_by_class:
+        return []
+
+    # The biggest class needs at least one item of another class between each run.
+    biggest_count = max([len(class_items) for class_items in items_by_class.values()])
+    feasible_consecutive = math.ceil(biggest_count / (len(items) - biggest_count + 1))
+
+    if max_consecutive is None:
+        max_consecutive = len(items)
+
+    elif max_consecutive < feasible_consecutive:
+        print("Warning: classes are too imbalanced for a maximum of {} consecutive items of the same class. "
+              "Using {} instead.".format(max_consecutive, feasible_consecutive))
+
+        max_consecutive = feasible_consecutive
+
+    streams = []
+
+    # Items of each class are shuffled and spread evenly, each one at a random offset inside its slot.
+    for class_id, class_items in enumerate(items_by_class.values()):
+        rng.shuffle(class_items)
+        streams.append(_spread([(class_id, item) for item in class_items], class_id, rng.random))
+
+    result = []
+    run_class = None
+    run_length = 0
+
+    # Items that would exceed the maximum consecutive count. All of them belong to the same class.
+    deferred = deque()
+    deferred_class = None
+
+    for position, stream_id, (item_class, item) in heapq.merge(*streams):
+
+        if item_class == run_class and run_length >= max_consecutive:
+            deferred.append(item)
+            deferred_class = item_class
+            continue
+
+        if item_class == run_class:
+            run_length += 1
+        else:
+            run_class = item_class
+            run_length = 1
+
+        result.append((item_class, item))
+
+        if deferred and item_class != deferred_class:
+            # The run has been broken: deferred items can be placed again.
+            flushed = min(len(deferred), max_consecutive)
+            result.extend([(deferred_class, deferred.popleft()) for _ in range(flushed)])
+            run_class = deferred_class
+            run_length = flushed
+
+    # Deferred items left at the end are placed back into the gaps of the result where they fit.
+    if deferred:
+        result = _insert_evenly(result, deferred, deferred_class, max_consecutive)
+
+    return [item for item_class, item in result]
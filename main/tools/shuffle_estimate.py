@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import math
+
+__author__ = 'Iván de Paz Centeno'
+
+
+CONFIDENCE = 0.95
+Z_95 = 1.959964     # Quantile of the normal distribution for 95% confidence bounds.
+
+
+def _wilson_interval(hits, trials, z=Z_95):
+    """
+    Confidence interval of a proportion (Wilson score interval). It is valid even when no hits were observed.
+    :param hits: number of successes.
+    :param trials: number of trials.
+    :param z: quantile of the normal distribution of the confidence level.
+    :return: tuple (low, high) of the interval.
+    """
+    if trials == 0:
+        return 0.0, 1.0
+
+    proportion = hits / trials
+    denominator = 1 + z * z / trials
+    center = (proportion + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(proportion * (1 - proportion) / trials + z * z / (4 * trials * trials)) / denominator
+
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def _mean_interval(values, z=Z_95):
+    """
+    Mean of a sample and its confidence interval (normal approximation).
+    :param values: list of values of the sample.
+    :param z: quantile of the normal distribution of the confidence level.
+    :return: tuple (mean, low, high), or (None, None, None) if the sample is empty.
+    """
+    if not values:
+        return None, None, None
+
+    mean = sum(values) / len(values)
+
+    if len(values) == 1:
+        return mean, mean, mean
+
+    variance = sum([(value - mean) ** 2 for value in values]) / (len(values) - 1)
+    margin = z * math.sqrt(variance / len(values))
+
+    return mean, mean - margin, mean + margin
+
+
+def _entropy(counts):
+    """
+    :param counts: iterable with the number of elements of each class.
+    :return: Shannon entropy, in bits, of the distribution of the classes.
+    """
+    total = sum(counts)
+
+    return -sum([count / total * math.log2(count / total) for count in counts if count > 0])
+
+
+def _get_runs(labels):
+    """
+    :param labels: list of labels.
+    :return: list of tuples (label, length, touches edge) with the runs of consecutive equal labels. Runs at the
+    beginning or at the end of the list are marked, as they may continue outside of it.
+    """
+    runs = []
+    start = 0
+
+    for index in range(1, len(labels) + 1):
+        if index == len(labels) or labels[index] != labels[start]:
+            runs.append((labels[start], index - start, start == 0 or index == len(labels)))
+            start = index
+
+    return runs
+
+
+def _extrapolate_max_run(continue_probability, entries, probability=0.5):
+    """
+    Extrapolates the longest run among the entries of a class, assuming that the run lengths follow a geometric
+    distribution (as they do when the entries are randomly shuffled). The longest of N runs is lower than L with
+    probability (1 - p ^ (L - 1)) ^ N ~ exp(-N * p ^ (L - 1)), being p the probability of a run to continue, so its
+    quantiles can be computed directly.
+    :param continue_probability: probability of an entry of the class to be followed by another one of the class.
+    :param entries: number of entries of the class.
+    :param probability: probability of the longest run to be lower or equal than the length returned. By default,
+    the median.
+    :return: the length of the longest run at the given quantile.
+    """
+    if continue_probability <= 0 or entries <= 1:
+        return 1
+
+    if continue_probability >= 1:
+        return int(entries)
+
+    runs = entries * (1 - continue_probability)
+
+    # Smallest length L with exp(-runs * p ^ L) >= probability.
+    longest_run = math.log(runs / -math.log(probability)) / -math.log(continue_probability)
+
+    return max(1, min(int(entries), int(math.ceil(longest_run))))
+
+
+def estimate_shuffle(windows, thresholds, total_entries=None):
+    """
+    Estimates how shuffled a LMDB is from random windows of consecutive labels.
+    Each window is an independent sample of a batch of the LMDB, so proportions of batches are bounded with the
+    Wilson interval. Run lengths are only taken from runs fully inside a window, as runs at the edges may be longer.
+    :param windows: list of windows, each one a list of consecutive labels.
+    :param thresholds: list of run lengths to estimate how many batches have a run of, at least, that length.
+    :param total_entries: number of entries of the LMDB, to extrapolate its longest runs. By default, the entries read.
+    :return: dict with the number of windows ("windows") and entries read ("entries"), the entries of each class
+    ("classes"), the longest run of each class observed ("max_consecutive", a lower bound of the real one), the mean
+    run length of each class with its 95% interval ("run_length": {label: (mean, low, high)}), the proportion of
+    batches with a run of each class of, at least, each threshold with its 95% interval ("long_runs":
+    {label: {threshold: (proportion, low, high)}}) and the entropy of the classes inside a batch with its 95% interval,
+    compared to the entropy of the classes of all the entries read ("entropy": {"batch": (mean, low, high),
+    "global": entropy}). The longest run of each class in the whole LMDB is extrapolated from the probability of an
+    entry to be followed by another one of its class, assuming a random shuffle ("estimated_max_consecutive":
+    {label: (median, low, high)}, with its 95% interval). It is never lower than the longest run observed.
+    """
+    classes = {}
+    max_consecutive = {}
+    run_lengths = {}
+    long_run_windows = {}
+    continue_pairs = {}
+    window_entropies = []
+
+    for window in windows:
+        window_classes = {}
+        window_max_consecutive = {}
+
+        for label, length, touches_edge in _get_runs(window):
+            window_classes[label] = window_classes.get(label, 0) + length
+            window_max_consecutive[label] = max(length, window_max_consecutive.get(label, 0))
+
+            if not touches_edge:
+                run_lengths.setdefault(label, []).append(length)
+
+        for label, count in window_classes.items():
+            classes[label] = classes.get(label, 0) + count
+
+        for label, length in window_max_consecutive.items():
+            max_consecutive[label] = max(length, max_consecutive.get(label, 0))
+
+            for threshold in thresholds:
+                if length >= threshold:
+                    long_run_windows.setdefault(label, {}).setdefault(threshold, 0)
+                    long_run_windows[label][threshold] += 1
+
+        # Each pair of consecutive entries tells whether a run of the class of the first one continues.
+        for label, next_label in zip(window, window[1:]):
+            hits, trials = continue_pairs.get(label, (0, 0))
+            continue_pairs[label] = (hits + (label == next_label), trials + 1)
+
+        if window:
+            window_entropies.append(_entropy(window_classes.values()))
+
+    long_runs = {}
+
+    for label in classes:
+        long_runs[label] = {}
+
+        for threshold in thresholds:
+            hits = long_run_windows.get(label, {}).get(threshold, 0)
+            long_runs[label][threshold] = (hits / max(1, len(windows)),) + _wilson_interval(hits, len(windows))
+
+    entries = sum([len(window) for window in windows])
+
+    if total_entries is None:
+        total_entries = entries
+
+    run_length = {label: _mean_interval(run_lengths.get(label, [])) for label in classes}
+    estimated_max_consecutive = {}
+
+    for label in classes:
+        if label not in continue_pairs:
+            # Only runs crossing the edges of the windows were observed: they may be as long as the class.
+            estimated_max_consecutive[label] = (max_consecutive[label], max_consecutive[label], None)
+            continue
+
+        # The bounds take both the uncertainty of the probability of a run to continue and the spread of the longest
+        # run.
+        hits, trials = continue_pairs.get(label, (0, 0))
+        low, high = _wilson_interval(hits, trials)
+        class_entries = total_entries * classes[label] / entries
+        estimated_max_consecutive[label] = tuple([max(max_consecutive[label],
+                                                      _extrapolate_max_run(value, class_entries, probability))
+                                                  for value, probability in [(hits / trials, 0.5),
+                                                                             (low, (1 - CONFIDENCE) / 2),
+                                                                             (high, (1 + CONFIDENCE) / 2)]])
+
+    return {
+        "windows": len(windows),
+        "entries": entries,
+        "classes": classes,
+        "max_consecutive": max_consecutive,
+        "estimated_max_consecutive": estimated_max_consecutive,
+        "run_length": run_length,
+        "long_runs": long_runs,
+        "entropy": {
+            "batch": _mean_interval(window_entropies),
+            "global": _entropy(classes.values()) if classes else 0.0,
+        },
+    }
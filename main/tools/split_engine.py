@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class SplitEngine(object):
+    """
+    Assigns keys to splits deterministically, with the exact number of keys requested for each split.
+    Keys are ranked by a seeded hash of the key, so the assignment does not depend on the order of the keys nor on
+    the process that computes it. Keys already assigned in a previous export keep their split, and new keys fill the
+    counts that each split is missing; this way, growing the dataset never moves existing keys between splits.
+    Without the previous assignment, the exact counts can move the keys ranked next to the limits of the splits, so
+    the exporter always takes it from the manifests of the LMDBs that already have entries.
+    """
+
+    def __init__(self, splits, seed=0, stratify=False):
+        """
+        Initialization of the split engine.
+        :param splits: list of tuples (name, percentage). The split with the highest percentage also takes the
+        keys not covered by the percentages, if they sum less than 1.
+        :param seed: seed for the hash of the keys. Different seeds give different assignments.
+        :param stratify: boolean flag to split each class separately, so that every split keeps the class balance.
+        """
+        self.names = [name for name, percentage in splits]
+        self.percentages = [float(percentage) for name, percentage in splits]
+        self.seed = seed
+        self.stratify = stratify
+
+        if sum(self.percentages) > 1:
+            raise Exception("Splits are not correctly defined: they must sum 1 or less.")
+
+        # The split with highest percentage takes the remaining keys.
+        index_max = max(range(len(self.percentages)), key=self.percentages.__getitem__)
+        self.shares = list(self.percentages)
+        self.shares[index_max] = 1 - (sum(self.percentages) - self.percentages[index_max])
+
+    def get_names(self):
+        """
+        Getter for the names of the splits, in order.
+        :return:
+        """
+        return list(self.names)
+
+    def get_percentages(self):
+        """
+        Getter for the percentages of the splits, in order.
+        :return:
+        """
+        return list(self.percentages)
+
+    def hash_key(self, key):
+        """
+        Computes the seeded hash of a key.
+        :param key: key to hash.
+        :return: integer hash of the key.
+        """
+        digest = hashlib.md5("{}:{}".format(self.seed, key).encode("UTF-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def get_counts(self, total):
+        """
+        Computes the exact number of keys for each split, rounding by largest remainder.
+        :param total: total number of keys.
+        :return: list with the number of keys for each split.
+        """
+        return self._apportion(total, self.shares)
+
+    def get_stratum_counts(self, stratum_sizes):
+        """
+        Computes the number of keys of each stratum for each split. Strata are rounded together, so that the number of
+        keys of each split is the same as without stratifying.
+        :param stratum_sizes: list with the number of keys of each stratum.
+        :return: list with the number of keys for each split, for each stratum.
+        """
+        totals = self.get_counts(sum(stratum_sizes))
+        exact_counts = [[size * share for share in self.shares] for size in stratum_sizes]
+        counts = [[int(count) for count in row] for row in exact_counts]
+
+        missing_rows = [size - sum(row) for size, row in zip(stratum_sizes, counts)]
+        missing_columns = [total - sum(row[index] for row in counts) for index, total in enumerate(totals)]
+
+        cells = [(stratum, index) for stratum in range(len(counts)) for index in range(len(totals))]
+        cells.sort(key=lambda cell: counts[cell[0]][cell[1]] - exact_counts[cell[0]][cell[1]])
+
+        # Each stratum rounds up its largest remainders, as long as their splits are missing keys.
+        for stratum, index in cells:
+            if missing_rows[stratum] > 0 and missing_columns[index] > 0:
+                counts[stratum][index] += 1
+                missing_rows[stratum] -= 1
+                missing_columns[index] -= 1
+
+        # The keys left are given to any split that is still missing keys.
+        for stratum, index in cells:
+            amount = min(missing_rows[stratum], missing_columns[index])
+            counts[stratum][index] += amount
+            missing_rows[stratum] -= amount
+            missing_columns[index] -= amount
+
+        return counts
+
+    @staticmethod
+    def _apportion(total, weights):
+        """
+        Splits a total in integer parts proportional to the weights, rounding by largest remainder.
+        :param total: total to split.
+        :param weights: list of weights. They must sum 1.
+        :return: list with the part of each weight.
+        """
+        exact_counts = [total * weight for weight in weights]
+        counts = [int(count) for count in exact_counts]
+
+        by_remainder = sorted(range(len(counts)), key=lambda index: counts[index] - exact_counts[index])
+
+        for index in by_remainder[:total - sum(counts)]:
+            counts[index] += 1
+
+        return counts
+
+    def assign(self, keys, classes=None, previous=None):
+        """
+        Assigns each key to a split.
+        :param keys: list of keys.
+        :param classes: list with the class of each key. Only used if the engine stratifies.
+        :param previous: dict {key: split index} with the keys already assigned, which keep their split. The counts
+        of the splits are completed with the new keys.
+        :return: bytearray with the split index of each key, in the same order as the keys.
+        """
+        if previous is None:
+            previous = {}
+
+        assignment = bytearray(len(keys))
+        strata = {}
+
+        for position, key in enumerate(keys):
+            stratum = classes[position] if self.stratify and classes is not None else None
+            strata.setdefault(stratum, []).append(position)
+
+        stratum_counts = self.get_stratum_counts([len(positions) for positions in strata.values()])
+
+        for positions, counts in zip(strata.values(), stratum_counts):
+            missing_counts = list(counts)
+            new_positions = []
+
+            for position in positions:
+                split_index = previous.get(keys[position])
+
+                if split_index is None:
+                    new_positions.append(position)
+                else:
+                    assignment[position] = split_index
+                    missing_counts[split_index] -= 1
+
+            # Splits that already have more keys than their count can't give them back: the new keys are shared
+            # among the other splits, in proportion to the keys they are missing.
+            if any(count < 0 for count in missing_counts):
+                missing_counts = [max(0, count) for count in missing_counts]
+                missing_total = sum(missing_counts)
+                missing_counts = self._apportion(len(new_positions), [count / missing_total
+                                                                      for count in missing_counts])
+
+            new_positions.sort(key=lambda position: self.hash_key(keys[position]))
+
+            split_index = 0
+
+            for position in new_positions:
+                while missing_counts[split_index] <= 0:
+                    split_index += 1
+
+                assignment[position] = split_index
+                missing_counts[split_index] -= 1
+
+        return assignment
@@ -44,6 +44,13 @@ class Splitter(object):
         """
         return self.splitted_list
 
+    def get_split_percentage(self):
+        """
+        Getter for the split percentage of the splitter.
+        :return:
+        """
+        return self.split_percentage
+
     def get_name(self):
         """
         Getter for the name of the splitter.
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from main.dataset.dataset import LMDB_BATCH_SIZE
+from main.tools.lmdb_writer import LMDBWriter
+
+__author__ = 'Iván de Paz Centeno'
+
+# Measures the write throughput of LMDBWriter with small and big datums, for each write profile:
+#   count:      commits every LMDB_BATCH_SIZE entries, with regular puts (the previous behaviour).
+#   bytes:      commits on the budget of bytes and time, with append-mode puts (as the exporter writes).
+#   fast-write: same as bytes, without synchronous writes (--fast-write).
+# Usage: python3 -m test.benchmark_lmdb_write [<megabytes per run>]
+
+megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+datum_sizes = [
+    ("small (16x16x3)", 16 * 16 * 3),
+    ("big (512x512x3)", 512 * 512 * 3),
+]
+
+profiles = [
+    ("count", dict(batch_size=LMDB_BATCH_SIZE, batch_bytes=float("inf"))),
+    ("bytes", dict(append=True)),
+    ("fast-write", dict(append=True, fast_write=True)),
+]
+
+root_folder = tempfile.mkdtemp()
+
+print("{:<18} {:<12} {:>10} {:>14} {:>10}".format("Datum", "Profile", "Entries", "Entries/s", "MB/s"))
+
+try:
+    for datum_name, datum_size in datum_sizes:
+        entries = max(1, megabytes * 1024 * 1024 // datum_size)
+        key_width = len(str(entries))
+        values = [np.random.bytes(datum_size) for _ in range(min(entries, 64))]
+
+        for profile_name, options in profiles:
+            lmdb_foldername = os.path.join(root_folder, "lmdb_{}".format(profile_name))
+
+            start = time.perf_counter()
+
+            writer = LMDBWriter(lmdb_foldername, expected_entries=entries, **options)
+
+            for index in range(1, entries + 1):
+                key = "{:0>{}}_dbuild_{}.jpg".format(index, key_width, index).encode("ascii")
+                writer.put(key, values[index % len(values)])
+
+            writer.close()
+
+            elapsed = time.perf_counter() - start
+
+            print("{:<18} {:<12} {:>10} {:>14.0f} {:>10.1f}".format(datum_name, profile_name, entries,
+                                                                    entries / elapsed,
+                                                                    entries * datum_size / elapsed / 1024 / 1024))
+
+            shutil.rmtree(lmdb_foldername)
+
+finally:
+    shutil.rmtree(root_folder)
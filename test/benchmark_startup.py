@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import lmdb
+
+__author__ = 'Iván de Paz Centeno'
+
+# Measures the cold-start latency of each dtb subcommand, running each of them in a new process.
+# Usage: python3 test/benchmark_startup.py [<repetitions>]
+
+DTB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dtb.py")
+
+repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+dataset_folder = tempfile.mkdtemp()
+lmdb_folder = os.path.join(dataset_folder, "lmdb_train")
+
+try:
+    lmdb.open(lmdb_folder, map_size=10 * 1024 * 1024).close()
+
+    subprocess.check_call([sys.executable, DTB_PATH, "init", "GenericImageAgeDataset"], cwd=dataset_folder)
+
+    subcommands = [
+        ["--version"],
+        ["list-dataset-types"],
+        ["info"],
+        ["size"],
+        ["lmdb", "size", lmdb_folder],
+        ["lmdb", "check-shuffle-status", lmdb_folder],
+    ]
+
+    print("{:<40} {:>12} {:>12}".format("Subcommand", "Median (ms)", "Max (ms)"))
+
+    for subcommand in subcommands:
+        timings = []
+
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, DTB_PATH] + subcommand, cwd=dataset_folder,
+                                  stdout=subprocess.DEVNULL)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        print("{:<40} {:>12.1f} {:>12.1f}".format(" ".join(subcommand[:2]), statistics.median(timings), max(timings)))
+
+finally:
+    shutil.rmtree(dataset_folder)